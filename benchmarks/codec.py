@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+"""
+Compares the size and (de)serialization time of stored consent requests for each available storage codec.
+"""
+import argparse
+import timeit
+
+from cmservice.codec import Codec
+
+
+def consent_request(num_attributes: int, num_values: int) -> dict:
+    return {
+        'id': 'a4f2c0d6e1b34c5fa9d8e7f6a5b4c3d2',
+        'redirect_endpoint': 'https://proxy.example.com/consent/handle_consent',
+        'requester_name': [{'lang': 'en', 'text': 'Example Service'}, {'lang': 'sv', 'text': 'Exempeltjänst'}],
+        'locked_attrs': ['edupersontargetedid'],
+        'attr': {
+            'attribute_{}'.format(i): ['value {} of attribute {} for the user'.format(j, i) for j in range(num_values)]
+            for i in range(num_attributes)
+        },
+    }
+
+
+def codecs():
+    for serializer in ['json', 'orjson', 'msgpack']:
+        for compression in [None, 'zlib', 'zstd']:
+            try:
+                codec = Codec(serializer, compression, allow_extra_formats=True)
+            except ValueError:
+                continue
+            yield '{}+{}'.format(serializer, compression or 'none'), codec
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--attributes', type=int, default=20, help='number of attributes in the request')
+    parser.add_argument('--values', type=int, default=5, help='number of values per attribute')
+    parser.add_argument('-n', '--number', type=int, default=2000, help='number of iterations per measurement')
+    args = parser.parse_args(argv)
+
+    value = consent_request(args.attributes, args.values)
+    print('{:<18} {:>10} {:>12} {:>12}'.format('codec', 'bytes', 'encode (us)', 'decode (us)'))
+    for name, codec in codecs():
+        encoded = codec.encode(value)
+        assert codec.decode(encoded) == value
+        encode_time = timeit.timeit(lambda: codec.encode(value), number=args.number) / args.number
+        decode_time = timeit.timeit(lambda: codec.decode(encoded), number=args.number) / args.number
+        print('{:<18} {:>10} {:>12.1f} {:>12.1f}'.format(name, len(encoded.encode('utf-8')),
+                                                         encode_time * 10 ** 6, decode_time * 10 ** 6))
+
+
+if __name__ == '__main__':
+    main()
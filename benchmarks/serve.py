@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+"""
+Compares the gunicorn worker models of `cmservice-serve` on the full consent flow.
+
+For each worker class a server is started with file based SQLite databases, and a number of concurrent clients
+repeatedly: register a consent request (/creq), open the consent page (/consent), give consent (/save_consent)
+and verify it (/verify). Throughput and latency percentiles are reported per worker class and step.
+"""
+import argparse
+import http.client
+import json
+import os
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from urllib.parse import urlencode
+
+STEPS = ['creq', 'consent', 'save_consent', 'verify']
+STATE_PATTERN = re.compile(rb'name="state" value="([^"]+)"')
+
+
+def write_config(directory: str) -> tuple:
+    from Cryptodome.PublicKey import RSA
+
+    key = RSA.generate(2048)
+    public_key_path = os.path.join(directory, 'trusted.pub')
+    with open(public_key_path, 'wb') as f:
+        f.write(key.publickey().export_key())
+
+    config = {
+        'SSL': False,
+        'TRUSTED_KEYS': [public_key_path],
+        'SECRET_KEY': uuid.uuid4().hex,
+        'TICKET_TTL': 600,
+        'AUTO_SELECT_ATTRIBUTES': True,
+        'MAX_CONSENT_EXPIRATION_MONTH': 12,
+        'USER_CONSENT_EXPIRATION_MONTH': [3, 6],
+        'CONSENT_SALT': uuid.uuid4().hex,
+        'CONSENT_DATABASE_URL': 'sqlite:///' + os.path.join(directory, 'consent.db'),
+        'CONSENT_REQUEST_DATABASE_URL': 'sqlite:///' + os.path.join(directory, 'consent_request.db'),
+        'LOGGING_LEVEL': 'WARNING',
+    }
+    config_path = os.path.join(directory, 'settings.cfg')
+    with open(config_path, 'w') as f:
+        for name, value in config.items():
+            f.write('{} = {!r}\n'.format(name, value))
+    return config_path, key
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_until_ready(port: int, process, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('server exited with {}'.format(process.returncode))
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            connection.request('GET', '/health/ready')
+            if connection.getresponse().status == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError('server did not become ready')
+
+
+class Client(object):
+    def __init__(self, port: int, key, latencies: dict):
+        from jwkest.jwk import RSAKey
+
+        self.connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        self.signing_key = RSAKey(key=key, alg='RS256')
+        self.latencies = latencies
+        self.cookie = None
+
+    def get(self, step: str, path: str) -> http.client.HTTPResponse:
+        headers = {'Cookie': self.cookie} if self.cookie else {}
+        start = time.perf_counter()
+        self.connection.request('GET', path, headers=headers)
+        response = self.connection.getresponse()
+        body = response.read()
+        self.latencies[step].append(time.perf_counter() - start)
+        if response.getheader('Set-Cookie'):
+            self.cookie = response.getheader('Set-Cookie').split(';', 1)[0]
+        return response.status, body
+
+    def consent_flow(self):
+        from jwkest.jws import JWS
+
+        id = uuid.uuid4().hex
+        consent_request = {
+            'id': id,
+            'attr': {'givenName': ['Alice'], 'sn': ['Smith'], 'mail': ['alice@example.com']},
+            'redirect_endpoint': 'https://proxy.example.com/consent/handle_consent',
+            'requester_name': [{'lang': 'en', 'text': 'Example Service'}],
+        }
+        jwt = JWS(json.dumps(consent_request), alg='RS256').sign_compact([self.signing_key])
+        status, ticket = self.get('creq', '/creq/' + jwt)
+        assert status == 200, status
+        status, page = self.get('consent', '/consent/' + ticket.decode('utf-8'))
+        assert status == 200, status
+        state = STATE_PATTERN.search(page).group(1).decode('utf-8')
+        query = urlencode({'state': state, 'month': 3, 'attributes': 'givenName,mail', 'consent_status': 'Yes'})
+        status, _ = self.get('save_consent', '/save_consent?' + query)
+        assert status == 302, status
+        status, _ = self.get('verify', '/verify/' + id)
+        assert status == 200, status
+
+
+def run_clients(port: int, key, concurrency: int, duration: float) -> tuple:
+    latencies = {step: [] for step in STEPS}
+    flows = [0] * concurrency
+    errors = []
+    deadline = time.monotonic() + duration
+
+    def run(index: int):
+        client = Client(port, key, latencies)
+        while time.monotonic() < deadline:
+            try:
+                client.consent_flow()
+                flows[index] += 1
+            except Exception as e:
+                errors.append(e)
+                client = Client(port, key, latencies)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(concurrency)]
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(flows) / (time.monotonic() - start), latencies, errors
+
+
+def benchmark(worker_class: str, config_path: str, key, args) -> dict:
+    port = free_port()
+    command = [sys.executable, '-m', 'cmservice.service.serve', '--config', config_path,
+               '--worker-class', worker_class, '--bind', '127.0.0.1:{}'.format(port)]
+    if args.workers:
+        command += ['--workers', str(args.workers)]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_until_ready(port, process)
+        flows_per_second, latencies, errors = run_clients(port, key, args.concurrency, args.duration)
+    finally:
+        process.terminate()
+        process.wait()
+
+    result = {'worker_class': worker_class, 'flows_per_second': flows_per_second, 'errors': len(errors)}
+    for step in STEPS:
+        if latencies[step]:
+            percentiles = statistics.quantiles(latencies[step], n=100)
+            result[step] = {'p50_ms': percentiles[49] * 1000, 'p99_ms': percentiles[98] * 1000}
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--worker-classes', nargs='+', default=['sync', 'gthread', 'gevent'],
+                        help='worker classes to compare')
+    parser.add_argument('--workers', type=int, help='number of workers, defaults to the CPU based default')
+    parser.add_argument('-c', '--concurrency', type=int, default=16, help='number of concurrent clients')
+    parser.add_argument('-d', '--duration', type=float, default=20, help='seconds to run each worker class for')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args(argv)
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        config_path, key = write_config(directory)
+        for worker_class in args.worker_classes:
+            if worker_class == 'gevent':
+                try:
+                    import gevent  # noqa: F401
+                except ImportError:
+                    print('gevent is not installed, skipping it', file=sys.stderr)
+                    continue
+            results.append(benchmark(worker_class, config_path, key, args))
+
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        return
+
+    print('{:<10} {:>9} {:>7}  {}'.format('workers', 'flows/s', 'errors',
+                                         '  '.join('{:>22}'.format(step + ' p50/p99 ms') for step in STEPS)))
+    for result in results:
+        print('{:<10} {:>9.1f} {:>7}  {}'.format(
+            result['worker_class'], result['flows_per_second'], result['errors'],
+            '  '.join('{:>22}'.format('{p50_ms:.1f}/{p99_ms:.1f}'.format(**result[step]) if step in result else '-')
+                      for step in STEPS)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""
+Measures how long it takes a fresh interpreter to import CMservice and create the app.
+
+Each run is done in a new process, to measure a cold start like the one of a newly spawned worker.
+The app is created both with WARM_UP disabled, as in a worker forked from a preloaded app which was warmed up
+before forking, and with it enabled, which is the default and what a worker of an app which isn't preloaded does.
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+MEASURE_SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+from cmservice.service.wsgi import create_app
+imported = time.perf_counter()
+create_app({
+    'TRUSTED_KEYS': [],
+    'SECRET_KEY': 'benchmark',
+    'TICKET_TTL': 600,
+    'AUTO_SELECT_ATTRIBUTES': True,
+    'MAX_CONSENT_EXPIRATION_MONTH': 12,
+    'USER_CONSENT_EXPIRATION_MONTH': [3, 6],
+    'CONSENT_SALT': 'benchmark',
+    'LOGGING_LEVEL': 'WARNING',
+    'WARM_UP': '--warm-up' in sys.argv,
+})
+created = time.perf_counter()
+json.dump({'import': imported - start, 'create_app': created - imported, 'modules': sorted(sys.modules)},
+          sys.stdout)
+'''
+
+
+def measure(warm_up: bool):
+    output = subprocess.check_output([sys.executable, '-c', MEASURE_SCRIPT] + (['--warm-up'] if warm_up else []))
+    return json.loads(output.decode('utf-8'))
+
+
+def summarize(runs: list) -> dict:
+    return {
+        'import': statistics.median(run['import'] for run in runs),
+        'create_app': statistics.median(run['create_app'] for run in runs),
+        'total': statistics.median(run['import'] + run['create_app'] for run in runs),
+        'modules': runs[-1]['modules'],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--runs', type=int, default=5, help='number of cold starts to measure')
+    parser.add_argument('--max-seconds', type=float,
+                        help='fail if the median time to import and create the app exceeds this')
+    parser.add_argument('--warm-up', choices=['both', 'on', 'off'], default='both',
+                        help='whether to warm up the app when creating it, or measure both')
+    parser.add_argument('--json', action='store_true', help='print the result as JSON')
+    args = parser.parse_args(argv)
+
+    settings = {'both': [False, True], 'on': [True], 'off': [False]}[args.warm_up]
+    result = {'warm_up' if warm_up else 'no_warm_up': summarize([measure(warm_up) for _ in range(args.runs)])
+              for warm_up in settings}
+
+    if args.json:
+        json.dump(result, sys.stdout)
+    else:
+        for name, times in result.items():
+            print('{name}: import: {import:.3f}s, create_app: {create_app:.3f}s, total: {total:.3f}s '
+                  '(median of {runs} runs)'.format(name=name, runs=args.runs, **times))
+
+    exceeded = False
+    for name, times in result.items():
+        if args.max_seconds is not None and times['total'] > args.max_seconds:
+            print('{} startup time {:.3f}s exceeds {:.3f}s'.format(name, times['total'], args.max_seconds),
+                  file=sys.stderr)
+            exceeded = True
+    return 1 if exceeded else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -25,16 +25,31 @@ setup(
     },
     classifiers=['Development Status :: 4 - Beta',
                  'Topic :: Software Development :: Libraries :: Python Modules',
-                 'Programming Language :: Python :: 3.4'],
+                 'Programming Language :: Python :: 3.9'],
+    python_requires='>=3.9',
     install_requires=[
         'Flask',
         'pyjwkest',
+        'pycryptodomex',
         'Flask-Babel',
         'Flask-Mako',
         'dataset',
         'gunicorn',
         'python-dateutil'
     ],
+    extras_require={
+        'brotli': ['brotli'],
+        'orjson': ['orjson'],
+        'msgpack': ['msgpack'],
+        'zstd': ['zstandard'],
+        'gevent': ['gevent'],
+    },
+    entry_points={
+        'console_scripts': [
+            'cmservice-build-static=cmservice.service.static_assets:main',
+            'cmservice-serve=cmservice.service.serve:main',
+        ],
+    },
     zip_safe=False,
     message_extractors={'.': [
         ('src/cmservice/**.py', 'python', None),
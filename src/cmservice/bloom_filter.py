@@ -0,0 +1,56 @@
+import hashlib
+import math
+
+
+class BloomFilter(object):
+    """
+    A Bloom filter over strings: membership tests may give false positives, but never false negatives.
+
+    Adding is not thread safe, concurrent adds must be serialized by the caller.
+    """
+
+    def __init__(self, capacity: int, error_rate: float):
+        """
+        Constructor.
+        :param capacity: number of items the filter is sized for
+        :param error_rate: wanted false positive rate when the filter holds `capacity` items
+        """
+        if capacity < 1:
+            raise ValueError('capacity must be positive')
+        if not 0 < error_rate < 1:
+            raise ValueError('error_rate must be between 0 and 1')
+
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_bits = max(int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)), 8)
+        self.num_hashes = max(int(round(self.num_bits / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item: str):
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'big')
+        h2 = int.from_bytes(digest[8:], 'big') | 1
+        return ((h1 + i * h2) % self.num_bits for i in range(self.num_hashes))
+
+    def add(self, item: str):
+        """
+        Adds an item to the filter.
+        :param item: the item to add
+        """
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+    def __len__(self) -> int:
+        return self.count
+
+    @property
+    def false_positive_rate(self) -> float:
+        """
+        :return: the estimated false positive rate given the number of items added so far
+        """
+        return (1 - math.exp(-self.num_hashes * self.count / self.num_bits)) ** self.num_hashes
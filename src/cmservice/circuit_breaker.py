@@ -0,0 +1,183 @@
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from datetime import datetime
+
+from cmservice.consent import Consent
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, name: str, retry_after: float):
+        super().__init__('circuit {} is open'.format(name))
+        self.retry_after = retry_after
+
+
+class CircuitBreaker(object):
+    """
+    Stops calling a failing backend, so requests fail fast instead of waiting for it.
+
+    After `failure_threshold` consecutive failed (or slow) calls the circuit opens, and all calls are rejected
+    for `reset_timeout` seconds. After that it's half open: a single trial call is let through, which closes the
+    circuit if it succeeds and opens it again if it fails.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30,
+                 slow_call_duration: float = None, max_transitions: int = 20, is_failure=None):
+        """
+        Constructor.
+        :param name: name of the protected backend
+        :param failure_threshold: number of consecutive failures which opens the circuit
+        :param reset_timeout: seconds the circuit stays open before a trial call is let through
+        :param slow_call_duration: calls taking longer than this many seconds count as failures,
+                                   if not specified only calls raising an exception do
+        :param max_transitions: number of recent state transitions to keep
+        :param is_failure: callable telling whether an exception raised by a call is a failure of the backend,
+                           if not specified every exception is. Other exceptions neither open nor close the circuit
+        """
+        self.name = name
+        self.is_failure = is_failure or (lambda e: True)
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.slow_call_duration = slow_call_duration
+        self.state = self.CLOSED
+        self.transitions = deque(maxlen=max_transitions)
+        self.listeners = []
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_progress = False
+        self._lock = threading.Lock()
+
+    def _transition(self, state: str):
+        logger.warning('circuit %s changed from %s to %s', self.name, self.state, state)
+        self.transitions.append({'time': datetime.now().isoformat(), 'from': self.state, 'to': state})
+        previous, self.state = self.state, state
+        for listener in self.listeners:
+            listener(self, previous, state)
+
+    def _before_call(self):
+        with self._lock:
+            if self.state == self.OPEN:
+                retry_after = self._opened_at + self.reset_timeout - time.monotonic()
+                if retry_after > 0:
+                    raise CircuitOpenError(self.name, retry_after)
+                self._transition(self.HALF_OPEN)
+            if self.state == self.HALF_OPEN:
+                if self._trial_in_progress:
+                    raise CircuitOpenError(self.name, self.reset_timeout)
+                self._trial_in_progress = True
+
+    def _end_trial(self):
+        with self._lock:
+            self._trial_in_progress = False
+
+    def _on_success(self):
+        with self._lock:
+            self._failures = 0
+            self._trial_in_progress = False
+            if self.state != self.CLOSED:
+                self._transition(self.CLOSED)
+
+    def _on_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_in_progress = False
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and
+                                                self._failures >= self.failure_threshold):
+                self._opened_at = time.monotonic()
+                self._transition(self.OPEN)
+
+    @contextmanager
+    def guard(self):
+        """
+        Protects the call made in the enclosed block.
+        :raise CircuitOpenError: if the circuit is open
+        """
+        self._before_call()
+        start = time.monotonic()
+        outcome = None
+        try:
+            yield
+        except Exception as e:
+            if self.is_failure(e):
+                outcome = self._on_failure
+            raise
+        else:
+            if self.slow_call_duration is not None and time.monotonic() - start > self.slow_call_duration:
+                logger.debug('slow call through circuit %s', self.name)
+                outcome = self._on_failure
+            else:
+                outcome = self._on_success
+        finally:
+            # also when the call is interrupted by a BaseException, e.g. a gevent timeout
+            if outcome is not None:
+                outcome()
+            else:
+                self._end_trial()
+
+    def stats(self) -> dict:
+        """
+        :return: the state of the circuit and its recent transitions
+        """
+        return {'state': self.state, 'consecutive_failures': self._failures, 'transitions': list(self.transitions)}
+
+
+class StaleConsentCache(object):
+    """
+    The last consent successfully read for each hashed id, used to answer when the consent database is unavailable.
+    """
+
+    def __init__(self, max_staleness: float, max_size: int = 10000):
+        """
+        Constructor.
+        :param max_staleness: seconds after being read during which a consent may be used
+        :param max_size: maximum number of consents to keep, the least recently read are dropped first
+        """
+        self.max_staleness = max_staleness
+        self.max_size = max_size
+        self._consents = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, hashed_id: str, consent: Consent):
+        """
+        :param hashed_id: hashed consent id
+        :param consent: the consent read from, or written to, the database; None if there is none
+        """
+        with self._lock:
+            self._consents.pop(hashed_id, None)
+            if consent is None:
+                return
+            self._consents[hashed_id] = (consent, time.monotonic())
+            if len(self._consents) > self.max_size:
+                self._consents.popitem(last=False)
+
+    def get(self, hashed_id: str, max_months_valid: int) -> Consent:
+        """
+        :param hashed_id: hashed consent id
+        :param max_months_valid: max number of months a consent should be valid
+        :return: the cached consent, or None if there is none which is fresh enough and not expired
+        """
+        entry = self._consents.get(hashed_id)
+        if entry is None:
+            return None
+        consent, read_at = entry
+        if time.monotonic() - read_at > self.max_staleness or consent.has_expired(max_months_valid):
+            return None
+        return consent
+
+    def invalidate(self, hashed_id: str):
+        """
+        Drops a consent changed by another process, or all consents.
+        :param hashed_id: hashed consent id, or None to drop all consents
+        """
+        with self._lock:
+            if hashed_id is None:
+                self._consents.clear()
+            else:
+                self._consents.pop(hashed_id, None)
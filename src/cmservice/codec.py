@@ -0,0 +1,143 @@
+import base64
+import json
+import zlib
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class MissingExtraError(ValueError):
+    """
+    Raised when a value is encoded, or must be decoded, with a library of an extra which isn't installed.
+    """
+
+    def __init__(self, name: str, extra: str):
+        super().__init__('{} needs the {} extra: pip install CMservice[{}]'.format(name, extra, extra))
+        self.extra = extra
+
+
+class Codec(object):
+    """
+    Serializes values stored in the database, optionally compressing them.
+
+    Values serialized to JSON and not compressed are stored as plain JSON text, exactly as before codecs existed.
+    Anything else is stored as `MARKER` followed by the base64 encoding of a header (format version, serializer
+    and compression) and the payload. Any stored value can be decoded, regardless of how the codec is configured,
+    so rows in different formats can coexist, as long as the extras they need are installed. Formats which can
+    only be read with an extra (msgpack, zstd) are therefore only written if explicitly allowed.
+    """
+    MARKER = '~'
+    VERSION = 1
+    SERIALIZERS = {'json': 1, 'orjson': 2, 'msgpack': 3}
+    COMPRESSIONS = {None: 0, 'zlib': 1, 'zstd': 2}
+    # extras needed to read the serializers and compressions, values serialized by orjson are read as JSON
+    READ_EXTRAS = {'msgpack': 'msgpack', 'zstd': 'zstd'}
+
+    def __init__(self, serializer: str = 'json', compression: str = None, compression_threshold: int = 1024,
+                 allow_extra_formats: bool = False):
+        """
+        Constructor.
+        :param serializer: 'json', 'orjson' or 'msgpack'
+        :param compression: None, 'zlib' or 'zstd'
+        :param compression_threshold: only serialized values of at least this many bytes are compressed
+        :param allow_extra_formats: whether to allow formats which can only be read with an extra installed,
+                                    which must be the case on every node sharing the database
+        """
+        if serializer not in self.SERIALIZERS:
+            raise ValueError('Unknown serializer: {}'.format(serializer))
+        if compression not in self.COMPRESSIONS:
+            raise ValueError('Unknown compression: {}'.format(compression))
+        for name in [serializer, compression]:
+            if name in self.READ_EXTRAS and not allow_extra_formats:
+                raise ValueError('Values written with {} can only be read by nodes with the {} extra installed, '
+                                 'allow extra formats to use it'.format(name, self.READ_EXTRAS[name]))
+        if serializer == 'orjson' and orjson is None:
+            raise MissingExtraError('orjson', 'orjson')
+        self._check_installed(serializer)
+        self._check_installed(compression)
+
+        self.serializer = serializer
+        self.compression = compression
+        self.compression_threshold = compression_threshold
+
+    @classmethod
+    def _check_installed(cls, name: str):
+        if name in cls.READ_EXTRAS and {'msgpack': msgpack, 'zstd': zstandard}[name] is None:
+            raise MissingExtraError(name, cls.READ_EXTRAS[name])
+
+    @staticmethod
+    def _serialize(value, serializer: str) -> bytes:
+        if serializer == 'orjson':
+            return orjson.dumps(value)
+        if serializer == 'msgpack':
+            return msgpack.packb(value, use_bin_type=True)
+        return json.dumps(value).encode('utf-8')
+
+    @staticmethod
+    def _deserialize(payload: bytes, serializer: str):
+        if serializer == 'msgpack':
+            return msgpack.unpackb(payload, raw=False)
+        if orjson:
+            return orjson.loads(payload)
+        return json.loads(payload.decode('utf-8'))
+
+    @staticmethod
+    def _compress(payload: bytes, compression: str) -> bytes:
+        if compression == 'zstd':
+            return zstandard.ZstdCompressor().compress(payload)
+        return zlib.compress(payload)
+
+    @staticmethod
+    def _decompress(payload: bytes, compression: str) -> bytes:
+        if compression == 'zstd':
+            return zstandard.ZstdDecompressor().decompress(payload)
+        if compression == 'zlib':
+            return zlib.decompress(payload)
+        return payload
+
+    def encode(self, value) -> str:
+        """
+        :param value: a JSON serializable value
+        :return: the value encoded as text
+        """
+        payload = self._serialize(value, self.serializer)
+        compression = None
+        if self.compression and len(payload) >= self.compression_threshold:
+            compressed = self._compress(payload, self.compression)
+            if len(compressed) < len(payload):
+                payload, compression = compressed, self.compression
+
+        if self.serializer != 'msgpack' and compression is None:
+            return payload.decode('utf-8')
+        header = bytes([self.VERSION, self.SERIALIZERS[self.serializer], self.COMPRESSIONS[compression]])
+        return self.MARKER + base64.b64encode(header + payload).decode('ascii')
+
+    def decode(self, text: str):
+        """
+        :param text: a value encoded by `encode`, or plain JSON
+        :return: the decoded value
+        """
+        if not text.startswith(self.MARKER):
+            return orjson.loads(text) if orjson else json.loads(text)
+
+        raw = base64.b64decode(text[len(self.MARKER):])
+        version, serializer_id, compression_id = raw[:3]
+        if version != self.VERSION:
+            raise ValueError('Unsupported encoding version: {}'.format(version))
+        serializer = {v: k for k, v in self.SERIALIZERS.items()}[serializer_id]
+        compression = {v: k for k, v in self.COMPRESSIONS.items()}[compression_id]
+        self._check_installed(serializer)
+        self._check_installed(compression)
+        return self._deserialize(self._decompress(raw[3:], compression), serializer)
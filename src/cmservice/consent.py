@@ -7,6 +7,8 @@ LOGGER = logging.getLogger(__name__)
 
 
 class Consent(object):
+    __slots__ = ('timestamp', 'months_valid', '_attributes', '_attribute_bits', '_attribute_dictionary')
+
     def __init__(self, attributes: list, months_valid: int, timestamp: datetime = None):
         """
 
@@ -19,14 +21,69 @@ class Consent(object):
         if not timestamp:
             timestamp = datetime.now()
         self.timestamp = timestamp
-        self.attributes = attributes
         self.months_valid = months_valid
+        self._attributes = attributes
+        self._attribute_bits = None
+        self._attribute_dictionary = None
+
+    @classmethod
+    def from_attribute_bits(cls, attribute_bits: int, attribute_dictionary, months_valid: int,
+                            timestamp: datetime = None):
+        """
+        Creates a consent from attributes encoded as a bitset, which are only decoded when accessed.
+
+        :param attribute_bits: bitset of the indices of the attributes in the dictionary
+        :param attribute_dictionary: dictionary used to encode the attributes, see
+               `cmservice.database.AttributeDictionary`
+        :param months_valid: policy for how long the consent is valid in months
+        :param timestamp: datetime for when the consent was created
+        """
+        consent = cls(None, months_valid, timestamp)
+        consent._attribute_bits = attribute_bits
+        consent._attribute_dictionary = attribute_dictionary
+        return consent
+
+    @property
+    def attributes(self) -> list:
+        if self._attributes is None and self._attribute_bits is not None:
+            self._attributes = self._attribute_dictionary.decode(self._attribute_bits)
+        return self._attributes
+
+    @attributes.setter
+    def attributes(self, attributes: list):
+        self._attributes = attributes
+        self._attribute_bits = None
+        self._attribute_dictionary = None
+
+    def attribute_bits(self, attribute_dictionary) -> int:
+        """
+        :param attribute_dictionary: dictionary to encode the attributes with
+        :return: the attributes encoded as a bitset, or None if consent has been given for all attributes
+        """
+        if self._attribute_dictionary is not attribute_dictionary:
+            attributes = self.attributes
+            self._attribute_bits = attribute_dictionary.encode(attributes) if attributes is not None else None
+            self._attribute_dictionary = attribute_dictionary
+        return self._attribute_bits
 
     def __eq__(self, other) -> bool:
-        return (isinstance(other, type(self))
+        if not (isinstance(other, type(self))
                 and self.months_valid == other.months_valid
-                and self.attributes == other.attributes
-                and abs(self.timestamp - other.timestamp) < timedelta(seconds=1))
+                and abs(self.timestamp - other.timestamp) < timedelta(seconds=1)):
+            return False
+
+        if self._attribute_dictionary is not None and self._attribute_dictionary is other._attribute_dictionary:
+            return self._attribute_bits == other._attribute_bits
+        if self.attributes is None or other.attributes is None:
+            return self.attributes is other.attributes
+        return set(self.attributes) == set(other.attributes)
+
+    def expiration_time(self, max_months_valid: int) -> datetime:
+        """
+        :param max_months_valid: maximum number of months any consent should be valid
+        :return: the point in time from which this consent is considered expired
+        """
+        return self.timestamp + relativedelta.relativedelta(months=min(self.months_valid, max_months_valid) + 1)
 
     def has_expired(self, max_months_valid: int):
         """
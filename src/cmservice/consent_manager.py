@@ -1,14 +1,17 @@
-import hashlib
-import json
 import logging
-from time import gmtime, mktime
-
-import jwkest
-from jwkest import jws
+import secrets
+import time
+from contextlib import contextmanager
 
+from cmservice.circuit_breaker import CircuitBreaker, CircuitOpenError, StaleConsentCache
 from cmservice.consent import Consent
 from cmservice.consent_request import ConsentRequest
-from cmservice.database import ConsentDB, ConsentRequestDB
+from cmservice.database import ConsentDB, ConsentRequestDB, ConsentRequestIndex, ConsentRequestMemoryIndex, hash_id, \
+    is_storage_error
+from cmservice.latency import LatencyMonitor
+from cmservice.log import LazyJSON
+from cmservice.ticket import TicketGenerator, StatelessTicketCodec
+from cmservice.tracing import span, traced
 
 logger = logging.getLogger(__name__)
 
@@ -17,9 +20,18 @@ class InvalidConsentRequestError(ValueError):
     pass
 
 
+class StorageUnavailableError(Exception):
+    def __init__(self, message: str, retry_after: float = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
 class ConsentManager(object):
     def __init__(self, consent_db: ConsentDB, ticket_db: ConsentRequestDB, trusted_keys: list, ticket_ttl: int,
-                 max_months_valid: int):
+                 max_months_valid: int, ticket_generator: TicketGenerator = None,
+                 ticket_codec: StatelessTicketCodec = None, consent_db_breaker: CircuitBreaker = None,
+                 ticket_db_breaker: CircuitBreaker = None, stale_consents: StaleConsentCache = None,
+                 request_index: ConsentRequestIndex = None):
         """
         Constructor.
         :param consent_db: database in which the consent information is stored
@@ -27,66 +39,220 @@ class ConsentManager(object):
         :param trusted_keys: trusted public keys to verify JWT signature.
         :param ticket_ttl: how long the ticket should live in seconds.
         :param max_months_valid: how long the consent should be valid
+        :param ticket_generator: generator of new tickets, if not specified tickets without HMAC will be used
+        :param ticket_codec: if specified, consent requests are embedded in the tickets instead of being stored
+                             in the ticket database
+        :param consent_db_breaker: circuit breaker protecting the consent database
+        :param ticket_db_breaker: circuit breaker protecting the ticket database
+        :param stale_consents: cache of consents to answer from when the consent database is unavailable,
+                               if not specified fetching consents fails while it is. Consents changed by other
+                               processes are dropped from it if the consent database has an invalidation bus
+        :param request_index: index of the tickets issued for consent requests, so retried requests get the same
+                              ticket. If not specified an index in the memory of this process is used
         """
         self.consent_db = consent_db
         self.ticket_db = ticket_db
         self.trusted_keys = trusted_keys
         self.ticket_ttl = ticket_ttl
         self.max_months_valid = max_months_valid
+        self.ticket_generator = ticket_generator or TicketGenerator()
+        self.ticket_codec = ticket_codec
+        self.storage_latency = LatencyMonitor()
+        self.consent_db_breaker = consent_db_breaker or CircuitBreaker('consent_db', is_failure=is_storage_error)
+        self.ticket_db_breaker = ticket_db_breaker or CircuitBreaker('ticket_db', is_failure=is_storage_error)
+        self.stale_consents = stale_consents
+        if stale_consents and consent_db.invalidation_bus:
+            consent_db.invalidation_bus.subscribe(stale_consents.invalidate)
+        self.request_index = request_index or ConsentRequestMemoryIndex(secrets.token_hex(16), ticket_ttl)
+
+    def warm_up(self):
+        """
+        Does everything done on first use of the databases and trusted keys, so the first requests are not slower
+        than the rest.
+        """
+        import jwkest
+        from jwkest.jws import SIGNER_ALGS
+
+        self.consent_db.warm_up()
+        if self.ticket_db:
+            self.ticket_db.warm_up()
+        self.request_index.warm_up()
+        for key in self.trusted_keys:
+            # verifying a bogus signature loads everything needed to verify real ones
+            try:
+                SIGNER_ALGS['RS256'].verify(b'', bytes(key.key.size_in_bytes()), key.key)
+            except jwkest.BadSignature:
+                pass
+
+    @contextmanager
+    def _storage(self, breaker: CircuitBreaker, operation: str):
+        """
+        Calls a database through its circuit breaker, measuring the latency and recording it as a span.
+        :param breaker: circuit breaker of the database
+        :param operation: name of the operation
+        :raise StorageUnavailableError: if the circuit of the database is open
+        """
+        try:
+            with breaker.guard(), self.storage_latency.measure(), span(operation):
+                yield
+        except CircuitOpenError as e:
+            raise StorageUnavailableError(str(e), e.retry_after) from e
+
+    def _stale_key(self, id: str) -> str:
+        # keyed like the invalidations of the consent database
+        return hash_id(id, self.consent_db.salt)
 
+    def probe_storage(self) -> float:
+        """
+        Checks that the databases are available.
+        :return: the time in seconds it took to query them
+        """
+        start = time.monotonic()
+        self.consent_db.ping()
+        if self.ticket_db:
+            self.ticket_db.ping()
+        return time.monotonic() - start
+
+    @traced()
+    def fetch_consent(self, id: str) -> Consent:
+        """
+        Fetches the consent for the given id.
+        :param id: Identifier for a given consent
+        :return: the consent, or None if there is no valid consent for the id.
+        """
+        try:
+            with self._storage(self.consent_db_breaker, 'ConsentDB.get_consent'):
+                consent = self.consent_db.get_consent(id)
+        except Exception as e:
+            if not isinstance(e, StorageUnavailableError) and not is_storage_error(e):
+                raise
+            consent = self.stale_consents.get(self._stale_key(id), self.max_months_valid) \
+                if self.stale_consents else None
+            if consent is None:
+                if isinstance(e, StorageUnavailableError):
+                    raise
+                raise StorageUnavailableError('failed to fetch consent') from e
+            logger.debug('answering with stale consent for id \'%s\': %s', id, e)
+            return consent
+
+        if consent and not consent.has_expired(self.max_months_valid):
+            if self.stale_consents:
+                self.stale_consents.put(self._stale_key(id), consent)
+            return consent
+        if self.stale_consents:
+            self.stale_consents.put(self._stale_key(id), None)
+
+        logger.debug('No consent for id: \'%s\'', id)
+        return None
+
+    @traced()
     def fetch_consented_attributes(self, id: str) -> list:
         """
         Fetches all consented attributes for the given id.
         :param id: Identifier for a given consent
         :return all consented attributes.
         """
-        consent = self.consent_db.get_consent(id)
-        if consent and not consent.has_expired(self.max_months_valid):
+        consent = self.fetch_consent(id)
+        if consent:
             return consent.attributes
-
-        logger.debug('No consented attributes for id: \'%s\'', id)
         return None
 
+    @traced()
     def save_consent_request(self, jwt: str):
         """
         Saves a consent request, in the form of a JWT.
+        A request identical to one saved less than `ticket_ttl` seconds ago gets the ticket issued for that one.
+
         :param jwt: JWT represented as a string
+        :return: the ticket for the consent request
         """
+        digest = self.request_index.digest(jwt)
+        if self.ticket_codec:
+            ticket = self.request_index.get_ticket(digest)
+        else:
+            with self._storage(self.ticket_db_breaker, 'ConsentRequestIndex.get_ticket'):
+                ticket = self.request_index.get_ticket(digest)
+        if ticket:
+            logger.debug('duplicate consent request, returning the ticket already issued for it')
+            return ticket
+
+        # jwkest is slow to import and only needed here, so it's imported on first use
+        import jwkest
+        from jwkest import jws
+
         try:
-            request = jws.factory(jwt).verify_compact(jwt, self.trusted_keys)
+            with span('jwt.verify'):
+                request = jws.factory(jwt).verify_compact(jwt, self.trusted_keys)
         except jwkest.Invalid as e:
-            logger.debug('invalid signature: %s', str(e))
+            logger.debug('invalid signature: %s', e)
             raise InvalidConsentRequestError('Invalid signature') from e
 
         try:
             data = ConsentRequest(request)
         except ValueError:
-            logger.debug('invalid consent request: %s', json.dumps(request))
+            logger.debug('invalid consent request: %s', LazyJSON(request))
             raise InvalidConsentRequestError('Invalid consent request')
 
-        ticket = hashlib.sha256((jwt + str(mktime(gmtime()))).encode("UTF-8")).hexdigest()
-        self.ticket_db.save_consent_request(ticket, data)
-        return ticket
+        if self.ticket_codec:
+            with span('ticket.encode'):
+                ticket = self.ticket_codec.encode(data)
+            return self.request_index.add_ticket(digest, ticket)
+
+        ticket = self.ticket_generator.new_ticket()
+        with self._storage(self.ticket_db_breaker, 'ConsentRequestDB.save_consent_request'):
+            self.ticket_db.save_consent_request(ticket, data)
+        with self._storage(self.ticket_db_breaker, 'ConsentRequestIndex.add_ticket'):
+            recorded_ticket = self.request_index.add_ticket(digest, ticket)
+        if recorded_ticket != ticket:
+            # a duplicate of the request was saved concurrently, so only the ticket issued for it is kept
+            with self._storage(self.ticket_db_breaker, 'ConsentRequestDB.remove_consent_request'):
+                self.ticket_db.remove_consent_request(ticket)
+        return recorded_ticket
 
+    @traced()
     def fetch_consent_request(self, ticket: str) -> dict:
         """
         Fetches a consent request.
         :param ticket: ticket associated with the consent request
         :return: the consent request
         """
-        ticketdata = self.ticket_db.get_consent_request(ticket)
+        if self.ticket_codec:
+            with span('ticket.decode'):
+                ticketdata = self.ticket_codec.decode(ticket)
+            if ticketdata:
+                self.request_index.remove_ticket(ticket)
+                return ticketdata.data
+            logger.debug('invalid, expired or already used ticket: %s', ticket)
+            return None
+
+        if not self.ticket_generator.is_well_formed(ticket):
+            logger.debug('malformed ticket: %s', ticket)
+            return None
+
+        with self._storage(self.ticket_db_breaker, 'ConsentRequestDB.get_consent_request'):
+            ticketdata = self.ticket_db.get_consent_request(ticket)
         if ticketdata:
-            self.ticket_db.remove_consent_request(ticket)
+            with self._storage(self.ticket_db_breaker, 'ConsentRequestDB.remove_consent_request'):
+                self.ticket_db.remove_consent_request(ticket)
+            with self._storage(self.ticket_db_breaker, 'ConsentRequestIndex.remove_ticket'):
+                self.request_index.remove_ticket(ticket)
             logger.debug('found consent request: %s', ticketdata.data)
             return ticketdata.data
         else:
-            logger.debug('failed to retrieve ticket data from ticket: %s' % ticket)
+            logger.debug('failed to retrieve ticket data from ticket: %s', ticket)
             return None
 
+    @traced()
     def save_consent(self, id: str, consent: Consent):
         """
         Saves a user consent entry.
         :param id: id to associate with the consent
         :param consent: consent object to store
         """
-        self.consent_db.save_consent(id, consent)
+        with self._storage(self.consent_db_breaker, 'ConsentDB.save_consent'):
+            self.consent_db.save_consent(id, consent)
+        # not guarded by the breaker of the consent database, which the bus may not even use
+        with span('ConsentDB.publish_invalidation'):
+            self.consent_db.publish_invalidation(id)
+        if self.stale_consents:
+            self.stale_consents.put(self._stale_key(id), consent)
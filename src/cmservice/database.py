@@ -1,18 +1,290 @@
+import base64
 import hashlib
-import json
+import hmac
+import itertools
+import logging
+import math
+import os
+import secrets
+import threading
+import time
+import weakref
+from collections import OrderedDict
 from datetime import datetime
 
-import dataset
-
+from cmservice.bloom_filter import BloomFilter
+from cmservice.codec import Codec
 from cmservice.consent import Consent
 from cmservice.consent_request import ConsentRequest
 
+logger = logging.getLogger(__name__)
+
 
 def hash_id(id: str, salt: str):
     return hashlib.sha512(id.encode("utf-8") + salt.encode("utf-8")) \
         .hexdigest().encode("utf-8").decode("utf-8")
 
 
+def is_storage_error(e: BaseException) -> bool:
+    """
+    :param e: an exception raised by a database call
+    :return: True if it's an error of the database or the connection to it, False if it's e.g. a programming error
+    """
+    if isinstance(e, OSError):
+        return True
+    # an error raised by SQLAlchemy means it has already been imported
+    from sqlalchemy.exc import SQLAlchemyError
+    return isinstance(e, SQLAlchemyError)
+
+
+_connections = weakref.WeakSet()
+
+
+def _reset_connections_after_fork():
+    for connection in list(_connections):
+        connection.reset_after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_connections_after_fork)
+
+
+class LazyDatasetConnection(object):
+    """
+    Connection to a database using the `dataset` library, which is established on first use.
+
+    Importing `dataset` (and with it SQLAlchemy and alembic) makes up a large part of the startup time,
+    so it's not imported until the connection is needed.
+
+    Connections opened before a fork (for example when the app is preloaded by gunicorn) are not used by the
+    child process, which opens its own. Reflected tables are kept.
+    """
+
+    def __init__(self, db_url: str = None, timeout: float = None):
+        """
+        Constructor.
+        :param db_url: URL to the database. If not specified an in-memory SQLite database will be used.
+        :param timeout: seconds to wait for a connection or a statement before failing,
+                        if not specified the defaults of the database driver are used
+        """
+        self.db_url = db_url or 'sqlite:///:memory:'
+        self.timeout = timeout
+        self._db = None
+        self._tables = {}
+        self._lock = threading.Lock()
+        _connections.add(self)
+
+    @property
+    def db(self):
+        if self._db is None:
+            with self._lock:
+                if self._db is None:
+                    import dataset
+                    self._db = dataset.connect(self.db_url, engine_kwargs=self._engine_kwargs())
+        return self._db
+
+    def table(self, name: str):
+        """
+        :param name: name of the table
+        :return: the table, it's only reflected from the database once
+        """
+        table = self._tables.get(name)
+        if table is None:
+            table = self._tables[name] = self.db[name]
+        return table
+
+    def _engine_kwargs(self) -> dict:
+        if not self.timeout:
+            return {}
+        from sqlalchemy.engine.url import make_url
+
+        backend = make_url(self.db_url).get_backend_name()
+        seconds = int(math.ceil(self.timeout))
+        if backend == 'sqlite':
+            # SQLite has no network to wait for, only locks held by other connections
+            return {'connect_args': {'timeout': self.timeout}}
+        if backend == 'postgresql':
+            connect_args = {'connect_timeout': seconds,
+                            'options': '-c statement_timeout={}'.format(int(self.timeout * 1000))}
+        elif backend == 'mysql':
+            connect_args = {'connect_timeout': seconds, 'read_timeout': seconds, 'write_timeout': seconds}
+        else:
+            connect_args = {}
+        return {'connect_args': connect_args, 'pool_timeout': self.timeout}
+
+    @property
+    def in_memory(self) -> bool:
+        return self.db_url.rstrip('/') in ('sqlite:', 'sqlite:///:memory:')
+
+    def reset_after_fork(self):
+        """
+        Drops the connections inherited from the parent process, after a fork.
+        """
+        self._lock = threading.Lock()
+        # an in-memory database only exists in the inherited connection
+        if self._db is None or self.in_memory:
+            return
+        self._db.lock = threading.RLock()
+        self._db.connections = {}
+        self._db.engine.dispose(close=False)
+
+    def ping(self):
+        """
+        Checks that the database can be queried, raises an exception if it can't.
+        """
+        self.db.query('SELECT 1')
+
+
+class ReplicaSet(object):
+    """
+    Read replicas of a database, which are used round robin.
+
+    A replica which fails is taken out of rotation, until it passes a health check again.
+    """
+
+    def __init__(self, replica_urls: list, retry_interval: float = 30, timeout: float = None):
+        """
+        Constructor.
+        :param replica_urls: URL:s to the replicas
+        :param retry_interval: seconds to wait before a failed replica is health checked again
+        :param timeout: seconds to wait for a replica before failing
+        """
+        self.replicas = [LazyDatasetConnection(url, timeout) for url in replica_urls]
+        self.retry_interval = retry_interval
+        self._down_until = [None] * len(self.replicas)
+        self._counter = itertools.count()
+
+    def choose(self) -> LazyDatasetConnection:
+        """
+        :return: the next healthy replica, or None if there is none
+        """
+        for _ in range(len(self.replicas)):
+            index = next(self._counter) % len(self.replicas)
+            down_until = self._down_until[index]
+            if down_until is None:
+                return self.replicas[index]
+            if down_until <= time.monotonic() and self.check(index):
+                return self.replicas[index]
+        return None
+
+    def check(self, index: int) -> bool:
+        """
+        Health checks a replica, and puts it back in rotation if it's healthy.
+        :param index: index of the replica
+        :return: True if the replica is healthy, else False
+        """
+        try:
+            self.replicas[index].ping()
+        except Exception:
+            logger.warning('health check of replica %s failed', index, exc_info=True)
+            self._down_until[index] = time.monotonic() + self.retry_interval
+            return False
+        self._down_until[index] = None
+        return True
+
+    def mark_down(self, replica: LazyDatasetConnection):
+        """
+        Takes a replica out of rotation.
+        :param replica: the failed replica
+        """
+        index = self.replicas.index(replica)
+        logger.warning('taking replica %s out of rotation for %ss', index, self.retry_interval)
+        self._down_until[index] = time.monotonic() + self.retry_interval
+
+    @property
+    def healthy(self) -> int:
+        """
+        :return: the number of replicas in rotation
+        """
+        return sum(1 for down_until in self._down_until if down_until is None)
+
+
+class AttributeDictionary(object):
+    """
+    Interns attribute names in a table, so a set of attributes can be stored as a bitset of their indices.
+    """
+    TABLE_NAME = 'attribute_name'
+
+    def __init__(self, connection: LazyDatasetConnection):
+        """
+        Constructor.
+        :param connection: connection to the database holding the dictionary
+        """
+        self._connection = connection
+        self._table = None
+        self._indices = {}
+        self._names = {}
+        self._lock = threading.Lock()
+
+    @property
+    def table(self):
+        if self._table is None:
+            db = self._connection.db
+            table = db.create_table(self.TABLE_NAME, primary_id='id', primary_type=db.types.integer)
+            table.create_column('name', db.types.string(255))
+            table.create_index(['name'], name='ix_{}_name'.format(self.TABLE_NAME), unique=True)
+            self._table = table
+        return self._table
+
+    def load(self):
+        """
+        Loads all interned names from the table.
+        """
+        with self._lock:
+            self._load()
+
+    def _load(self):
+        for row in self.table.find(order_by='id'):
+            self._names[row['id']] = row['name']
+            self._indices.setdefault(row['name'], row['id'])
+
+    def _intern(self, name: str) -> int:
+        with self._lock:
+            if name not in self._indices:
+                # the name might have been interned by another process
+                self._load()
+            if name not in self._indices:
+                from sqlalchemy.exc import IntegrityError
+                try:
+                    self.table.insert_ignore({'name': name}, ['name'])
+                except IntegrityError:
+                    # interned by another process after the table was read
+                    logger.debug('attribute name %s was interned concurrently', name)
+                self._load()
+            return self._indices[name]
+
+    def _name(self, index: int) -> str:
+        if index not in self._names:
+            with self._lock:
+                self._load()
+        return self._names[index]
+
+    def encode(self, names: list) -> int:
+        """
+        :param names: attribute names, unknown names are added to the dictionary
+        :return: bitset of the indices of the names
+        """
+        bits = 0
+        for name in names:
+            index = self._indices.get(name)
+            if index is None:
+                index = self._intern(name)
+            bits |= 1 << index
+        return bits
+
+    def decode(self, bits: int) -> list:
+        """
+        :param bits: bitset created by `encode`
+        :return: the attribute names, ordered by index
+        """
+        names = []
+        while bits:
+            lowest_bit = bits & -bits
+            names.append(self._name(lowest_bit.bit_length() - 1))
+            bits ^= lowest_bit
+        return names
+
+
 class ConsentRequestDB(object):
     def __init__(self, salt: str):
         """
@@ -47,6 +319,18 @@ class ConsentRequestDB(object):
         """
         raise NotImplementedError("Must be implemented!")
 
+    def warm_up(self):
+        """
+        Prepares the database for the first request, for example by connecting and reflecting tables.
+        """
+        pass
+
+    def ping(self):
+        """
+        Checks that the database is available, raises an exception if it's not.
+        """
+        pass
+
 
 class ConsentRequestDatasetDB(ConsentRequestDB):
     """
@@ -54,23 +338,30 @@ class ConsentRequestDatasetDB(ConsentRequestDB):
     """
     TIME_PATTERN = "%Y %m %d %H:%M:%S"
 
-    def __init__(self, salt: str, consent_request_path: str = None):
+    def __init__(self, salt: str, consent_request_path: str = None, codec: Codec = None, timeout: float = None):
         """
         Constructor.
         :param consent_request_path:  path to the SQLite db.
                                 If not specified an in-memory database will be used.
+        :param codec: codec used to store the consent request data, if not specified plain JSON will be used
+        :param timeout: seconds to wait for the database before failing
         """
         super().__init__(salt)
-        if consent_request_path:
-            self.consent_request_db = dataset.connect(consent_request_path)
-        else:
-            self.consent_request_db = dataset.connect('sqlite:///:memory:')
-        self.consent_request_table = self.consent_request_db['consent_request']
+        self._connection = LazyDatasetConnection(consent_request_path, timeout)
+        self.codec = codec or Codec()
+
+    @property
+    def consent_request_db(self):
+        return self._connection.db
+
+    @property
+    def consent_request_table(self):
+        return self._connection.table('consent_request')
 
     def save_consent_request(self, ticket: str, consent_request: ConsentRequest):
         row = {
             'ticket': hash_id(ticket, self.salt),
-            'data': json.dumps(consent_request.data),
+            'data': self.codec.encode(consent_request.data),
             'timestamp': consent_request.timestamp.strftime(ConsentRequestDatasetDB.TIME_PATTERN)
         }
         self.consent_request_table.insert(row)
@@ -78,7 +369,7 @@ class ConsentRequestDatasetDB(ConsentRequestDB):
     def get_consent_request(self, ticket: str) -> ConsentRequest:
         result = self.consent_request_table.find_one(ticket=hash_id(ticket, self.salt))
         if result:
-            return ConsentRequest(json.loads(result['data']),
+            return ConsentRequest(self.codec.decode(result['data']),
                                   timestamp=datetime.strptime(result['timestamp'],
                                                               ConsentRequestDatasetDB.TIME_PATTERN))
         return None
@@ -86,8 +377,229 @@ class ConsentRequestDatasetDB(ConsentRequestDB):
     def remove_consent_request(self, ticket: str):
         self.consent_request_table.delete(ticket=hash_id(ticket, self.salt))
 
+    def warm_up(self):
+        # creates the table up front, instead of on the first insert where concurrent workers would race to do it
+        for column, example in [('ticket', ''), ('data', ''), ('timestamp', '')]:
+            self.consent_request_table.create_column_by_example(column, example)
+
+    def ping(self):
+        self._connection.ping()
+
+
+class ConsentRequestIndex(object):
+    """
+    Index of the tickets issued for consent requests, so a retried request gets the ticket already issued for it.
+
+    Requests are identified by a salted digest of the complete JWT, including its signature, so only an identical
+    (and thereby already verified) JWT matches. Entries expire after `ttl` seconds, or when their ticket is used.
+    """
+    DIGEST_BYTES = 32
+
+    def __init__(self, salt: str, ttl: int):
+        """
+        Constructor.
+        :param salt: salt to use when hashing JWT:s
+        :param ttl: seconds an issued ticket is returned for duplicates of its request
+        """
+        self.salt = salt
+        self.ttl = ttl
+
+    def digest(self, jwt: str) -> bytes:
+        """
+        :param jwt: a consent request JWT
+        :return: the digest identifying the JWT in the index. The first `DIGEST_BYTES` identify the request and the
+                 rest is a key only known to those who have the JWT.
+        """
+        return hmac.new(self.salt.encode('utf-8'), jwt.encode('utf-8'), hashlib.sha512).digest()
+
+    def get_ticket(self, digest: bytes) -> str:
+        """
+        :param digest: digest of a consent request JWT
+        :return: the ticket issued for the JWT, or None if there is none which has not expired
+        """
+        raise NotImplementedError("Must be implemented!")
+
+    def add_ticket(self, digest: bytes, ticket: str) -> str:
+        """
+        Records the ticket issued for a JWT, unless one has already been recorded concurrently.
+
+        :param digest: digest of a consent request JWT
+        :param ticket: the ticket issued for it
+        :return: the ticket recorded for the JWT, which is another ticket if one was already recorded
+        """
+        raise NotImplementedError("Must be implemented!")
+
+    def remove_ticket(self, ticket: str):
+        """
+        Removes a used ticket, so a new request identical to the one it was issued for gets a new ticket.
+        :param ticket: the used ticket
+        """
+        raise NotImplementedError("Must be implemented!")
+
+    def warm_up(self):
+        """
+        Prepares the index for the first request.
+        """
+        pass
+
+
+class ConsentRequestMemoryIndex(ConsentRequestIndex):
+    """
+    Implementation keeping the index in the memory of the current process.
+    """
+
+    def __init__(self, salt: str, ttl: int, max_size: int = 100000):
+        """
+        Constructor.
+        :param max_size: maximum number of tickets to keep, the oldest are dropped first
+        """
+        super().__init__(salt, ttl)
+        self.max_size = max_size
+        self._tickets = OrderedDict()
+        self._digests = {}
+        self._lock = threading.Lock()
+
+    def get_ticket(self, digest: bytes) -> str:
+        entry = self._tickets.get(digest[:self.DIGEST_BYTES])
+        if entry is None or entry[1] <= time.monotonic():
+            return None
+        return entry[0]
+
+    def add_ticket(self, digest: bytes, ticket: str) -> str:
+        request_digest = digest[:self.DIGEST_BYTES]
+        now = time.monotonic()
+        with self._lock:
+            entry = self._tickets.get(request_digest)
+            if entry and entry[1] > now:
+                return entry[0]
+            self._remove(request_digest)
+            self._tickets[request_digest] = (ticket, now + self.ttl)
+            self._digests[ticket] = request_digest
+            # entries are kept in order of expiration
+            while self._tickets and (len(self._tickets) > self.max_size or
+                                     next(iter(self._tickets.values()))[1] <= now):
+                self._remove(next(iter(self._tickets)))
+        return ticket
+
+    def _remove(self, request_digest: bytes):
+        entry = self._tickets.pop(request_digest, None)
+        if entry:
+            self._digests.pop(entry[0], None)
+
+    def remove_ticket(self, ticket: str):
+        with self._lock:
+            request_digest = self._digests.get(ticket)
+            if request_digest:
+                self._remove(request_digest)
+
+
+class ConsentRequestDatasetIndex(ConsentRequestIndex):
+    """
+    Implementation using the `dataset` library, shared by all workers using the same database.
+
+    Tickets are stored encrypted with a key derived from the JWT they were issued for, so they can't be used by
+    someone who can only read the database. Used tickets are found by their salted hash.
+    """
+    TABLE_NAME = 'consent_request_index'
+    NONCE_BYTES = 12
+
+    def __init__(self, salt: str, ttl: int, index_db_path: str = None, timeout: float = None,
+                 cleanup_interval: int = 100):
+        """
+        Constructor.
+        :param index_db_path: path to the SQLite db.
+                              If not specified an in-memory database will be used.
+        :param timeout: seconds to wait for the database before failing
+        :param cleanup_interval: number of added tickets between removals of expired ones
+        """
+        super().__init__(salt, ttl)
+        self._connection = LazyDatasetConnection(index_db_path, timeout)
+        self._table = None
+        self.cleanup_interval = cleanup_interval
+        self._added = itertools.count(1)
+
+    @property
+    def index_table(self):
+        if self._table is None:
+            db = self._connection.db
+            table = db.create_table(self.TABLE_NAME, primary_id='request_digest',
+                                    primary_type=db.types.string(64))
+            table.create_column('ticket_hash', db.types.string(128))
+            table.create_column('encrypted_ticket', db.types.string(255))
+            table.create_column('created', db.types.float)
+            table.create_index(['ticket_hash'], name='ix_{}_ticket_hash'.format(self.TABLE_NAME))
+            self._table = table
+        return self._table
+
+    def warm_up(self):
+        # creates the table
+        self.index_table
+
+    def _encrypt(self, digest: bytes, ticket: str) -> str:
+        from Cryptodome.Cipher import AES
+
+        nonce = secrets.token_bytes(self.NONCE_BYTES)
+        cipher = AES.new(digest[self.DIGEST_BYTES:], AES.MODE_GCM, nonce=nonce)
+        ciphertext, tag = cipher.encrypt_and_digest(ticket.encode('utf-8'))
+        return base64.urlsafe_b64encode(nonce + ciphertext + tag).decode('utf-8')
+
+    def _decrypt(self, digest: bytes, encrypted_ticket: str) -> str:
+        from Cryptodome.Cipher import AES
+
+        raw = base64.urlsafe_b64decode(encrypted_ticket)
+        cipher = AES.new(digest[self.DIGEST_BYTES:], AES.MODE_GCM, nonce=raw[:self.NONCE_BYTES])
+        return cipher.decrypt_and_verify(raw[self.NONCE_BYTES:-16], raw[-16:]).decode('utf-8')
+
+    def _row(self, digest: bytes, ticket: str, now: float) -> dict:
+        return {'request_digest': digest[:self.DIGEST_BYTES].hex(), 'ticket_hash': hash_id(ticket, self.salt),
+                'encrypted_ticket': self._encrypt(digest, ticket), 'created': now}
+
+    def get_ticket(self, digest: bytes) -> str:
+        return self._find_ticket(digest)
+
+    def _find_ticket(self, digest: bytes) -> str:
+        row = self.index_table.find_one(request_digest=digest[:self.DIGEST_BYTES].hex())
+        if row is None or row['created'] + self.ttl <= time.time():
+            return None
+        return self._decrypt(digest, row['encrypted_ticket'])
+
+    def add_ticket(self, digest: bytes, ticket: str) -> str:
+        from sqlalchemy.exc import IntegrityError
+
+        now = time.time()
+        if next(self._added) % self.cleanup_interval == 0:
+            self.index_table.delete(created={'<=': now - self.ttl})
+        row = self._row(digest, ticket, now)
+        table = self.index_table.table
+        for _ in range(2):
+            try:
+                # the primary key makes sure only one worker records a ticket for the request
+                self.index_table.insert(row)
+                return ticket
+            except IntegrityError:
+                pass
+
+            # an expired entry for the same request is replaced, unless another worker replaced it first
+            statement = table.update() \
+                .where(table.c.request_digest == row['request_digest']) \
+                .where(table.c.created <= now - self.ttl) \
+                .values(ticket_hash=row['ticket_hash'], encrypted_ticket=row['encrypted_ticket'], created=now)
+            if self._connection.db.executable.execute(statement).rowcount == 1:
+                return ticket
+            recorded = self._find_ticket(digest)
+            if recorded is not None:
+                return recorded
+            # the recorded ticket was used in the meantime
+        raise RuntimeError('failed to record the ticket for the consent request')
+
+    def remove_ticket(self, ticket: str):
+        self.index_table.delete(ticket_hash=hash_id(ticket, self.salt))
+
 
 class ConsentDB(object):
+    # whether all consents are kept in the memory of one process, so they aren't shared by several workers
+    SINGLE_PROCESS = False
+
     def __init__(self, salt: str, max_months_valid: int):
         """
         Constructor.
@@ -96,6 +608,7 @@ class ConsentDB(object):
         """
         self.salt = salt
         self.max_month = max_months_valid
+        self.invalidation_bus = None
 
     def save_consent(self, id: str, consent: Consent):
         """
@@ -123,6 +636,34 @@ class ConsentDB(object):
         """
         raise NotImplementedError("Must be implemented!")
 
+    def publish_invalidation(self, id: str):
+        """
+        Tells the other processes that a consent has changed, if the database has an invalidation bus.
+
+        It's best effort and separate from saving the consent, so an unavailable bus doesn't fail the change:
+        failures are logged, and the other processes may keep using what they know about the consent.
+
+        :param id: id of the changed consent
+        """
+        if self.invalidation_bus is None:
+            return
+        try:
+            self.invalidation_bus.publish(hash_id(id, self.salt))
+        except Exception:
+            logger.warning('failed to publish the invalidation of a consent', exc_info=True)
+
+    def warm_up(self):
+        """
+        Prepares the database for the first request, for example by connecting and reflecting tables.
+        """
+        pass
+
+    def ping(self):
+        """
+        Checks that the database is available, raises an exception if it's not.
+        """
+        pass
+
 
 class ConsentDatasetDB(ConsentDB):
     """
@@ -130,37 +671,141 @@ class ConsentDatasetDB(ConsentDB):
     """
     CONSENT_TABLE_NAME = 'consent'
     TIME_PATTERN = "%Y %m %d %H:%M:%S"
+    # marks attributes stored as a hex encoded bitset, instead of a JSON list
+    ATTRIBUTE_BITS_PREFIX = '#'
 
-    def __init__(self, salt: str, max_months_valid: int, consent_db_path: str = None):
+    def __init__(self, salt: str, max_months_valid: int, consent_db_path: str = None,
+                 bloom_filter_error_rate: float = None, bloom_filter_capacity: int = 100000, codec: Codec = None,
+                 replica_urls: list = None, read_your_writes_window: float = 5, timeout: float = None,
+                 invalidation_bus=None):
         """
         Constructor.
-        :param consent_db_path: path to the SQLite db.
+        :param consent_db_path: path to the SQLite db, used for all writes.
                                 If not specified an in-memory database will be used.
+        :param bloom_filter_error_rate: false positive rate of the Bloom filter of stored consent id's, used to
+                                        answer lookups of unknown id's without querying the database.
+                                        If not specified no filter will be used.
+        :param bloom_filter_capacity: number of consents the Bloom filter is initially sized for
+        :param codec: codec used to store attributes that are not dictionary encoded,
+                      if not specified plain JSON will be used
+        :param replica_urls: URL:s to read replicas of the database, consents are read from them when healthy
+        :param read_your_writes_window: seconds after a consent is written during which it's only read from
+                                        the primary database, to hide replication lag
+        :param timeout: seconds to wait for the database, or a replica, before failing
+        :param invalidation_bus: bus to broadcast changed consents on, and to learn about consents changed by
+                                 other processes from, so the Bloom filter and read-your-writes window cover them
         """
         super().__init__(salt, max_months_valid)
-        if consent_db_path:
-            self.consent_db = dataset.connect(consent_db_path)
-        else:
-            self.consent_db = dataset.connect('sqlite:///:memory:')
-        self.consent_table = self.consent_db[self.CONSENT_TABLE_NAME]
+        self._connection = LazyDatasetConnection(consent_db_path, timeout)
+        self.codec = codec or Codec()
+        self.replica_set = ReplicaSet(replica_urls or [], timeout=timeout)
+        self.read_your_writes_window = read_your_writes_window
+        self._recent_writes = OrderedDict()
+        self._recent_writes_lock = threading.Lock()
+        self.attribute_dictionary = AttributeDictionary(self._connection)
+
+        self.known_ids = None
+        # held while adding to, or replacing, the filter
+        self._known_ids_lock = threading.Lock()
+        # held while rebuilding the filter, so rebuilds don't overlap
+        self._rebuild_lock = threading.Lock()
+        self._writes_during_rebuild = None
+        self.bloom_filter_error_rate = bloom_filter_error_rate
+        self.bloom_filter_capacity = bloom_filter_capacity
+        self.negative_cache_hits = 0
+        self.negative_cache_false_positives = 0
+        if bloom_filter_error_rate:
+            self._build_known_ids(bloom_filter_capacity)
+        self.invalidation_bus = invalidation_bus
+        if invalidation_bus:
+            invalidation_bus.subscribe(self._on_invalidation)
+
+    @property
+    def consent_db(self):
+        return self._connection.db
+
+    @property
+    def consent_table(self):
+        return self._connection.table(self.CONSENT_TABLE_NAME)
+
+    def _build_known_ids(self, capacity: int, replaces: BloomFilter = None):
+        with self._rebuild_lock:
+            if replaces is not None and self.known_ids is not replaces:
+                # already rebuilt by another thread
+                return
+            with self._known_ids_lock:
+                writes = self._writes_during_rebuild = []
+            try:
+                hashed_ids = [row['consent_id'] for row in self.consent_table.distinct('consent_id')]
+                known_ids = BloomFilter(max(capacity, 2 * len(hashed_ids)), self.bloom_filter_error_rate)
+                for hashed_id in hashed_ids:
+                    known_ids.add(hashed_id)
+                with self._known_ids_lock:
+                    # consents saved after the table was read may be missing from it
+                    for hashed_id in writes:
+                        known_ids.add(hashed_id)
+                    self.known_ids = known_ids
+            finally:
+                with self._known_ids_lock:
+                    self._writes_during_rebuild = None
+        if logger.isEnabledFor(logging.INFO):
+            logger.info('built consent id Bloom filter: %s', self.negative_cache_stats())
+
+    def negative_cache_stats(self) -> dict:
+        """
+        :return: statistics about the Bloom filter of stored consent id's, or None if it's not in use
+        """
+        if self.known_ids is None:
+            return None
+        lookups = self.negative_cache_hits + self.negative_cache_false_positives
+        return {
+            'capacity': self.known_ids.capacity,
+            'size': len(self.known_ids),
+            'configured_false_positive_rate': self.bloom_filter_error_rate,
+            'estimated_false_positive_rate': self.known_ids.false_positive_rate,
+            'hits': self.negative_cache_hits,
+            'false_positives': self.negative_cache_false_positives,
+            'observed_false_positive_rate': self.negative_cache_false_positives / lookups if lookups else 0.0,
+        }
 
     def save_consent(self, id: str, consent: Consent):
+        hashed_id = hash_id(id, self.salt)
         data = {
-            'consent_id': hash_id(id, self.salt),
+            'consent_id': hashed_id,
             'timestamp': consent.timestamp.strftime(ConsentDatasetDB.TIME_PATTERN),
             'months_valid': consent.months_valid,
-            'attributes': json.dumps(consent.attributes),
+            'attributes': self._encode_attributes(consent),
         }
         self.consent_table.insert(data)
+        self._record_write(hashed_id)
+        self._add_known_id(hashed_id)
+
+    def _add_known_id(self, hashed_id: str):
+        with self._known_ids_lock:
+            if self._writes_during_rebuild is not None:
+                self._writes_during_rebuild.append(hashed_id)
+            known_ids = self.known_ids
+            if known_ids is None:
+                return
+            known_ids.add(hashed_id)
+            full = len(known_ids) > known_ids.capacity
+        if full:
+            self._build_known_ids(2 * known_ids.capacity, replaces=known_ids)
 
     def get_consent(self, id: str) -> Consent:
         hashed_id = hash_id(id, self.salt)
-        result = self.consent_table.find_one(consent_id=hashed_id)
+        known_ids = self.known_ids
+        if known_ids is not None and hashed_id not in known_ids:
+            self.negative_cache_hits += 1
+            return None
+
+        result = self._find_consent(hashed_id)
         if not result:
+            if known_ids is not None:
+                self.negative_cache_false_positives += 1
             return None
 
-        consent = Consent(json.loads(result['attributes']), result['months_valid'],
-                          datetime.strptime(result['timestamp'], ConsentDatasetDB.TIME_PATTERN))
+        consent = self._decode_consent(result)
         if consent.has_expired(self.max_month):
             self.remove_consent(id)
             return None
@@ -169,3 +814,70 @@ class ConsentDatasetDB(ConsentDB):
     def remove_consent(self, id: str):
         hashed_id = hash_id(id, self.salt)
         self.consent_table.delete(consent_id=hashed_id)
+        self._record_write(hashed_id)
+
+    def _on_invalidation(self, hashed_id: str):
+        if hashed_id is None:
+            if self.bloom_filter_error_rate:
+                # consents saved by other processes may be missing from the filter
+                try:
+                    self._build_known_ids(self.known_ids.capacity if self.known_ids else self.bloom_filter_capacity)
+                except Exception:
+                    logger.warning('failed to rebuild the consent id Bloom filter, disabling it', exc_info=True)
+                    self.known_ids = None
+            return
+        self._record_write(hashed_id)
+        self._add_known_id(hashed_id)
+
+    def warm_up(self):
+        # creates the table up front, instead of on the first insert where concurrent workers would race to do it
+        for column, example in [('consent_id', ''), ('timestamp', ''), ('months_valid', 0), ('attributes', '')]:
+            self.consent_table.create_column_by_example(column, example)
+        self.attribute_dictionary.load()
+        for index in range(len(self.replica_set.replicas)):
+            if self.replica_set.check(index):
+                self.replica_set.replicas[index].table(self.CONSENT_TABLE_NAME).columns
+
+    def ping(self):
+        self._connection.ping()
+
+    def _record_write(self, hashed_id: str):
+        if not self.replica_set.replicas:
+            return
+        now = time.monotonic()
+        with self._recent_writes_lock:
+            while self._recent_writes:
+                oldest, deadline = next(iter(self._recent_writes.items()))
+                if deadline > now:
+                    break
+                del self._recent_writes[oldest]
+            self._recent_writes.pop(hashed_id, None)
+            self._recent_writes[hashed_id] = now + self.read_your_writes_window
+
+    def _find_consent(self, hashed_id: str) -> dict:
+        if self._recent_writes.get(hashed_id, 0) > time.monotonic():
+            return self.consent_table.find_one(consent_id=hashed_id)
+
+        replica = self.replica_set.choose()
+        if replica is not None:
+            try:
+                return replica.table(self.CONSENT_TABLE_NAME).find_one(consent_id=hashed_id)
+            except Exception:
+                logger.warning('failed to read consent from replica', exc_info=True)
+                self.replica_set.mark_down(replica)
+        return self.consent_table.find_one(consent_id=hashed_id)
+
+    def _encode_attributes(self, consent: Consent) -> str:
+        attribute_bits = consent.attribute_bits(self.attribute_dictionary)
+        if attribute_bits is None:
+            return self.codec.encode(None)
+        return '{}{:x}'.format(self.ATTRIBUTE_BITS_PREFIX, attribute_bits)
+
+    def _decode_consent(self, row: dict) -> Consent:
+        timestamp = datetime.strptime(row['timestamp'], ConsentDatasetDB.TIME_PATTERN)
+        attributes = row['attributes']
+        if attributes.startswith(self.ATTRIBUTE_BITS_PREFIX):
+            return Consent.from_attribute_bits(int(attributes[len(self.ATTRIBUTE_BITS_PREFIX):], 16),
+                                               self.attribute_dictionary, row['months_valid'], timestamp)
+        # stored before attributes were dictionary encoded
+        return Consent(self.codec.decode(attributes), row['months_valid'], timestamp)
@@ -0,0 +1,326 @@
+import logging
+import os
+import secrets
+import socket
+import threading
+import time
+import weakref
+
+from cmservice.database import LazyDatasetConnection
+
+logger = logging.getLogger(__name__)
+
+_buses = weakref.WeakSet()
+
+
+def _start_buses_after_fork():
+    for bus in list(_buses):
+        bus.after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_start_buses_after_fork)
+
+
+class InvalidationBus(object):
+    """
+    Broadcasts invalidations of consents to the other processes using the same consent database, so they can
+    update, or drop, what they cache about them.
+
+    Invalidations are identified by hashed consent id. Listeners are called with the hashed id of each
+    invalidation published by another process, or with None when invalidations may have been missed and
+    everything cached must be considered stale.
+
+    This implementation has no other processes to broadcast to, it's used when there is a single worker.
+    """
+
+    def __init__(self):
+        self.listeners = []
+        self._start_in_children = False
+        _buses.add(self)
+
+    def subscribe(self, listener):
+        """
+        :param listener: callable called with the hashed id of each invalidation, or None
+        """
+        self.listeners.append(listener)
+
+    def publish(self, hashed_id: str):
+        """
+        Broadcasts an invalidation to the other processes.
+        :param hashed_id: hashed id of the changed consent
+        """
+        pass
+
+    def start(self):
+        """
+        Starts receiving invalidations in this process.
+        """
+        pass
+
+    def start_after_fork(self):
+        """
+        Starts receiving invalidations in each process forked from this one, instead of in this one.
+
+        Used when the app is preloaded in the master process of a server. Its threads must not be running when
+        the workers are forked, since a lock of a cache held by one of them would never be released in the worker.
+        """
+        self._start_in_children = True
+
+    def close(self):
+        """
+        Stops receiving invalidations.
+        """
+        pass
+
+    def after_fork(self):
+        """
+        Called in a forked process. Threads and sockets of the parent are not inherited, so the bus is only started
+        if it was meant to be started in the children.
+        """
+        if self._start_in_children:
+            self.start()
+            self._deliver_missed()
+
+    def _deliver_missed(self):
+        # caches inherited from the parent may be missing everything published before the bus was started
+        self._deliver(None)
+
+    def _deliver(self, hashed_id: str):
+        for listener in self.listeners:
+            try:
+                listener(hashed_id)
+            except Exception:
+                logger.warning('invalidation listener failed', exc_info=True)
+
+
+class UnixSocketInvalidationBus(InvalidationBus):
+    """
+    Broadcasts invalidations to the processes on this host, e.g. the workers of one gunicorn master.
+
+    Each process binds a datagram socket in a shared directory and sends every invalidation to the sockets
+    of the others, which receive them immediately. Sockets left behind by processes that have exited are
+    removed. An invalidation is dropped, and a warning logged, if the receiving process has fallen behind
+    so far that its socket buffer is full.
+    """
+    SOCKET_SUFFIX = '.sock'
+
+    def __init__(self, socket_dir: str):
+        """
+        Constructor.
+        :param socket_dir: directory for the sockets, shared by all processes and not writable by others
+        """
+        super().__init__()
+        self.socket_dir = socket_dir
+        self.dropped = 0
+        self._socket = None
+        self._socket_path = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._socket is not None:
+                return
+            os.makedirs(self.socket_dir, mode=0o700, exist_ok=True)
+            name = '{}-{}{}'.format(os.getpid(), secrets.token_hex(4), self.SOCKET_SUFFIX)
+            self._socket_path = os.path.join(self.socket_dir, name)
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._socket.bind(self._socket_path)
+            threading.Thread(target=self._receive, args=(self._socket,), name='invalidation-receiver',
+                             daemon=True).start()
+
+    def close(self):
+        with self._lock:
+            if self._socket is None:
+                return
+            self._socket.close()
+            self._unlink(self._socket_path)
+            self._socket = None
+
+    def after_fork(self):
+        # the socket is still used by the parent process, only the inherited file descriptor is closed
+        self._lock = threading.Lock()
+        if self._socket is not None:
+            self._socket.close()
+        self._socket = None
+        self._socket_path = None
+        super().after_fork()
+
+    def _receive(self, sock: socket.socket):
+        while True:
+            try:
+                data = sock.recv(1024)
+            except OSError:
+                # the socket was closed
+                return
+            self._deliver(data.decode('ascii'))
+
+    def _peers(self) -> list:
+        try:
+            with os.scandir(self.socket_dir) as entries:
+                return [entry.path for entry in entries
+                        if entry.name.endswith(self.SOCKET_SUFFIX) and entry.path != self._socket_path]
+        except FileNotFoundError:
+            return []
+
+    def publish(self, hashed_id: str):
+        data = hashed_id.encode('ascii')
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.setblocking(False)
+            for path in self._peers():
+                try:
+                    sock.sendto(data, path)
+                except (ConnectionRefusedError, FileNotFoundError):
+                    # nothing is bound to the socket, the process has exited
+                    self._unlink(path)
+                except BlockingIOError:
+                    self.dropped += 1
+                    logger.warning('dropped invalidation for %s, its socket buffer is full', path)
+
+    @staticmethod
+    def _unlink(path: str):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+class DatabaseInvalidationBus(InvalidationBus):
+    """
+    Broadcasts invalidations to all processes on all nodes through a table in a shared database.
+
+    Invalidations are inserted in the table, which every process polls for the ones inserted by others, so they
+    are received within `poll_interval` seconds. If polling fails for more than `max_delay` seconds, the listeners
+    are told that invalidations may have been missed, and again when polling succeeds.
+
+    Rows are numbered by an autoincrement id, but they don't necessarily become visible in that order: a row
+    inserted in a transaction which commits late has a lower id than rows already seen. Ids skipped by a poll are
+    therefore looked for again by the following polls, for `overlap` seconds.
+    """
+    INVALIDATION_TABLE_NAME = 'consent_invalidation'
+    MAX_GAP = 1000
+
+    def __init__(self, db_url: str = None, poll_interval: float = 1, max_delay: float = 10,
+                 retention: float = 3600, timeout: float = None, overlap: float = 30):
+        """
+        Constructor.
+        :param db_url: URL to the database. If not specified an in-memory SQLite database will be used.
+        :param poll_interval: seconds between polls for new invalidations
+        :param max_delay: seconds of failed polling after which everything cached is considered stale
+        :param retention: seconds invalidations are kept in the table
+        :param timeout: seconds to wait for the database before failing
+        :param overlap: seconds during which an id skipped by a poll is looked for, should be longer than the
+                        longest time between inserting an invalidation and committing it
+        """
+        super().__init__()
+        self.poll_interval = poll_interval
+        self.max_delay = max_delay
+        self.retention = retention
+        self.overlap = overlap
+        self._connection = LazyDatasetConnection(db_url, timeout)
+        self._origin = secrets.token_hex(8)
+        self._last_id = None
+        self._gaps = {}
+        self._seen = set()
+        self._prepared_at = None
+        self._last_poll = None
+        self._missed = False
+        self._polls = 0
+        self._stopped = None
+        self._lock = threading.Lock()
+
+    @property
+    def invalidation_table(self):
+        return self._connection.table(self.INVALIDATION_TABLE_NAME)
+
+    def publish(self, hashed_id: str):
+        self.invalidation_table.insert({'hashed_id': hashed_id, 'origin': self._origin, 'created': time.time()})
+
+    def _prepare(self):
+        if self._last_id is not None:
+            return
+        for column, example in [('hashed_id', ''), ('origin', ''), ('created', 0.0)]:
+            self.invalidation_table.create_column_by_example(column, example)
+        # only invalidations published from now on are of interest
+        last = self.invalidation_table.find_one(order_by='-id')
+        self._last_id = last['id'] if last else 0
+        self._prepared_at = time.monotonic()
+
+    def start(self):
+        with self._lock:
+            if self._stopped is not None:
+                return
+            self._prepare()
+            self._last_poll = time.monotonic()
+            self._stopped = threading.Event()
+            threading.Thread(target=self._run, args=(self._stopped,), name='invalidation-poller',
+                             daemon=True).start()
+
+    def start_after_fork(self):
+        # the children receive everything published after this
+        self._prepare()
+        super().start_after_fork()
+
+    def close(self):
+        with self._lock:
+            if self._stopped is None:
+                return
+            self._stopped.set()
+            self._stopped = None
+
+    def after_fork(self):
+        self._lock = threading.Lock()
+        self._origin = secrets.token_hex(8)
+        self._stopped = None
+        super().after_fork()
+
+    def _deliver_missed(self):
+        # what was published since the bus was prepared in the parent is received by the first poll, unless it
+        # may already have been removed
+        if time.monotonic() - self._prepared_at > self.retention / 2:
+            super()._deliver_missed()
+
+    def _run(self, stopped: threading.Event):
+        while not stopped.wait(self.poll_interval):
+            self.poll()
+
+    def poll(self):
+        """
+        Delivers the invalidations published by other processes since the last poll.
+        """
+        scan_from = min(self._gaps) - 1 if self._gaps else self._last_id
+        try:
+            rows = list(self.invalidation_table.find(id={'>': scan_from}, order_by='id'))
+            if self._polls % 100 == 0:
+                self.invalidation_table.delete(created={'<': time.time() - self.retention})
+            self._polls += 1
+        except Exception:
+            logger.warning('failed to poll for invalidations', exc_info=True)
+            if not self._missed and time.monotonic() - self._last_poll > self.max_delay:
+                self._missed = True
+                self._deliver(None)
+            return
+
+        now = self._last_poll = time.monotonic()
+        for row in rows:
+            id = row['id']
+            if id in self._seen or (id <= self._last_id and id not in self._gaps):
+                continue
+            if id > self._last_id:
+                for skipped in range(max(self._last_id + 1, id - self.MAX_GAP), id):
+                    self._gaps[skipped] = now
+                self._last_id = id
+            self._gaps.pop(id, None)
+            self._seen.add(id)
+            if row['origin'] != self._origin:
+                self._deliver(row['hashed_id'])
+
+        # skipped ids which have not shown up in time never will, e.g. those of rolled back transactions
+        self._gaps = {id: skipped_at for id, skipped_at in self._gaps.items() if now - skipped_at <= self.overlap}
+        lowest = min(self._gaps) if self._gaps else self._last_id
+        self._seen = {id for id in self._seen if id > lowest}
+
+        if self._missed:
+            # what was dropped while polling failed can be rebuilt now
+            self._missed = False
+            self._deliver(None)
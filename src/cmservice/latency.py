@@ -0,0 +1,58 @@
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+
+class LatencyMonitor(object):
+    """
+    Keeps an exponentially weighted moving average of observed latencies.
+
+    The average decays towards zero while nothing is observed, so a monitor that stops receiving observations
+    (for example because requests are being rejected due to high latency) eventually reports a low latency again.
+    """
+
+    def __init__(self, weight: float = 0.2, half_life: float = 1.0):
+        """
+        Constructor.
+        :param weight: weight given to each new observation
+        :param half_life: seconds without observations after which the average is halved
+        """
+        self.weight = weight
+        self.half_life = half_life
+        self._average = 0.0
+        self._last_observation = None
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float):
+        """
+        Records an observed latency.
+        :param seconds: the observed latency in seconds
+        """
+        with self._lock:
+            if self._last_observation is None:
+                self._average = seconds
+            else:
+                self._average = self.weight * seconds + (1 - self.weight) * self._average
+            self._last_observation = time.monotonic()
+
+    @contextmanager
+    def measure(self):
+        """
+        Records the latency of the enclosed block.
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start)
+
+    @property
+    def average(self) -> float:
+        """
+        :return: the current average latency in seconds
+        """
+        if self._last_observation is None:
+            return 0.0
+        idle = time.monotonic() - self._last_observation
+        return self._average * math.pow(0.5, idle / self.half_life)
@@ -0,0 +1,192 @@
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+from datetime import datetime, timezone
+
+from cmservice.tracing import current_span
+
+request_id = contextvars.ContextVar('request_id', default=None)
+
+TEXT_FORMAT = '[%(asctime)-19.19s] [%(levelname)-5.5s]: %(message)s'
+
+_handler = None
+_listener = None
+
+
+class LazyJSON(object):
+    """
+    Serializes an object to JSON when a log message is formatted, so it's only done for messages that are emitted.
+    """
+    __slots__ = ('obj',)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        return json.dumps(self.obj)
+
+
+class RequestContextFilter(logging.Filter):
+    """
+    Adds the id of the current request, and of its trace if it's traced, to each record.
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id.get()
+        span = current_span()
+        record.trace_id = span.trace_id if span is not None else None
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Lets through only a fraction of the debug records of high-volume loggers.
+    """
+
+    def __init__(self, sample_rates: dict):
+        """
+        Constructor.
+        :param sample_rates: fraction of the debug records to keep, by logger name. Applies to child loggers too.
+        """
+        super().__init__()
+        self.sample_rates = sample_rates
+        self._rates = {}
+
+    def _rate(self, name: str) -> float:
+        rate = self._rates.get(name)
+        if rate is None:
+            logger_name = name
+            while logger_name not in self.sample_rates and '.' in logger_name:
+                logger_name = logger_name.rsplit('.', 1)[0]
+            rate = self._rates[name] = self.sample_rates.get(logger_name, 1.0)
+        return rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.DEBUG:
+            return True
+        rate = self._rate(record.name)
+        return rate >= 1.0 or random.random() < rate
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    Formats records as JSON objects, one per line.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key in ['request_id', 'trace_id']:
+            value = getattr(record, key, None)
+            if value is not None:
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            # rendered by NonBlockingQueueHandler before the record was queued
+            entry['exception'] = record.exc_text
+        return json.dumps(entry)
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records over to a `QueueListener`, which writes them from its own thread. When the queue is full,
+    records are dropped instead of waiting for the listener.
+    """
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # the message is merged with its arguments, and the traceback rendered, in the logging thread, since they
+        # may change or be freed later; the formatting of the record is left to the listener
+        record = logging.makeLogRecord(record.__dict__)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging(logging_level: str, log_format: str = 'text', log_file: str = None, debug_sample_rates: dict = None,
+                  queue_size: int = 10000):
+    """
+    Sends the log records of the root logger to stdout, and optionally to a file. Records are written by a
+    background thread, so logging never blocks on I/O.
+
+    Calling it again replaces the previous setup.
+
+    :param logging_level: lowest level of the records to log
+    :param log_format: 'text' or 'json'
+    :param log_file: path to a file to also write the records to
+    :param debug_sample_rates: fraction of the debug records to keep, by logger name
+    :param queue_size: maximum number of records waiting to be written, further records are dropped
+    """
+    global _handler, _listener
+
+    formatter = JSONFormatter() if log_format == 'json' else logging.Formatter(TEXT_FORMAT)
+    handlers = [logging.StreamHandler(sys.stdout)]
+    if log_file:
+        # reopens the file if it's rotated
+        handlers.append(logging.handlers.WatchedFileHandler(log_file))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    queue_handler = NonBlockingQueueHandler(queue.Queue(queue_size))
+    queue_handler.setLevel(logging_level)
+    queue_handler.addFilter(RequestContextFilter())
+    if debug_sample_rates:
+        queue_handler.addFilter(SamplingFilter(debug_sample_rates))
+    listener = logging.handlers.QueueListener(queue_handler.queue, *handlers)
+
+    root = logging.getLogger('')
+    if _handler is not None:
+        root.removeHandler(_handler)
+        _stop_listener()
+    root.setLevel(logging_level)
+    root.addHandler(queue_handler)
+    _handler, _listener = queue_handler, listener
+    listener.start()
+
+
+def _stop_listener():
+    global _listener
+    if _listener is None:
+        return
+    # writes the records still in the queue
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.close()
+    _listener = None
+
+
+def _restart_listener_after_fork():
+    # the listener thread isn't inherited, and the queue may have been locked by it when the process forked
+    if _listener is None:
+        return
+    _handler.queue = _listener.queue = queue.Queue(_handler.queue.maxsize)
+    _listener._thread = None
+    _listener.start()
+
+
+atexit.register(_stop_listener)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_restart_listener_after_fork)
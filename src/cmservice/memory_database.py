@@ -0,0 +1,231 @@
+import heapq
+import json
+import logging
+import mmap
+import os
+import threading
+import weakref
+from datetime import datetime
+
+from cmservice.consent import Consent
+from cmservice.database import ConsentDB, hash_id
+
+logger = logging.getLogger(__name__)
+
+_databases = weakref.WeakSet()
+
+
+def _reload_databases_after_fork():
+    for consent_db in list(_databases):
+        consent_db.reload_after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reload_databases_after_fork)
+
+
+class ConsentMemoryDB(ConsentDB):
+    """
+    Implementation keeping all consents in memory, for single node deployments.
+
+    Consents are indexed by hashed id, and a heap ordered by expiration time is used to remove expired consents.
+    If a data directory is given, every change is appended to a write-ahead log which is compacted into a snapshot
+    every `snapshot_interval` changes. Both are loaded when the database is created.
+
+    Since all state is kept in the memory of one process, it must only be used by a single worker process.
+    A process forked from the one which created the database, e.g. a worker of a preloaded app which replaces
+    one that was restarted, reloads the snapshot and write-ahead log, so it sees the changes made by its
+    predecessor.
+    """
+    SINGLE_PROCESS = True
+    SNAPSHOT_NAME = 'consents.snapshot'
+    WAL_NAME = 'consents.wal'
+    MIN_COMPACTED_HEAP_SIZE = 1024
+
+    def __init__(self, salt: str, max_months_valid: int, data_dir: str = None, snapshot_interval: int = 10000,
+                 fsync: bool = False):
+        """
+        Constructor.
+        :param data_dir: directory for the write-ahead log and snapshots.
+                         If not specified nothing will be persisted.
+        :param snapshot_interval: number of changes in the write-ahead log which triggers a new snapshot
+        :param fsync: whether to fsync the write-ahead log after each change
+        """
+        super().__init__(salt, max_months_valid)
+        self.data_dir = data_dir
+        self.snapshot_interval = snapshot_interval
+        self.fsync = fsync
+
+        self._consents = {}
+        self._expirations = []
+        self._lock = threading.RLock()
+        self._wal = None
+        self._wal_records = 0
+
+        if data_dir:
+            os.makedirs(data_dir, exist_ok=True)
+            self._open()
+        _databases.add(self)
+
+    def _open(self):
+        self._load()
+        self._wal = open(os.path.join(self.data_dir, self.WAL_NAME), 'ab')
+        self._truncate_partial_record()
+
+    def reload_after_fork(self):
+        """
+        Replaces the state inherited from the parent process with what has been persisted, after a fork.
+        """
+        self._lock = threading.RLock()
+        if self._wal is None:
+            # nothing is persisted, or the database has been closed
+            return
+        # every change is flushed, so nothing buffered is written again by closing the inherited file
+        self._wal.close()
+        self._consents = {}
+        self._expirations = []
+        self._wal_records = 0
+        self._open()
+
+    @staticmethod
+    def _read_records(path: str):
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            return
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for line in iter(mm.readline, b''):
+                try:
+                    yield json.loads(line.decode('utf-8'))
+                except ValueError:
+                    # a partially written last record, from a crash during a write
+                    logger.warning('skipping corrupt record in %s', path)
+
+    def _truncate_partial_record(self):
+        size = self._wal.tell()
+        if size == 0:
+            return
+        with open(self._wal.name, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            end = mm.rfind(b'\n') + 1
+        if end != size:
+            self._wal.truncate(end)
+            self._wal.seek(end)
+
+    def _load(self):
+        for record in self._read_records(os.path.join(self.data_dir, self.SNAPSHOT_NAME)):
+            self._apply(record)
+        for record in self._read_records(os.path.join(self.data_dir, self.WAL_NAME)):
+            self._apply(record)
+            self._wal_records += 1
+        self.sweep()
+        logger.info('loaded %s consents from %s', len(self._consents), self.data_dir)
+
+    def _apply(self, record: dict):
+        if record['op'] == 'save':
+            consent = Consent(record['attributes'], record['months_valid'],
+                              datetime.fromtimestamp(record['timestamp']))
+            self._put(record['id'], consent)
+        elif record['op'] == 'remove':
+            self._consents.pop(record['id'], None)
+
+    def _put(self, hashed_id: str, consent: Consent):
+        expires_at = consent.expiration_time(self.max_month)
+        self._consents[hashed_id] = (consent, expires_at)
+        heapq.heappush(self._expirations, (expires_at, hashed_id))
+        # entries of replaced and removed consents are only dropped when they expire, unless they pile up
+        if len(self._expirations) > 2 * len(self._consents) + self.MIN_COMPACTED_HEAP_SIZE:
+            self._compact()
+
+    def _compact(self):
+        self._expirations = [(expires_at, hashed_id) for hashed_id, (_, expires_at) in self._consents.items()]
+        heapq.heapify(self._expirations)
+
+    @staticmethod
+    def _save_record(hashed_id: str, consent: Consent) -> dict:
+        return {
+            'op': 'save',
+            'id': hashed_id,
+            'timestamp': consent.timestamp.timestamp(),
+            'months_valid': consent.months_valid,
+            'attributes': consent.attributes,
+        }
+
+    def _log(self, record: dict):
+        if self._wal is None:
+            return
+        self._wal.write(json.dumps(record).encode('utf-8') + b'\n')
+        self._wal.flush()
+        if self.fsync:
+            os.fsync(self._wal.fileno())
+        self._wal_records += 1
+        if self._wal_records >= self.snapshot_interval:
+            self.snapshot()
+
+    def snapshot(self):
+        """
+        Writes all consents to a new snapshot and truncates the write-ahead log.
+        """
+        if not self.data_dir:
+            return
+        with self._lock:
+            path = os.path.join(self.data_dir, self.SNAPSHOT_NAME)
+            with open(path + '.tmp', 'wb') as f:
+                for hashed_id, (consent, _) in self._consents.items():
+                    f.write(json.dumps(self._save_record(hashed_id, consent)).encode('utf-8') + b'\n')
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(path + '.tmp', path)
+
+            # replaying the log on top of the new snapshot is harmless, so a crash before this point is safe
+            self._wal.truncate(0)
+            self._wal_records = 0
+
+    def sweep(self) -> int:
+        """
+        Removes all expired consents.
+        :return: the number of removed consents
+        """
+        removed = 0
+        now = datetime.now()
+        with self._lock:
+            while self._expirations and self._expirations[0][0] <= now:
+                expires_at, hashed_id = heapq.heappop(self._expirations)
+                entry = self._consents.get(hashed_id)
+                # the heap may contain outdated entries for consents which have been replaced or removed
+                if entry and entry[1] == expires_at:
+                    del self._consents[hashed_id]
+                    self._log({'op': 'remove', 'id': hashed_id})
+                    removed += 1
+        return removed
+
+    def save_consent(self, id: str, consent: Consent):
+        hashed_id = hash_id(id, self.salt)
+        with self._lock:
+            self._put(hashed_id, consent)
+            self._log(self._save_record(hashed_id, consent))
+        self.sweep()
+
+    def get_consent(self, id: str) -> Consent:
+        entry = self._consents.get(hash_id(id, self.salt))
+        if entry is None:
+            return None
+        consent, expires_at = entry
+        if expires_at <= datetime.now():
+            self.remove_consent(id)
+            return None
+        return consent
+
+    def remove_consent(self, id: str):
+        hashed_id = hash_id(id, self.salt)
+        with self._lock:
+            if self._consents.pop(hashed_id, None) is not None:
+                self._log({'op': 'remove', 'id': hashed_id})
+
+    def __len__(self) -> int:
+        return len(self._consents)
+
+    def close(self):
+        """
+        Closes the write-ahead log.
+        """
+        if self._wal is not None:
+            self._wal.close()
+            self._wal = None
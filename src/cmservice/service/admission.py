@@ -0,0 +1,192 @@
+import functools
+import logging
+import math
+import random
+import threading
+import time
+from collections import OrderedDict
+
+from flask import request
+from flask.globals import current_app
+
+from cmservice.database import LazyDatasetConnection, is_storage_error
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimitBackend(object):
+    def consume(self, key: str, rate: float, burst: int) -> float:
+        """
+        Takes one token from the bucket identified by the key.
+
+        :param key: identifier of the bucket
+        :param rate: number of tokens added to the bucket per second
+        :param burst: maximum number of tokens in the bucket
+        :return: 0 if a token was available, else the number of seconds until one will be
+        """
+        raise NotImplementedError("Must be implemented!")
+
+
+class MemoryRateLimitBackend(RateLimitBackend):
+    """
+    Keeps the token buckets in the memory of the current process.
+    """
+
+    def __init__(self, max_buckets: int = 100000):
+        """
+        Constructor.
+        :param max_buckets: maximum number of buckets to keep, the least recently used are dropped first
+        """
+        self.max_buckets = max_buckets
+        self.buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def consume(self, key: str, rate: float, burst: int) -> float:
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self.buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            retry_after = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                retry_after = (1 - tokens) / rate
+
+            self.buckets[key] = (tokens, now)
+            if len(self.buckets) > self.max_buckets:
+                self.buckets.popitem(last=False)
+            return retry_after
+
+
+class DatasetRateLimitBackend(RateLimitBackend):
+    """
+    Keeps the token buckets in a database shared by all workers, using the `dataset` library.
+    """
+    TABLE_NAME = 'rate_limit'
+
+    def __init__(self, rate_limit_db_path: str = None, timeout: float = None):
+        """
+        Constructor.
+        :param rate_limit_db_path: path to the SQLite db.
+                                   If not specified an in-memory database will be used.
+        :param timeout: seconds to wait for the database before failing
+        """
+        self._connection = LazyDatasetConnection(rate_limit_db_path, timeout)
+        self._rate_limit_table = None
+
+    @property
+    def rate_limit_db(self):
+        return self._connection.db
+
+    @property
+    def rate_limit_table(self):
+        if self._rate_limit_table is None:
+            table = self.rate_limit_db.create_table(self.TABLE_NAME, primary_id='bucket',
+                                                    primary_type=self.rate_limit_db.types.string(255))
+            table.create_column('tokens', self.rate_limit_db.types.float)
+            table.create_column('updated', self.rate_limit_db.types.float)
+            self._rate_limit_table = table
+        return self._rate_limit_table
+
+    def consume(self, key: str, rate: float, burst: int) -> float:
+        from sqlalchemy import text
+
+        now = time.time()
+        table = self.rate_limit_table
+        refilled = ('CASE WHEN tokens + (:now - updated) * :rate > :burst '
+                    'THEN :burst ELSE tokens + (:now - updated) * :rate END')
+        # the refill and the withdrawal are done in a single statement, to be atomic across workers
+        result = self.rate_limit_db.executable.execute(
+            text('UPDATE {table} SET tokens = {refilled} - 1, updated = :now '
+                 'WHERE bucket = :bucket AND {refilled} >= 1'.format(table=self.TABLE_NAME, refilled=refilled)),
+            now=now, rate=rate, burst=burst, bucket=key)
+        if result.rowcount:
+            return 0.0
+
+        row = table.find_one(bucket=key)
+        if row is None:
+            table.insert_ignore({'bucket': key, 'tokens': burst - 1, 'updated': now}, ['bucket'])
+            return 0.0
+        tokens = min(burst, row['tokens'] + (now - row['updated']) * rate)
+        return max((1 - tokens) / rate, 0.0)
+
+
+class AdmissionController(object):
+    def __init__(self, rate_limit_backend: RateLimitBackend, rate_limits: dict, storage_latency,
+                 latency_thresholds: list = None, retry_after: int = 1):
+        """
+        Constructor.
+        :param rate_limit_backend: storage of the token buckets
+        :param rate_limits: map of endpoint name to [tokens per second, burst size], per client
+        :param storage_latency: `cmservice.latency.LatencyMonitor` of the storage used by the endpoints
+        :param latency_thresholds: [soft, hard] storage latency in seconds. Between the two, an increasing share of
+                                   requests is rejected, above the hard threshold all of them are.
+                                   If not specified no requests are rejected because of latency.
+        :param retry_after: seconds to ask the client to wait when a request is rejected because of latency
+        """
+        self.rate_limit_backend = rate_limit_backend
+        self.rate_limits = rate_limits
+        self.storage_latency = storage_latency
+        self.latency_thresholds = latency_thresholds
+        self.retry_after = retry_after
+
+    def should_shed_load(self) -> bool:
+        if not self.latency_thresholds:
+            return False
+        soft, hard = self.latency_thresholds
+        latency = self.storage_latency.average
+        if latency <= soft:
+            return False
+        if latency >= hard:
+            return True
+        return random.random() < (latency - soft) / (hard - soft)
+
+    def admit(self, endpoint: str, client: str):
+        """
+        Decides whether a request should be handled.
+
+        :param endpoint: name of the requested endpoint
+        :param client: identifier of the client making the request
+        :return: None if the request is admitted, else a tuple of the HTTP status code to respond with and the
+                 number of seconds the client should wait before retrying
+        """
+        if self.should_shed_load():
+            logger.warning('shedding load on %s, storage latency is %.3fs', endpoint, self.storage_latency.average)
+            return 503, self.retry_after
+
+        if endpoint in self.rate_limits:
+            rate, burst = self.rate_limits[endpoint]
+            try:
+                retry_after = self.rate_limit_backend.consume('{}:{}'.format(endpoint, client), rate, burst)
+            except Exception as e:
+                if not is_storage_error(e):
+                    raise
+                # an unavailable rate limit database must not take the endpoints down with it
+                logger.warning('failed to rate limit %s, admitting the request', endpoint, exc_info=True)
+                return None
+            if retry_after:
+                logger.debug('rate limited %s for client %s', endpoint, client)
+                return 429, int(math.ceil(retry_after))
+        return None
+
+
+def admission_controlled(endpoint: str):
+    """
+    Decorator rejecting requests to a view that are not admitted by the app's `AdmissionController`.
+    :param endpoint: the name of the endpoint, as used in the rate limit configuration
+    """
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            rejection = current_app.admission.admit(endpoint, request.remote_addr)
+            if rejection:
+                status, retry_after = rejection
+                response = current_app.response_class(status=status)
+                response.headers['Retry-After'] = str(retry_after)
+                return response
+            return view(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
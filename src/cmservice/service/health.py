@@ -0,0 +1,44 @@
+import logging
+
+from flask import jsonify
+from flask.blueprints import Blueprint
+from flask.globals import current_app
+
+from cmservice.service.warmup import warm_up
+
+health_views = Blueprint('health', __name__, url_prefix='/health')
+
+logger = logging.getLogger(__name__)
+
+
+def health_response(status_code: int, **data):
+    response = jsonify(data)
+    response.status_code = status_code
+    response.cache_control.no_store = True
+    return response
+
+
+@health_views.route('/live')
+def live():
+    return health_response(200, status='alive')
+
+
+@health_views.route('/ready')
+def ready():
+    if not current_app.warmed_up:
+        # the app was not warmed up when it was created, so it's done before it reports being ready
+        warm_up(current_app._get_current_object())
+
+    try:
+        storage_latency = current_app.cm.probe_storage()
+    except Exception:
+        logger.warning('storage probe failed', exc_info=True)
+        return health_response(503, status='storage unavailable')
+
+    circuit_breakers = {breaker.name: breaker.stats()
+                        for breaker in [current_app.cm.consent_db_breaker, current_app.cm.ticket_db_breaker]}
+    if storage_latency > current_app.config.get('READINESS_MAX_STORAGE_LATENCY', 1.0):
+        logger.warning('not ready, storage latency is %.3fs', storage_latency)
+        return health_response(503, status='storage slow', storage_latency=storage_latency,
+                               circuit_breakers=circuit_breakers)
+    return health_response(200, status='ready', storage_latency=storage_latency, circuit_breakers=circuit_breakers)
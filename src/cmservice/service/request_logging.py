@@ -0,0 +1,48 @@
+import re
+from uuid import uuid4
+
+from flask import Flask
+
+from cmservice.log import request_id
+
+REQUEST_ID_PATTERN = re.compile(r'[A-Za-z0-9._-]{1,64}')
+
+
+class RequestIdMiddleware(object):
+    """
+    WSGI middleware giving each request an id, which is added to the records logged while handling it and
+    returned in the `X-Request-ID` response header.
+
+    The id of a request with a well-formed `X-Request-ID` header, e.g. set by a load balancer, is kept.
+    """
+
+    def __init__(self, wsgi_app):
+        """
+        Constructor.
+        :param wsgi_app: the WSGI app to give request ids
+        """
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        id = environ.get('HTTP_X_REQUEST_ID', '')
+        if not REQUEST_ID_PATTERN.fullmatch(id):
+            id = uuid4().hex
+
+        def start_response_with_id(status, headers, exc_info=None):
+            headers.append(('X-Request-ID', id))
+            return start_response(status, headers, exc_info)
+
+        token = request_id.set(id)
+        try:
+            return self.wsgi_app(environ, start_response_with_id)
+        finally:
+            request_id.reset(token)
+
+
+def init_app(app: Flask):
+    """
+    Gives every request to the app an id.
+
+    :param app: the app
+    """
+    app.wsgi_app = RequestIdMiddleware(app.wsgi_app)
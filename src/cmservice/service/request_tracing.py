@@ -0,0 +1,69 @@
+from flask import Flask, request
+from flask.sessions import SecureCookieSessionInterface
+
+from cmservice.tracing import Tracer, current_span, span
+
+
+class TracedSessionInterface(SecureCookieSessionInterface):
+    """
+    Records loading and saving of the session cookie as spans.
+    """
+
+    def open_session(self, app, request):
+        with span('session.open'):
+            return super().open_session(app, request)
+
+    def save_session(self, app, session, response):
+        with span('session.save'):
+            return super().save_session(app, session, response)
+
+
+class TracingMiddleware(object):
+    """
+    WSGI middleware recording a trace of each sampled request, continuing the trace of the caller if the request
+    has a `traceparent` header.
+
+    The trace covers everything done by Flask, including loading and saving the session.
+    """
+
+    def __init__(self, wsgi_app, tracer: Tracer):
+        """
+        Constructor.
+        :param wsgi_app: the WSGI app to trace
+        :param tracer: tracer to record the traces with
+        """
+        self.wsgi_app = wsgi_app
+        self.tracer = tracer
+
+    def __call__(self, environ, start_response):
+        method = environ.get('REQUEST_METHOD', 'GET')
+        # named after the method until the route is known, the path may contain tickets and JWT:s
+        root = self.tracer.start_trace(method, environ.get('HTTP_TRACEPARENT'), {'http.method': method})
+        if root is None:
+            return self.wsgi_app(environ, start_response)
+
+        def traced_start_response(status, headers, exc_info=None):
+            root.set_attribute('http.status_code', int(status.split(' ', 1)[0]))
+            return start_response(status, headers, exc_info)
+
+        with root:
+            return self.wsgi_app(environ, traced_start_response)
+
+
+def name_request_span(endpoint, values):
+    root = current_span()
+    if root is not None and request.url_rule is not None:
+        root.name = '{} {}'.format(request.method, request.url_rule.rule)
+        root.set_attribute('http.route', request.url_rule.rule)
+
+
+def init_app(app: Flask, tracer: Tracer):
+    """
+    Records a trace of every sampled request to the app.
+
+    :param app: the app to trace
+    :param tracer: tracer to record the traces with
+    """
+    app.wsgi_app = TracingMiddleware(app.wsgi_app, tracer)
+    app.session_interface = TracedSessionInterface()
+    app.url_value_preprocessor(name_request_span)
@@ -0,0 +1,138 @@
+import argparse
+import json
+import os
+import sys
+
+WORKER_CLASSES = ['sync', 'gthread', 'gevent']
+
+
+def default_options(worker_class: str, cpu_count: int) -> dict:
+    """
+    :param worker_class: gunicorn worker class
+    :param cpu_count: number of CPUs available
+    :return: number of workers, threads and connections suitable for the worker class
+    """
+    if worker_class == 'sync':
+        # the workers spend part of their time waiting for the database
+        return {'workers': 2 * cpu_count + 1, 'threads': 1}
+    if worker_class == 'gthread':
+        return {'workers': cpu_count + 1, 'threads': 4}
+    # a single worker per CPU serves many connections, bounded to not exhaust the database connections
+    return {'workers': cpu_count, 'worker_connections': 256}
+
+
+def gunicorn_options(config: dict, cpu_count: int = None) -> dict:
+    """
+    :param config: the CMservice configuration
+    :param cpu_count: number of CPUs available, if not specified the number of CPUs this process may run on
+    :return: gunicorn settings for serving the CMservice
+    """
+    if cpu_count is None:
+        cpu_count = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+
+    worker_class = config.get('SERVER_WORKER_CLASS', 'gthread')
+    if worker_class not in WORKER_CLASSES:
+        raise ValueError('Unknown worker class: {}'.format(worker_class))
+    defaults = default_options(worker_class, cpu_count)
+
+    max_requests = config.get('SERVER_MAX_REQUESTS', 10000)
+    options = {
+        'bind': '{}:{}'.format(config.get('HOST', '127.0.0.1'), config.get('PORT', 8166)),
+        'worker_class': worker_class,
+        'workers': config.get('SERVER_WORKERS', defaults['workers']),
+        # the app is created, and warmed up, once in the master and shared by the workers
+        'preload_app': config.get('SERVER_PRELOAD', True),
+        # workers are restarted after a random number of requests in this range, so they don't all restart at once
+        'max_requests': max_requests,
+        'max_requests_jitter': config.get('SERVER_MAX_REQUESTS_JITTER', max_requests // 10),
+        'keepalive': config.get('SERVER_KEEPALIVE', 5),
+        'timeout': config.get('SERVER_TIMEOUT', 30),
+        'graceful_timeout': config.get('SERVER_GRACEFUL_TIMEOUT', 30),
+    }
+    if worker_class == 'gthread':
+        options['threads'] = config.get('SERVER_THREADS', defaults['threads'])
+    elif worker_class == 'gevent':
+        options['worker_connections'] = config.get('SERVER_WORKER_CONNECTIONS', defaults['worker_connections'])
+    if config.get('SSL'):
+        options['certfile'] = config['SERVER_CERT']
+        options['keyfile'] = config['SERVER_KEY']
+    return options
+
+
+def load_config(path: str) -> dict:
+    """
+    Reads a configuration file like `flask.Config.from_pyfile`, without importing Flask, which must not be
+    imported before gevent has patched the standard library.
+
+    :param path: path to a CMservice configuration file
+    :return: the configuration
+    """
+    namespace = {'__file__': path}
+    with open(path, 'rb') as f:
+        exec(compile(f.read(), path, 'exec'), namespace)
+    return {key: value for key, value in namespace.items() if key.isupper()}
+
+
+def serve(config: dict, options: dict):
+    """
+    Serves the CMservice with gunicorn.
+
+    :param config: the CMservice configuration
+    :param options: gunicorn settings
+    """
+    if options['worker_class'] == 'gevent':
+        # everything must be patched before the app is loaded, which with preload is done in the master process
+        from gevent import monkey
+        monkey.patch_all()
+
+    from gunicorn.app.base import BaseApplication
+
+    class CMserviceApplication(BaseApplication):
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            from cmservice.service.wsgi import create_app
+            # a preloaded app is created in the master, which must not receive invalidations before forking
+            return create_app(dict(config, INVALIDATION_START_AFTER_FORK=options['preload_app'],
+                                   SERVER_WORKERS=options['workers']))
+
+    CMserviceApplication(prog='cmservice-serve').run()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve the CMservice with gunicorn.')
+    parser.add_argument('--config', default=os.environ.get('CMSERVICE_CONFIG'),
+                        help='path to the configuration file, defaults to $CMSERVICE_CONFIG')
+    parser.add_argument('--bind', help='address to listen on, defaults to HOST:PORT of the configuration')
+    parser.add_argument('--worker-class', choices=WORKER_CLASSES)
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--threads', type=int, help='threads per worker, for the gthread worker class')
+    parser.add_argument('--no-preload', action='store_true', help='create the app in each worker')
+    parser.add_argument('--print-options', action='store_true', help='print the gunicorn settings and exit')
+    args = parser.parse_args(argv)
+    if not args.config:
+        parser.error('no configuration file, use --config or set CMSERVICE_CONFIG')
+
+    config = load_config(args.config)
+    for key, value in [('SERVER_WORKER_CLASS', args.worker_class), ('SERVER_WORKERS', args.workers),
+                       ('SERVER_THREADS', args.threads)]:
+        if value is not None:
+            config[key] = value
+    if args.no_preload:
+        config['SERVER_PRELOAD'] = False
+
+    options = gunicorn_options(config)
+    if args.bind:
+        options['bind'] = args.bind
+    if args.print_options:
+        json.dump(options, sys.stdout, indent=2, sort_keys=True)
+        print()
+        return
+
+    serve(config, options)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+import argparse
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import sys
+
+from flask.globals import current_app
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MANIFEST_NAME = 'manifest.json'
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+# preferred encodings first
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+
+def fingerprinted_name(name: str, content: bytes) -> str:
+    """
+    :param name: name of an asset
+    :param content: content of the asset
+    :return: the name with a hash of the content inserted before the file extension
+    """
+    root, ext = os.path.splitext(name)
+    return '{}.{}{}'.format(root, hashlib.sha256(content).hexdigest()[:12], ext)
+
+
+def compress(content: bytes, encoding: str) -> bytes:
+    if encoding == 'gzip':
+        return gzip.compress(content, compresslevel=9, mtime=0)
+    if encoding == 'br' and brotli:
+        return brotli.compress(content)
+    return None
+
+
+class Asset(object):
+    def __init__(self, name: str, content: bytes, variants: dict):
+        """
+        :param name: name of the asset, without fingerprint
+        :param content: uncompressed content
+        :param variants: map of content encoding to the compressed content
+        """
+        self.name = name
+        self.content = content
+        self.variants = variants
+        self.mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+
+
+class StaticAssets(object):
+    """
+    Static assets, read once and served from memory under fingerprinted names.
+    """
+
+    def __init__(self, directory: str):
+        """
+        Constructor.
+        :param directory: directory containing the assets, either the source directory or one created
+                          by `build`, which also contains fingerprinted and precompressed files
+        """
+        self.assets = {}
+        self.fingerprinted = {}
+
+        manifest_path = os.path.join(directory, MANIFEST_NAME)
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            for name, fingerprinted in manifest.items():
+                self._add(name, fingerprinted, self._read_variants(directory, fingerprinted))
+        else:
+            for name in sorted(os.listdir(directory)):
+                path = os.path.join(directory, name)
+                if not os.path.isfile(path) or name.endswith(tuple(suffix for _, suffix in ENCODINGS)):
+                    continue
+                with open(path, 'rb') as f:
+                    content = f.read()
+                variants = {encoding: compress(content, encoding) for encoding, _ in ENCODINGS}
+                variants[None] = content
+                self._add(name, fingerprinted_name(name, content), variants)
+
+    @staticmethod
+    def _read_variants(directory: str, fingerprinted: str) -> dict:
+        variants = {}
+        for encoding, suffix in [(None, '')] + ENCODINGS:
+            path = os.path.join(directory, fingerprinted + suffix)
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    variants[encoding] = f.read()
+        return variants
+
+    def _add(self, name: str, fingerprinted: str, variants: dict):
+        content = variants.pop(None)
+        asset = Asset(name, content, {encoding: data for encoding, data in variants.items() if data})
+        self.assets[name] = asset
+        self.assets[fingerprinted] = asset
+        self.fingerprinted[name] = fingerprinted
+
+    def url(self, name: str) -> str:
+        """
+        :param name: name of an asset
+        :return: the URL of the fingerprinted asset
+        """
+        return '/static/' + self.fingerprinted.get(name, name)
+
+    def response(self, path: str, accept_encodings):
+        """
+        :param path: requested asset, with or without fingerprint
+        :param accept_encodings: the `Accept-Encoding` of the request
+        :return: a response with the asset, or None if it's unknown
+        """
+        asset = self.assets.get(path)
+        if asset is None:
+            return None
+
+        content, content_encoding = asset.content, None
+        for encoding, _ in ENCODINGS:
+            if encoding in asset.variants and accept_encodings[encoding]:
+                content, content_encoding = asset.variants[encoding], encoding
+                break
+
+        response = current_app.response_class(content, mimetype=asset.mimetype)
+        response.headers['Vary'] = 'Accept-Encoding'
+        if content_encoding:
+            response.headers['Content-Encoding'] = content_encoding
+        if path != asset.name:
+            # fingerprinted URLs never change content
+            response.cache_control.public = True
+            response.cache_control.max_age = IMMUTABLE_MAX_AGE
+            response.cache_control.immutable = True
+        else:
+            response.set_etag(self.fingerprinted[asset.name])
+        return response
+
+
+def static_url(name: str) -> str:
+    """
+    Template helper giving the fingerprinted URL of a static asset.
+    :param name: name of the asset
+    """
+    return current_app.static_assets.url(name)
+
+
+def build(source: str, destination: str) -> dict:
+    """
+    Writes fingerprinted and precompressed copies of all assets in a directory, together with a manifest
+    mapping the original names to the fingerprinted ones. The result can be served directly by a web server,
+    or used by the CMservice with `STATIC_ASSETS_DIR`.
+
+    :param source: directory with the original assets
+    :param destination: directory to write to
+    :return: the manifest
+    """
+    os.makedirs(destination, exist_ok=True)
+    manifest = {}
+    for name, fingerprinted in StaticAssets(source).fingerprinted.items():
+        with open(os.path.join(source, name), 'rb') as f:
+            content = f.read()
+        with open(os.path.join(destination, fingerprinted), 'wb') as f:
+            f.write(content)
+        for encoding, suffix in ENCODINGS:
+            compressed = compress(content, encoding)
+            if compressed:
+                with open(os.path.join(destination, fingerprinted + suffix), 'wb') as f:
+                    f.write(compressed)
+        manifest[name] = fingerprinted
+
+    with open(os.path.join(destination, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def main(argv=None):
+    from importlib import resources
+
+    parser = argparse.ArgumentParser(description='Build fingerprinted and precompressed static assets.')
+    parser.add_argument('destination', help='directory to write the assets to')
+    parser.add_argument('--source', default=str(resources.files('cmservice.service') / 'site/static'),
+                        help='directory with the original assets')
+    args = parser.parse_args(argv)
+
+    manifest = build(args.source, args.destination)
+    for name, fingerprinted in sorted(manifest.items()):
+        print('{} -> {}'.format(name, os.path.join(args.destination, fingerprinted)))
+    if not brotli:
+        print('brotli is not installed, no .br files were written', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
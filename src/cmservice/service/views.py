@@ -1,35 +1,58 @@
 import copy
+import hashlib
+import json
 import logging
+import math
+from datetime import datetime
 from uuid import uuid4
 
-import pkg_resources
 from flask import abort, jsonify
 from flask import redirect
 from flask import request
 from flask import session
 from flask.blueprints import Blueprint
 from flask.globals import current_app
-from flask.helpers import send_from_directory
 from flask_mako import render_template
 
 from cmservice.consent import Consent
-from cmservice.consent_manager import InvalidConsentRequestError
+from cmservice.consent_manager import InvalidConsentRequestError, StorageUnavailableError
+from cmservice.service.admission import admission_controlled
+from cmservice.tracing import span
 
 consent_views = Blueprint('consent_service', __name__, url_prefix='')
 
 logger = logging.getLogger(__name__)
 
 
+@consent_views.errorhandler(StorageUnavailableError)
+def storage_unavailable(e):
+    logger.warning('storage unavailable: %s', e)
+    response = current_app.response_class(status=503)
+    response.headers['Retry-After'] = str(int(math.ceil(e.retry_after or 1)))
+    return response
+
+
 @consent_views.route('/static/<path:path>')
 def static(path):
-    return send_from_directory(pkg_resources.resource_filename('cmservice.service', 'site/static'), path)
+    response = current_app.static_assets.response(path, request.accept_encodings)
+    if response is None:
+        abort(404)
+    return response.make_conditional(request)
 
 
 @consent_views.route("/verify/<id>")
+@admission_controlled('verify')
 def verify(id):
-    attributes = current_app.cm.fetch_consented_attributes(id)
-    if attributes:
-        return jsonify(attributes)
+    consent = current_app.cm.fetch_consent(id)
+    if consent and consent.attributes:
+        etag = consent_etag(consent)
+        if request.if_none_match.contains_weak(etag):
+            response = current_app.response_class(status=304)
+        else:
+            response = jsonify(consent.attributes)
+        response.set_etag(etag)
+        response.cache_control.max_age = verify_max_age(consent)
+        return response
 
     # no consent for the given id or it has expired
     logging.debug('no consent found for id \'%s\'', id)
@@ -37,6 +60,7 @@ def verify(id):
 
 
 @consent_views.route("/creq/<jwt>", methods=['GET','POST'])
+@admission_controlled('creq')
 def creq(jwt):
     if request.method == 'POST':
         jwt = request.values.get('jwt')
@@ -44,7 +68,7 @@ def creq(jwt):
         ticket = current_app.cm.save_consent_request(jwt)
         return ticket
     except InvalidConsentRequestError as e:
-        logger.debug('received invalid consent request: %s, %s', str(e), jwt)
+        logger.debug('received invalid consent request: %s, %s', e, jwt)
         abort(400)
 
 
@@ -90,7 +114,7 @@ def save_consent():
         abort(403)
     ok = request.args['consent_status']
 
-    if ok == 'Yes' and not set(attributes).issubset(set(session['attr'])):
+    if ok == 'Yes' and not set(attributes).issubset(session['attr']):
         abort(400)
 
     if ok == 'Yes':
@@ -106,17 +130,32 @@ def render_consent(language: str, requester_name: str, locked_attr: list, releas
         locked_attr = [locked_attr]
     locked_claims = {k: released_claims.pop(k) for k in locked_attr if k in released_claims}
 
-    return render_template(
-        'consent.mako',
-        consent_question=None,
-        state=state,
-        released_claims=released_claims,
-        locked_claims=locked_claims,
-        form_action='/set_language',
-        language=language,
-        requester_name=requester_name,
-        months=months,
-        select_attributes=select_attributes)
+    with span('render_template', template='consent.mako'):
+        return render_template(
+            'consent.mako',
+            consent_question=None,
+            state=state,
+            released_claims=released_claims,
+            locked_claims=locked_claims,
+            form_action='/set_language',
+            language=language,
+            requester_name=requester_name,
+            months=months,
+            select_attributes=select_attributes)
+
+
+def consent_etag(consent: Consent) -> str:
+    digest = hashlib.sha256(consent.timestamp.isoformat().encode('utf-8'))
+    digest.update(json.dumps(consent.attributes).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def verify_max_age(consent: Consent) -> int:
+    expiration_time = consent.expiration_time(current_app.config['MAX_CONSENT_EXPIRATION_MONTH'])
+    max_age = max(int((expiration_time - datetime.now()).total_seconds()), 0)
+    if current_app.config.get('VERIFY_MAX_AGE') is not None:
+        max_age = min(max_age, current_app.config['VERIFY_MAX_AGE'])
+    return max_age
 
 
 def find_requester_name(requester_name: list, language: str) -> str:
@@ -0,0 +1,42 @@
+import logging
+import os
+import threading
+import time
+
+from flask import Flask
+from flask_babel import force_locale, get_translations
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+
+
+def warm_up(app: Flask):
+    """
+    Loads everything which is otherwise loaded while handling the first requests: templates, translations,
+    database tables and trusted keys.
+
+    When done before the app is forked into workers (for example with gunicorn's `preload_app`), the workers
+    share the loaded state copy-on-write instead of each loading it. It's only done once per app.
+
+    :param app: the app to warm up
+    """
+    with _lock:
+        if app.warmed_up:
+            return
+        start = time.monotonic()
+
+        lookup = app._mako_lookup
+        for directory in lookup.directories:
+            for name in sorted(os.listdir(directory)):
+                if name.endswith('.mako'):
+                    lookup.get_template(name)
+
+        with app.test_request_context():
+            for locale in app.extensions['babel'].list_translations():
+                with force_locale(locale):
+                    get_translations()
+
+        app.cm.warm_up()
+        app.warmed_up = True
+        logger.info('warmed up in %.3fs', time.monotonic() - start)
@@ -1,17 +1,25 @@
 import logging
-import sys
-from importlib import import_module
+from importlib import import_module, metadata, resources
 
-import pkg_resources
 from flask import Flask
 from flask.globals import session
 from flask_babel import Babel
 from flask_mako import MakoTemplates
-from jwkest.jwk import RSAKey, rsa_load
 from mako.lookup import TemplateLookup
 
+from cmservice.circuit_breaker import CircuitBreaker, StaleConsentCache
+from cmservice.codec import Codec
 from cmservice.consent_manager import ConsentManager
-from cmservice.database import ConsentDB, ConsentRequestDB, ConsentDatasetDB, ConsentRequestDatasetDB
+from cmservice.database import ConsentDB, ConsentRequestDB, ConsentDatasetDB, ConsentRequestDatasetDB, \
+    ConsentRequestDatasetIndex, is_storage_error
+from cmservice.invalidation import InvalidationBus, UnixSocketInvalidationBus, DatabaseInvalidationBus
+from cmservice.log import setup_logging
+from cmservice.service import request_logging, request_tracing
+from cmservice.service.admission import AdmissionController, DatasetRateLimitBackend, MemoryRateLimitBackend
+from cmservice.service.static_assets import StaticAssets
+from cmservice.service.warmup import warm_up
+from cmservice.ticket import TicketGenerator, StatelessTicketCodec
+from cmservice.tracing import Tracer, FileSpanExporter, OTLPSpanExporter
 
 
 def import_database_class(db_module_name: str) -> type:
@@ -37,26 +45,106 @@ def load_consent_request_db_class(db_class: str, salt: str, init_args: list):
     return consent_request_db
 
 
+def init_invalidation_bus(app: Flask) -> InvalidationBus:
+    if app.config.get('INVALIDATION_DATABASE_URL'):
+        bus = DatabaseInvalidationBus(app.config['INVALIDATION_DATABASE_URL'],
+                                      app.config.get('INVALIDATION_POLL_INTERVAL', 1),
+                                      app.config.get('INVALIDATION_MAX_DELAY', 10),
+                                      timeout=app.config.get('STORAGE_TIMEOUT'))
+    elif app.config.get('INVALIDATION_SOCKET_DIR'):
+        bus = UnixSocketInvalidationBus(app.config['INVALIDATION_SOCKET_DIR'])
+    else:
+        return None
+    if app.config.get('INVALIDATION_START_AFTER_FORK'):
+        bus.start_after_fork()
+    else:
+        bus.start()
+    return bus
+
+
 def init_consent_manager(app: Flask):
-    consent_db = ConsentDatasetDB(app.config['CONSENT_SALT'], app.config['MAX_CONSENT_EXPIRATION_MONTH'],
-                                  app.config.get('CONSENT_DATABASE_URL'))
-    consent_request_db = ConsentRequestDatasetDB(app.config['CONSENT_SALT'],
-                                                 app.config.get('CONSENT_REQUEST_DATABASE_URL'))
+    # jwkest is slow to import and only needed to load the keys
+    from jwkest.jwk import RSAKey, rsa_load
+
+    codec = Codec(app.config.get('STORAGE_SERIALIZER', 'json'), app.config.get('STORAGE_COMPRESSION'),
+                  app.config.get('STORAGE_COMPRESSION_THRESHOLD', 1024),
+                  app.config.get('STORAGE_ALLOW_EXTRA_FORMATS', False))
+    if app.config.get('CONSENT_DATABASE_CLASS'):
+        consent_db = load_consent_db_class(app.config['CONSENT_DATABASE_CLASS'], app.config['CONSENT_SALT'],
+                                           app.config['MAX_CONSENT_EXPIRATION_MONTH'],
+                                           app.config.get('CONSENT_DATABASE_CLASS_ARGS', []))
+        if consent_db.SINGLE_PROCESS and app.config.get('SERVER_WORKERS', 1) > 1:
+            raise ValueError('{} keeps all consents in one process, SERVER_WORKERS must be 1'.format(
+                app.config['CONSENT_DATABASE_CLASS']))
+    else:
+        if app.config.get('CONSENT_BLOOM_FILTER_ERROR_RATE'):
+            # the proxy verifies a consent right after it's saved, possibly with another worker, whose filter
+            # must already contain it
+            if app.config.get('INVALIDATION_DATABASE_URL'):
+                raise ValueError('CONSENT_BLOOM_FILTER_ERROR_RATE can not be used with INVALIDATION_DATABASE_URL, '
+                                 'which only updates the filters of other workers when they poll')
+            if app.config.get('SERVER_WORKERS', 1) > 1 and not app.config.get('INVALIDATION_SOCKET_DIR'):
+                raise ValueError('CONSENT_BLOOM_FILTER_ERROR_RATE needs INVALIDATION_SOCKET_DIR when SERVER_WORKERS '
+                                 'is more than 1')
+        consent_db = ConsentDatasetDB(app.config['CONSENT_SALT'], app.config['MAX_CONSENT_EXPIRATION_MONTH'],
+                                      app.config.get('CONSENT_DATABASE_URL'),
+                                      bloom_filter_error_rate=app.config.get('CONSENT_BLOOM_FILTER_ERROR_RATE'),
+                                      bloom_filter_capacity=app.config.get('CONSENT_BLOOM_FILTER_CAPACITY', 100000),
+                                      codec=codec,
+                                      replica_urls=app.config.get('CONSENT_DATABASE_REPLICA_URLS'),
+                                      read_your_writes_window=app.config.get(
+                                          'CONSENT_DATABASE_READ_YOUR_WRITES_WINDOW', 5),
+                                      timeout=app.config.get('STORAGE_TIMEOUT'),
+                                      invalidation_bus=init_invalidation_bus(app))
+    ticket_codec = None
+    consent_request_db = None
+    request_index = None
+    if app.config.get('STATELESS_TICKET_KEY'):
+        ticket_codec = StatelessTicketCodec(app.config['STATELESS_TICKET_KEY'], app.config['TICKET_TTL'])
+    else:
+        consent_request_db = ConsentRequestDatasetDB(app.config['CONSENT_SALT'],
+                                                     app.config.get('CONSENT_REQUEST_DATABASE_URL'), codec,
+                                                     app.config.get('STORAGE_TIMEOUT'))
+        # kept next to the consent requests, so duplicates are detected by all workers
+        request_index = ConsentRequestDatasetIndex(app.config['CONSENT_SALT'], app.config['TICKET_TTL'],
+                                                   app.config.get('CONSENT_REQUEST_DATABASE_URL'),
+                                                   app.config.get('STORAGE_TIMEOUT'))
 
     trusted_keys = [RSAKey(key=rsa_load(key)) for key in app.config['TRUSTED_KEYS']]
+    ticket_generator = TicketGenerator(app.config.get('TICKET_HMAC_KEY'))
+    breakers = [CircuitBreaker(name, app.config.get('CIRCUIT_BREAKER_FAILURE_THRESHOLD', 5),
+                               app.config.get('CIRCUIT_BREAKER_RESET_TIMEOUT', 30), app.config.get('STORAGE_TIMEOUT'),
+                               is_failure=is_storage_error)
+                for name in ['consent_db', 'ticket_db']]
+    stale_consents = None
+    if app.config.get('VERIFY_MAX_STALENESS'):
+        stale_consents = StaleConsentCache(app.config['VERIFY_MAX_STALENESS'],
+                                           app.config.get('VERIFY_STALE_CACHE_SIZE', 10000))
     cm = ConsentManager(consent_db, consent_request_db, trusted_keys, app.config['TICKET_TTL'],
-                        app.config['MAX_CONSENT_EXPIRATION_MONTH'])
+                        app.config['MAX_CONSENT_EXPIRATION_MONTH'], ticket_generator, ticket_codec, *breakers,
+                        stale_consents, request_index)
     return cm
 
 
-def setup_logging(logging_level: str):
-    logger = logging.getLogger('')
-    base_formatter = logging.Formatter('[%(asctime)-19.19s] [%(levelname)-5.5s]: %(message)s')
-    hdlr = logging.StreamHandler(sys.stdout)
-    hdlr.setFormatter(base_formatter)
-    hdlr.setLevel(logging_level)
-    logger.setLevel(logging_level)
-    logger.addHandler(hdlr)
+def init_admission_controller(app: Flask, cm: ConsentManager):
+    if app.config.get('RATE_LIMIT_DATABASE_URL'):
+        rate_limit_backend = DatasetRateLimitBackend(app.config['RATE_LIMIT_DATABASE_URL'],
+                                                     app.config.get('STORAGE_TIMEOUT'))
+    else:
+        rate_limit_backend = MemoryRateLimitBackend()
+    return AdmissionController(rate_limit_backend, app.config.get('RATE_LIMITS', {}), cm.storage_latency,
+                               app.config.get('LOAD_SHEDDING_LATENCY_THRESHOLDS'),
+                               app.config.get('LOAD_SHEDDING_RETRY_AFTER', 1))
+
+
+def init_tracer(app: Flask):
+    if app.config.get('TRACING_OTLP_ENDPOINT'):
+        exporter = OTLPSpanExporter(app.config['TRACING_OTLP_ENDPOINT'])
+    elif app.config.get('TRACING_FILE'):
+        exporter = FileSpanExporter(app.config['TRACING_FILE'])
+    else:
+        return None
+    return Tracer(exporter, app.config.get('TRACING_SAMPLE_RATE', 0.01))
 
 
 def create_app(config: dict = None):
@@ -69,24 +157,39 @@ def create_app(config: dict = None):
 
     mako = MakoTemplates()
     mako.init_app(app)
-    app._mako_lookup = TemplateLookup(directories=[pkg_resources.resource_filename('cmservice.service', 'templates')],
+    app._mako_lookup = TemplateLookup(directories=[str(resources.files('cmservice.service') / 'templates')],
                                       input_encoding='utf-8', output_encoding='utf-8',
-                                      imports=['from flask_babel import gettext as _'])
+                                      imports=['from flask_babel import gettext as _',
+                                               'from cmservice.service.static_assets import static_url'])
+    app.static_assets = StaticAssets(app.config.get('STATIC_ASSETS_DIR') or
+                                     str(resources.files('cmservice.service') / 'site/static'))
 
     app.cm = init_consent_manager(app)
+    app.admission = init_admission_controller(app, app.cm)
+    app.tracer = init_tracer(app)
+    if app.tracer:
+        request_tracing.init_app(app, app.tracer)
+    request_logging.init_app(app)
 
     babel = Babel(app)
     babel.localeselector(get_locale)
-    app.config['BABEL_TRANSLATION_DIRECTORIES'] = pkg_resources.resource_filename('cmservice.service',
-                                                                                  'data/i18n/locales')
+    app.config['BABEL_TRANSLATION_DIRECTORIES'] = str(resources.files('cmservice.service') / 'data/i18n/locales')
 
     from .views import consent_views
+    from .health import health_views
     app.register_blueprint(consent_views)
+    app.register_blueprint(health_views)
+
+    setup_logging(app.config.get('LOGGING_LEVEL', 'INFO'), app.config.get('LOGGING_FORMAT', 'text'),
+                  app.config.get('LOGGING_FILE'), app.config.get('LOGGING_DEBUG_SAMPLE_RATES'))
 
-    setup_logging(app.config.get('LOGGING_LEVEL', 'INFO'))
+    app.warmed_up = False
+    if app.config.get('WARM_UP', True):
+        warm_up(app)
 
     logger = logging.getLogger(__name__)
-    logger.info("Running CMservice version %s", pkg_resources.get_distribution("CMservice").version)
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("Running CMservice version %s", metadata.version("CMservice"))
     return app
 
 
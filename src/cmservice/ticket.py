@@ -0,0 +1,151 @@
+import base64
+import binascii
+import hashlib
+import heapq
+import hmac
+import json
+import re
+import secrets
+import struct
+import threading
+import time
+import zlib
+from datetime import datetime
+
+from cmservice.consent_request import ConsentRequest
+
+
+class TicketGenerator(object):
+    """
+    Generates random consent request tickets, optionally bound to a secret key with an HMAC so forged
+    tickets can be rejected without looking them up.
+    """
+    TOKEN_BYTES = 32
+    MAC_BYTES = 16
+    TOKEN_PATTERN = re.compile(r'[A-Za-z0-9_-]{43}')
+    SIGNED_TOKEN_PATTERN = re.compile(r'([A-Za-z0-9_-]{43})\.([A-Za-z0-9_-]{22})')
+
+    def __init__(self, secret: str = None):
+        """
+        Constructor.
+        :param secret: key used to compute the HMAC of each ticket.
+                       If not specified tickets will only contain the random token.
+        """
+        self.secret = secret.encode('utf-8') if secret else None
+
+    def _mac(self, token: str) -> str:
+        mac = hmac.new(self.secret, token.encode('utf-8'), hashlib.sha256).digest()[:self.MAC_BYTES]
+        return base64.urlsafe_b64encode(mac).decode('utf-8').rstrip('=')
+
+    def new_ticket(self) -> str:
+        """
+        :return: a new unique ticket
+        """
+        token = secrets.token_urlsafe(self.TOKEN_BYTES)
+        if self.secret:
+            return '{}.{}'.format(token, self._mac(token))
+        return token
+
+    def is_well_formed(self, ticket: str) -> bool:
+        """
+        Checks whether a ticket could have been generated by this generator.
+        :param ticket: the ticket to check
+        :return: True if the ticket has the correct format (and HMAC), else False
+        """
+        if not self.secret:
+            return bool(self.TOKEN_PATTERN.fullmatch(ticket))
+
+        match = self.SIGNED_TOKEN_PATTERN.fullmatch(ticket)
+        return bool(match) and hmac.compare_digest(match.group(2), self._mac(match.group(1)))
+
+
+class StatelessTicketCodec(object):
+    """
+    Encodes consent requests into encrypted, authenticated and expiring tickets, so they don't need to be stored.
+
+    A ticket is the URL-safe base64 encoding of: version (1 byte), expiration time (8 bytes), nonce (12 bytes),
+    the AES-GCM encrypted consent request and the authentication tag (16 bytes).
+    Each ticket can only be decoded once by the same codec, as long as it has not expired.
+    """
+    VERSION = 1
+    HEADER = struct.Struct('>BQ')
+    NONCE_BYTES = 12
+    TAG_BYTES = 16
+
+    def __init__(self, key: str, ticket_ttl: int):
+        """
+        Constructor.
+        :param key: secret used to derive the encryption key
+        :param ticket_ttl: how long a ticket is valid in seconds
+        """
+        self.key = hashlib.sha256(('cmservice-ticket:' + key).encode('utf-8')).digest()
+        self.ticket_ttl = ticket_ttl
+        self._used_tickets = set()
+        self._used_tickets_expiry = []
+        self._lock = threading.Lock()
+
+    def encode(self, consent_request: ConsentRequest) -> str:
+        """
+        :param consent_request: the consent request to embed in the ticket
+        :return: a new ticket
+        """
+        from Cryptodome.Cipher import AES
+
+        header = self.HEADER.pack(self.VERSION, int(time.time()) + self.ticket_ttl)
+        nonce = secrets.token_bytes(self.NONCE_BYTES)
+        plaintext = zlib.compress(json.dumps({
+            'data': consent_request.data,
+            'timestamp': consent_request.timestamp.timestamp()
+        }).encode('utf-8'))
+
+        cipher = AES.new(self.key, AES.MODE_GCM, nonce=nonce, mac_len=self.TAG_BYTES)
+        cipher.update(header)
+        ciphertext, tag = cipher.encrypt_and_digest(plaintext)
+        return base64.urlsafe_b64encode(header + nonce + ciphertext + tag).decode('utf-8').rstrip('=')
+
+    def decode(self, ticket: str) -> ConsentRequest:
+        """
+        :param ticket: a ticket created by `encode`
+        :return: the embedded consent request, or None if the ticket is malformed, forged, expired or already used
+        """
+        try:
+            raw = base64.urlsafe_b64decode(ticket + '=' * (-len(ticket) % 4))
+        except (binascii.Error, ValueError):
+            return None
+        if len(raw) <= self.HEADER.size + self.NONCE_BYTES + self.TAG_BYTES:
+            return None
+
+        header = raw[:self.HEADER.size]
+        version, expires_at = self.HEADER.unpack(header)
+        if version != self.VERSION or expires_at < time.time():
+            return None
+
+        from Cryptodome.Cipher import AES
+
+        nonce = raw[self.HEADER.size:self.HEADER.size + self.NONCE_BYTES]
+        ciphertext, tag = raw[self.HEADER.size + self.NONCE_BYTES:-self.TAG_BYTES], raw[-self.TAG_BYTES:]
+        cipher = AES.new(self.key, AES.MODE_GCM, nonce=nonce, mac_len=self.TAG_BYTES)
+        cipher.update(header)
+        try:
+            plaintext = cipher.decrypt_and_verify(ciphertext, tag)
+        except ValueError:
+            return None
+
+        if not self._mark_used(tag, expires_at):
+            return None
+
+        payload = json.loads(zlib.decompress(plaintext).decode('utf-8'))
+        return ConsentRequest(payload['data'], timestamp=datetime.fromtimestamp(payload['timestamp']))
+
+    def _mark_used(self, tag: bytes, expires_at: int) -> bool:
+        with self._lock:
+            now = time.time()
+            while self._used_tickets_expiry and self._used_tickets_expiry[0][0] < now:
+                _, expired_tag = heapq.heappop(self._used_tickets_expiry)
+                self._used_tickets.discard(expired_tag)
+
+            if tag in self._used_tickets:
+                return False
+            self._used_tickets.add(tag)
+            heapq.heappush(self._used_tickets_expiry, (expires_at, tag))
+            return True
@@ -0,0 +1,372 @@
+import contextvars
+import functools
+import json
+import logging
+import os
+import queue
+import random
+import re
+import threading
+import time
+import urllib.request
+from contextlib import nullcontext
+
+logger = logging.getLogger(__name__)
+
+_current_span = contextvars.ContextVar('cmservice_current_span', default=None)
+
+# https://www.w3.org/TR/trace-context/#traceparent-header
+TRACEPARENT_PATTERN = re.compile(r'^([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$')
+SAMPLED_FLAG = 0x01
+
+
+def new_id(bits: int) -> str:
+    return '{:0{}x}'.format(random.getrandbits(bits) or 1, bits // 4)
+
+
+def parse_traceparent(traceparent: str):
+    """
+    :param traceparent: value of a W3C `traceparent` header
+    :return: a tuple of the trace id, the parent span id and whether the trace is sampled,
+             or None if the header is missing or invalid
+    """
+    match = TRACEPARENT_PATTERN.match(traceparent.strip().lower()) if traceparent else None
+    if not match:
+        return None
+    version, trace_id, parent_id, flags = match.groups()
+    if version == 'ff' or trace_id == '0' * 32 or parent_id == '0' * 16:
+        return None
+    return trace_id, parent_id, bool(int(flags, 16) & SAMPLED_FLAG)
+
+
+class Span(object):
+    """
+    A timed operation in a trace. It's used as a context manager, which makes it the current span while active.
+    """
+    __slots__ = ('tracer', 'name', 'trace_id', 'span_id', 'parent_id', 'attributes', 'start_time', 'end_time',
+                 'error', 'local_root', '_finished', '_token')
+
+    def __init__(self, tracer, name: str, trace_id: str, parent_id: str = None, attributes: dict = None,
+                 finished: list = None):
+        """
+        Constructor.
+        :param tracer: tracer exporting the span
+        :param name: name of the operation
+        :param trace_id: id of the trace the span belongs to
+        :param parent_id: id of the parent span, None for the root span of a trace in this process
+        :param attributes: attributes describing the operation
+        :param finished: finished spans of the trace, shared by all spans of it
+        """
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = new_id(64)
+        self.parent_id = parent_id
+        self.attributes = attributes or {}
+        self.start_time = None
+        self.end_time = None
+        self.error = None
+        self.local_root = finished is None
+        self._finished = [] if finished is None else finished
+        self._token = None
+
+    def child(self, name: str, attributes: dict = None):
+        """
+        :param name: name of the operation
+        :param attributes: attributes describing the operation
+        :return: a new span, with this span as parent
+        """
+        return Span(self.tracer, name, self.trace_id, self.span_id, attributes, self._finished)
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    @property
+    def traceparent(self) -> str:
+        """
+        :return: the W3C `traceparent` header identifying this span
+        """
+        return '00-{}-{}-{:02x}'.format(self.trace_id, self.span_id, SAMPLED_FLAG)
+
+    def __enter__(self):
+        self.start_time = time.time_ns()
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.end_time = time.time_ns()
+        if exc_value is not None:
+            self.error = repr(exc_value)
+        _current_span.reset(self._token)
+        self._finished.append(self)
+        if self.local_root:
+            self.tracer.export(self._finished)
+        return False
+
+    def to_dict(self) -> dict:
+        return {
+            'name': self.name,
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'start_time': self.start_time,
+            'end_time': self.end_time,
+            'duration_ms': (self.end_time - self.start_time) / 1e6,
+            'attributes': self.attributes,
+            'error': self.error,
+        }
+
+
+class SpanExporter(object):
+    def export(self, spans: list):
+        """
+        Exports the finished spans of a trace.
+        :param spans: the spans, each child before its parent
+        """
+        raise NotImplementedError("Must be implemented!")
+
+
+class BatchSpanExporter(SpanExporter):
+    """
+    Queues spans and exports them in batches from a background thread, so requests never wait for the export.
+    When the queue is full new spans are dropped.
+    """
+
+    def __init__(self, max_queue_size: int = 2048, max_batch_size: int = 512):
+        """
+        Constructor.
+        :param max_queue_size: maximum number of spans waiting to be exported
+        :param max_batch_size: maximum number of spans exported at once
+        """
+        self.max_batch_size = max_batch_size
+        self.dropped = 0
+        self._queue = queue.Queue(max_queue_size)
+        self._worker = None
+        self._worker_pid = None
+        self._lock = threading.Lock()
+
+    def export(self, spans: list):
+        self._ensure_worker()
+        for span in spans:
+            try:
+                self._queue.put_nowait(span)
+            except queue.Full:
+                self.dropped += 1
+
+    def send(self, spans: list):
+        """
+        Exports a batch of spans, called from the background thread.
+        :param spans: the spans to export
+        """
+        raise NotImplementedError("Must be implemented!")
+
+    def flush(self, timeout: float = None) -> bool:
+        """
+        Waits until the queued spans have been exported.
+        :param timeout: maximum number of seconds to wait, if not specified waits as long as it takes
+        :return: True if all spans have been exported, else False
+        """
+        with self._queue.all_tasks_done:
+            return self._queue.all_tasks_done.wait_for(lambda: not self._queue.unfinished_tasks, timeout)
+
+    def _ensure_worker(self):
+        # threads don't survive a fork, so a worker process started after the exporter was created needs its own
+        if self._worker_pid == os.getpid():
+            return
+        with self._lock:
+            if self._worker_pid != os.getpid():
+                if self._worker_pid is not None:
+                    # the queue may have been locked by the thread of the parent when the process forked
+                    self._queue = queue.Queue(self._queue.maxsize)
+                self._worker = threading.Thread(target=self._run, name=type(self).__name__, daemon=True)
+                self._worker.start()
+                self._worker_pid = os.getpid()
+
+    def _run(self):
+        span_queue = self._queue
+        while True:
+            batch = [span_queue.get()]
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.append(span_queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.send(batch)
+            except Exception:
+                logger.warning('failed to export %s spans', len(batch), exc_info=True)
+            for _ in batch:
+                span_queue.task_done()
+
+
+class FileSpanExporter(BatchSpanExporter):
+    """
+    Appends spans to a file, as one JSON object per line. Spans are written in batches by a background thread.
+    """
+
+    def __init__(self, path: str, max_queue_size: int = 2048, max_batch_size: int = 512):
+        """
+        Constructor.
+        :param path: path to the file
+        :param max_queue_size: maximum number of spans waiting to be written
+        :param max_batch_size: maximum number of spans written at once
+        """
+        super().__init__(max_queue_size, max_batch_size)
+        self.path = path
+
+    def send(self, spans: list):
+        lines = ''.join(json.dumps(span.to_dict()) + '\n' for span in spans)
+        with open(self.path, 'a') as f:
+            f.write(lines)
+
+
+class OTLPSpanExporter(BatchSpanExporter):
+    """
+    Sends spans to an OpenTelemetry collector, using OTLP over HTTP with JSON encoding.
+
+    Spans are queued and sent in batches by a background thread, so requests never wait for the collector.
+    When the queue is full new spans are dropped.
+    """
+
+    def __init__(self, endpoint: str, service_name: str = 'cmservice', max_queue_size: int = 2048,
+                 max_batch_size: int = 512, timeout: float = 5):
+        """
+        Constructor.
+        :param endpoint: URL to send the spans to, e.g. 'http://localhost:4318/v1/traces'
+        :param service_name: name of the service the spans are reported for
+        :param max_queue_size: maximum number of spans waiting to be sent
+        :param max_batch_size: maximum number of spans sent in one request
+        :param timeout: seconds to wait for the collector to respond
+        """
+        super().__init__(max_queue_size, max_batch_size)
+        self.endpoint = endpoint
+        self.service_name = service_name
+        self.timeout = timeout
+
+    def send(self, spans: list):
+        """
+        Sends spans to the collector.
+        :param spans: the spans to send
+        """
+        body = json.dumps(self.encode(spans)).encode('utf-8')
+        request = urllib.request.Request(self.endpoint, data=body, headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            response.read()
+
+    def encode(self, spans: list) -> dict:
+        """
+        :param spans: the spans to encode
+        :return: an OTLP `ExportTraceServiceRequest`, in its JSON form
+        """
+        return {
+            'resourceSpans': [{
+                'resource': {'attributes': [self._attribute('service.name', self.service_name)]},
+                'scopeSpans': [{
+                    'scope': {'name': 'cmservice'},
+                    'spans': [self._encode_span(span) for span in spans],
+                }],
+            }],
+        }
+
+    def _encode_span(self, span: Span) -> dict:
+        encoded = {
+            'traceId': span.trace_id,
+            'spanId': span.span_id,
+            'name': span.name,
+            # SPAN_KIND_SERVER for the span of the request, SPAN_KIND_INTERNAL for the rest
+            'kind': 2 if span.local_root else 1,
+            'startTimeUnixNano': str(span.start_time),
+            'endTimeUnixNano': str(span.end_time),
+            'attributes': [self._attribute(key, value) for key, value in span.attributes.items()],
+            'status': {'code': 2, 'message': span.error} if span.error else {'code': 1},
+        }
+        if span.parent_id:
+            encoded['parentSpanId'] = span.parent_id
+        return encoded
+
+    @staticmethod
+    def _attribute(key: str, value) -> dict:
+        if isinstance(value, bool):
+            return {'key': key, 'value': {'boolValue': value}}
+        if isinstance(value, int):
+            return {'key': key, 'value': {'intValue': str(value)}}
+        if isinstance(value, float):
+            return {'key': key, 'value': {'doubleValue': value}}
+        return {'key': key, 'value': {'stringValue': str(value)}}
+
+
+class Tracer(object):
+    def __init__(self, exporter: SpanExporter, sample_rate: float = 1.0):
+        """
+        Constructor.
+        :param exporter: exporter of finished traces
+        :param sample_rate: share of traces to record, unless the caller has decided with a `traceparent` header
+        """
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+
+    def start_trace(self, name: str, traceparent: str = None, attributes: dict = None) -> Span:
+        """
+        Creates the root span of a trace in this process, which is entered to start the trace.
+
+        :param name: name of the operation
+        :param traceparent: `traceparent` header of the request, if the trace was started by the caller
+        :param attributes: attributes describing the operation
+        :return: the span, or None if the trace is not sampled
+        """
+        parent = parse_traceparent(traceparent)
+        if parent:
+            trace_id, parent_id, sampled = parent
+        else:
+            trace_id, parent_id, sampled = None, None, random.random() < self.sample_rate
+        if not sampled:
+            return None
+        return Span(self, name, trace_id or new_id(128), parent_id, attributes)
+
+    def export(self, spans: list):
+        try:
+            self.exporter.export(spans)
+        except Exception:
+            logger.warning('failed to export trace', exc_info=True)
+
+
+def current_span() -> Span:
+    """
+    :return: the active span, or None if no trace is being recorded
+    """
+    return _current_span.get()
+
+
+def span(name: str, **attributes):
+    """
+    Context manager recording the enclosed block as a child of the current span.
+    Does nothing, at negligible cost, when no trace is being recorded.
+
+    :param name: name of the operation
+    :param attributes: attributes describing the operation
+    """
+    parent = _current_span.get()
+    if parent is None:
+        return nullcontext()
+    return parent.child(name, attributes)
+
+
+def traced(name: str = None):
+    """
+    Decorator recording calls of a function as spans.
+    :param name: name of the spans, if not specified the qualified name of the function will be used
+    """
+
+    def decorator(f):
+        span_name = name or f.__qualname__
+
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if _current_span.get() is None:
+                return f(*args, **kwargs)
+            with span(span_name):
+                return f(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,68 @@
+import os
+from unittest.mock import patch, Mock
+
+import pytest
+
+from cmservice.latency import LatencyMonitor
+from cmservice.service.admission import AdmissionController, MemoryRateLimitBackend, DatasetRateLimitBackend
+
+
+@pytest.fixture(params=['memory', 'dataset'])
+def rate_limit_backend(request, tmpdir):
+    if request.param == 'memory':
+        return MemoryRateLimitBackend()
+    return DatasetRateLimitBackend('sqlite:///' + os.path.join(str(tmpdir), 'rate_limit.db'))
+
+
+class TestRateLimitBackend(object):
+    def test_burst_is_allowed_then_limited(self, rate_limit_backend):
+        for _ in range(3):
+            assert rate_limit_backend.consume('client', 1, 3) == 0
+        assert rate_limit_backend.consume('client', 1, 3) > 0
+
+    def test_buckets_are_separate(self, rate_limit_backend):
+        assert rate_limit_backend.consume('client1', 1, 1) == 0
+        assert rate_limit_backend.consume('client1', 1, 1) > 0
+        assert rate_limit_backend.consume('client2', 1, 1) == 0
+
+    def test_tokens_are_refilled(self, rate_limit_backend):
+        assert rate_limit_backend.consume('client', 1000, 1) == 0
+        assert rate_limit_backend.consume('client', 0.001, 1) > 0
+        with patch('cmservice.service.admission.time') as mock_time:
+            mock_time.monotonic.return_value = 10 ** 10
+            mock_time.time.return_value = 10 ** 10
+            assert rate_limit_backend.consume('client', 1, 1) == 0
+
+    def test_dataset_backend_is_shared(self, tmpdir):
+        db_url = 'sqlite:///' + os.path.join(str(tmpdir), 'rate_limit.db')
+        assert DatasetRateLimitBackend(db_url).consume('client', 1, 1) == 0
+        assert DatasetRateLimitBackend(db_url).consume('client', 1, 1) > 0
+
+
+class TestAdmissionController(object):
+    def test_admit_within_rate_limit(self):
+        controller = AdmissionController(MemoryRateLimitBackend(), {'verify': [1, 1]}, LatencyMonitor())
+        assert controller.admit('verify', 'client') is None
+        assert controller.admit('verify', 'client') == (429, 1)
+        assert controller.admit('creq', 'client') is None
+
+    def test_admit_when_rate_limit_database_is_unavailable(self, tmpdir):
+        backend = DatasetRateLimitBackend('sqlite:///' + os.path.join(str(tmpdir), 'missing', 'rate_limit.db'))
+        controller = AdmissionController(backend, {'verify': [1, 1]}, LatencyMonitor())
+        assert controller.admit('verify', 'client') is None
+
+    def test_programming_errors_are_raised(self):
+        backend = Mock(consume=Mock(side_effect=TypeError()))
+        controller = AdmissionController(backend, {'verify': [1, 1]}, LatencyMonitor())
+        with pytest.raises(TypeError):
+            controller.admit('verify', 'client')
+
+    @pytest.mark.parametrize('latency, expected', [
+        (0.01, None),
+        (2.0, (503, 5)),
+    ])
+    def test_shed_load_when_storage_is_slow(self, latency, expected):
+        storage_latency = Mock(average=latency)
+        controller = AdmissionController(MemoryRateLimitBackend(), {}, storage_latency, [0.1, 1.0], 5)
+        assert controller.admit('verify', 'client') == expected
+
@@ -0,0 +1,58 @@
+from unittest.mock import patch
+
+import pytest
+
+from cmservice.service.wsgi import create_app
+
+
+class TestHealth(object):
+    @pytest.fixture(autouse=True)
+    def create_test_client(self, app_config):
+        self.app_config = app_config
+        self.flask_app = create_app(config=app_config)
+        self.app = self.flask_app.test_client()
+
+    def test_live(self):
+        resp = self.app.get('/health/live')
+        assert resp.status_code == 200
+        assert resp.json['status'] == 'alive'
+
+    def test_ready(self):
+        resp = self.app.get('/health/ready')
+        assert resp.status_code == 200
+        assert resp.json['status'] == 'ready'
+        assert resp.json['storage_latency'] >= 0
+        assert resp.json['circuit_breakers']['consent_db']['state'] == 'closed'
+        assert resp.cache_control.no_store
+
+    def test_not_ready_when_storage_is_unavailable(self):
+        with patch.object(self.flask_app.cm, 'probe_storage', side_effect=Exception('connection refused')):
+            resp = self.app.get('/health/ready')
+        assert resp.status_code == 503
+
+    def test_not_ready_when_storage_is_slow(self):
+        self.flask_app.config['READINESS_MAX_STORAGE_LATENCY'] = 0.5
+        with patch.object(self.flask_app.cm, 'probe_storage', return_value=1.0):
+            resp = self.app.get('/health/ready')
+        assert resp.status_code == 503
+        assert resp.json['storage_latency'] == 1.0
+
+
+class TestWarmUp(object):
+    def test_app_is_warmed_up_when_created(self, app_config):
+        app = create_app(config=app_config)
+        assert app.warmed_up
+        assert app._mako_lookup.has_template('consent.mako')
+        assert 'consent.mako' in app._mako_lookup._collection
+
+    def test_warm_up_can_be_disabled(self, app_config):
+        app_config['WARM_UP'] = False
+        app = create_app(config=app_config)
+        assert not app.warmed_up
+        assert 'consent.mako' not in app._mako_lookup._collection
+
+    def test_app_is_warmed_up_before_it_is_ready(self, app_config):
+        app_config['WARM_UP'] = False
+        app = create_app(config=app_config)
+        assert app.test_client().get('/health/ready').status_code == 200
+        assert app.warmed_up
@@ -0,0 +1,40 @@
+import logging
+
+import pytest
+from flask import Flask
+
+from cmservice.log import RequestContextFilter
+from cmservice.service import request_logging
+
+
+class TestRequestLogging(object):
+    @pytest.fixture(autouse=True)
+    def create_test_client(self):
+        self.records = []
+        app = Flask(__name__)
+
+        @app.route('/')
+        def index():
+            record = logging.LogRecord('cmservice.test', logging.INFO, __file__, 1, 'message', None, None)
+            RequestContextFilter().filter(record)
+            self.records.append(record)
+            return 'ok'
+
+        request_logging.init_app(app)
+        self.app = app.test_client()
+
+    def test_request_id_is_generated(self):
+        first, second = self.app.get('/'), self.app.get('/')
+        assert first.headers['X-Request-ID'] != second.headers['X-Request-ID']
+        assert [record.request_id for record in self.records] == [first.headers['X-Request-ID'],
+                                                                  second.headers['X-Request-ID']]
+
+    def test_request_id_from_header_is_kept(self):
+        resp = self.app.get('/', headers={'X-Request-ID': 'lb-1234'})
+        assert resp.headers['X-Request-ID'] == 'lb-1234'
+        assert self.records[0].request_id == 'lb-1234'
+
+    def test_malformed_request_id_is_replaced(self):
+        resp = self.app.get('/', headers={'X-Request-ID': 'id with spaces'})
+        assert resp.headers['X-Request-ID'] != 'id with spaces'
+        assert self.records[0].request_id == resp.headers['X-Request-ID']
@@ -0,0 +1,88 @@
+import json
+import os
+
+import pytest
+from jwkest.jwk import RSAKey, rsa_load
+from jwkest.jws import JWS
+
+from cmservice.service.wsgi import create_app
+
+TRACE_ID = '4bf92f3577b34da6a3ce929d0e0e4736'
+PARENT_ID = '00f067aa0ba902b7'
+
+
+class TestRequestTracing(object):
+    @pytest.fixture(autouse=True)
+    def create_test_client(self, app_config, cert_and_key, tmpdir):
+        self.trace_file = str(tmpdir.join('spans.jsonl'))
+        app_config['TRACING_FILE'] = self.trace_file
+        app_config['TRACING_SAMPLE_RATE'] = 1.0
+        self.flask_app = create_app(config=app_config)
+        self.app = self.flask_app.test_client()
+        self.signing_key = RSAKey(key=rsa_load(cert_and_key[1]), alg='RS256')
+
+    def traces(self):
+        assert self.flask_app.tracer.exporter.flush(5)
+        traces = {}
+        with open(self.trace_file) as f:
+            for line in f:
+                span = json.loads(line)
+                traces.setdefault(span['trace_id'], []).append(span)
+        return list(traces.values())
+
+    def request_ticket(self):
+        consent_args = {
+            'attr': {'k0': ['v0']},
+            'id': 'test_id',
+            'redirect_endpoint': 'https://client.example.com/callback',
+            'requester_name': [{'text': 'requester', 'lang': 'en'}]
+        }
+        jws = JWS(json.dumps(consent_args), alg=self.signing_key.alg).sign_compact([self.signing_key])
+        return self.app.get('/creq/{}'.format(jws)).data.decode('utf-8')
+
+    def test_consent_request_is_traced(self):
+        ticket = self.request_ticket()
+        resp = self.app.get('/consent/{}'.format(ticket))
+        assert resp.status_code == 200
+
+        creq_trace, consent_trace = self.traces()
+        assert {span['name'] for span in creq_trace} >= {'GET /creq/<jwt>', 'ConsentManager.save_consent_request',
+                                                         'jwt.verify', 'ConsentRequestDB.save_consent_request'}
+
+        spans = {span['name']: span for span in consent_trace}
+        root = spans['GET /consent/<ticket>']
+        assert root['parent_id'] is None
+        assert root['attributes'] == {'http.method': 'GET', 'http.route': '/consent/<ticket>',
+                                      'http.status_code': 200}
+        fetch = spans['ConsentManager.fetch_consent_request']
+        assert fetch['parent_id'] == root['span_id']
+        assert spans['ConsentRequestDB.get_consent_request']['parent_id'] == fetch['span_id']
+        assert spans['ConsentRequestDB.remove_consent_request']['parent_id'] == fetch['span_id']
+        assert spans['render_template']['parent_id'] == root['span_id']
+        assert spans['session.open']['parent_id'] == root['span_id']
+        assert spans['session.save']['parent_id'] == root['span_id']
+
+    def test_tickets_are_not_recorded(self):
+        ticket = self.request_ticket()
+        self.app.get('/consent/{}'.format(ticket))
+        assert self.flask_app.tracer.exporter.flush(5)
+        with open(self.trace_file) as f:
+            assert ticket not in f.read()
+
+    def test_trace_context_is_propagated(self):
+        self.app.get('/verify/unknown', headers={'traceparent': '00-{}-{}-01'.format(TRACE_ID, PARENT_ID)})
+
+        trace, = self.traces()
+        root = trace[-1]
+        assert root['trace_id'] == TRACE_ID
+        assert root['parent_id'] == PARENT_ID
+        assert root['attributes']['http.status_code'] == 401
+
+    def test_unsampled_request_is_not_traced(self):
+        self.app.get('/verify/unknown', headers={'traceparent': '00-{}-{}-00'.format(TRACE_ID, PARENT_ID)})
+        assert self.flask_app.tracer.exporter.flush(5)
+        assert not os.path.exists(self.trace_file)
+
+    def test_tracing_is_disabled_by_default(self, app_config):
+        del app_config['TRACING_FILE']
+        assert create_app(config=app_config).tracer is None
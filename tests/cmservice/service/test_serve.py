@@ -0,0 +1,80 @@
+import json
+
+import pytest
+
+from cmservice.service.serve import gunicorn_options, load_config, main
+
+
+@pytest.fixture
+def config():
+    return {'HOST': '0.0.0.0', 'PORT': 8166, 'SSL': False}
+
+
+class TestGunicornOptions(object):
+    @pytest.mark.parametrize('worker_class, workers, concurrency', [
+        ('sync', 9, {}),
+        ('gthread', 5, {'threads': 4}),
+        ('gevent', 4, {'worker_connections': 256}),
+    ])
+    def test_defaults_depend_on_cpu_count(self, config, worker_class, workers, concurrency):
+        config['SERVER_WORKER_CLASS'] = worker_class
+        options = gunicorn_options(config, cpu_count=4)
+        assert options['workers'] == workers
+        for key, value in concurrency.items():
+            assert options[key] == value
+
+    def test_defaults(self, config):
+        options = gunicorn_options(config, cpu_count=2)
+        assert options['bind'] == '0.0.0.0:8166'
+        assert options['worker_class'] == 'gthread'
+        assert options['preload_app']
+        assert options['max_requests'] == 10000
+        assert options['max_requests_jitter'] == 1000
+        assert options['keepalive'] == 5
+        assert 'certfile' not in options
+
+    def test_settings_override_defaults(self, config):
+        config.update(SERVER_WORKER_CLASS='sync', SERVER_WORKERS=3, SERVER_PRELOAD=False, SERVER_MAX_REQUESTS=500,
+                      SERVER_KEEPALIVE=75)
+        options = gunicorn_options(config, cpu_count=4)
+        assert options['workers'] == 3
+        assert not options['preload_app']
+        assert options['max_requests'] == 500
+        assert options['max_requests_jitter'] == 50
+        assert options['keepalive'] == 75
+        assert 'threads' not in options
+
+    def test_ssl(self, config):
+        config.update(SSL=True, SERVER_CERT='server.crt', SERVER_KEY='server.key')
+        options = gunicorn_options(config, cpu_count=1)
+        assert options['certfile'] == 'server.crt'
+        assert options['keyfile'] == 'server.key'
+
+    def test_unknown_worker_class(self, config):
+        config['SERVER_WORKER_CLASS'] = 'eventlet'
+        with pytest.raises(ValueError):
+            gunicorn_options(config)
+
+
+class TestMain(object):
+    @pytest.fixture
+    def config_path(self, tmpdir):
+        path = tmpdir.join('settings.cfg')
+        path.write('HOST = "127.0.0.1"\nPORT = 8000\nSSL = False\nSERVER_WORKERS = 2\nlowercase = 1\n')
+        return str(path)
+
+    def test_load_config(self, config_path):
+        assert load_config(config_path) == {'HOST': '127.0.0.1', 'PORT': 8000, 'SSL': False, 'SERVER_WORKERS': 2}
+
+    def test_print_options(self, config_path, capsys):
+        main(['--config', config_path, '--worker-class', 'sync', '--no-preload', '--print-options'])
+        options = json.loads(capsys.readouterr().out)
+        assert options['bind'] == '127.0.0.1:8000'
+        assert options['worker_class'] == 'sync'
+        assert options['workers'] == 2
+        assert not options['preload_app']
+
+    def test_config_is_required(self, monkeypatch):
+        monkeypatch.delenv('CMSERVICE_CONFIG', raising=False)
+        with pytest.raises(SystemExit):
+            main(['--print-options'])
@@ -0,0 +1,33 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+STARTUP_BENCHMARK = os.path.join(os.path.dirname(__file__), '..', '..', '..', 'benchmarks', 'startup.py')
+STARTUP_BUDGET = float(os.environ.get('CMSERVICE_STARTUP_BUDGET', 2.0))
+
+
+@pytest.fixture(scope='module')
+def startup():
+    output = subprocess.check_output([sys.executable, STARTUP_BENCHMARK, '--runs', '3', '--json'])
+    return json.loads(output.decode('utf-8'))
+
+
+class TestStartup(object):
+    @pytest.mark.benchmark
+    @pytest.mark.parametrize('setting', ['no_warm_up', 'warm_up'])
+    def test_startup_is_within_budget(self, startup, setting):
+        assert startup[setting]['total'] < STARTUP_BUDGET
+
+    @pytest.mark.parametrize('module', [
+        'pkg_resources',
+        'dataset',
+        'sqlalchemy',
+        'alembic',
+        'Cryptodome.Cipher',
+    ])
+    def test_heavy_modules_are_not_imported_before_first_use(self, startup, module):
+        # warming up the app uses them
+        assert module not in startup['no_warm_up']['modules']
@@ -0,0 +1,67 @@
+import gzip
+import json
+import os
+
+import pytest
+from flask import Flask
+from werkzeug.datastructures import Accept
+
+from cmservice.service.static_assets import StaticAssets, build, fingerprinted_name
+
+
+@pytest.fixture
+def asset_dir(tmpdir):
+    directory = tmpdir.mkdir('static')
+    directory.join('style.css').write('body { color: black; }' * 10)
+    return str(directory)
+
+
+@pytest.fixture
+def app():
+    app = Flask(__name__)
+    with app.app_context():
+        yield app
+
+
+class TestStaticAssets(object):
+    def test_url_is_fingerprinted_with_content_hash(self, asset_dir):
+        assets = StaticAssets(asset_dir)
+        url = assets.url('style.css')
+        assert url == '/static/' + fingerprinted_name('style.css', b'body { color: black; }' * 10)
+
+    def test_fingerprinted_asset_is_immutable(self, asset_dir, app):
+        assets = StaticAssets(asset_dir)
+        response = assets.response(assets.url('style.css')[len('/static/'):], Accept())
+        assert response.cache_control.immutable
+        assert response.cache_control.max_age == 365 * 24 * 60 * 60
+        assert response.mimetype == 'text/css'
+
+    def test_unfingerprinted_asset_is_not_immutable(self, asset_dir, app):
+        response = StaticAssets(asset_dir).response('style.css', Accept())
+        assert not response.cache_control.immutable
+        assert response.get_etag()[0]
+
+    def test_gzip_variant_is_served_if_accepted(self, asset_dir, app):
+        response = StaticAssets(asset_dir).response('style.css', Accept([('gzip', 1)]))
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert gzip.decompress(response.get_data()) == b'body { color: black; }' * 10
+
+    def test_unknown_asset(self, asset_dir):
+        assert StaticAssets(asset_dir).response('unknown.css', Accept()) is None
+
+
+class TestBuild(object):
+    def test_build_writes_fingerprinted_and_precompressed_files(self, asset_dir, tmpdir, app):
+        destination = str(tmpdir.join('build'))
+        manifest = build(asset_dir, destination)
+
+        fingerprinted = manifest['style.css']
+        assert os.path.exists(os.path.join(destination, fingerprinted))
+        assert os.path.exists(os.path.join(destination, fingerprinted + '.gz'))
+        with open(os.path.join(destination, 'manifest.json')) as f:
+            assert json.load(f) == manifest
+
+        assets = StaticAssets(destination)
+        assert assets.url('style.css') == StaticAssets(asset_dir).url('style.css')
+        response = assets.response(fingerprinted, Accept([('gzip', 1)]))
+        assert gzip.decompress(response.get_data()) == b'body { color: black; }' * 10
@@ -1,6 +1,8 @@
+from datetime import datetime
 from unittest.mock import patch
 
-from cmservice.service.views import find_requester_name, render_consent
+from cmservice.consent import Consent
+from cmservice.service.views import find_requester_name, render_consent, consent_etag
 
 
 class TestFindRequesterName(object):
@@ -28,3 +30,15 @@ class TestRenderConsent(object):
         kwargs = m.call_args[1]
         assert kwargs['locked_claims'] == locked_claims
         assert kwargs['released_claims'] == released_claims
+
+
+class TestConsentEtag(object):
+    def test_etag_is_stable_for_same_consent(self):
+        timestamp = datetime(2016, 1, 1)
+        assert consent_etag(Consent(['foo'], 3, timestamp)) == consent_etag(Consent(['foo'], 6, timestamp))
+
+    def test_etag_changes_with_attributes_or_timestamp(self):
+        timestamp = datetime(2016, 1, 1)
+        etag = consent_etag(Consent(['foo'], 3, timestamp))
+        assert etag != consent_etag(Consent(['foo', 'bar'], 3, timestamp))
+        assert etag != consent_etag(Consent(['foo'], 3, datetime(2016, 1, 2)))
@@ -1,4 +1,5 @@
 import json
+from unittest.mock import patch
 from urllib.parse import urlencode
 
 import flask
@@ -6,15 +7,25 @@ import pytest
 from jwkest.jwk import RSAKey, rsa_load
 from jwkest.jws import JWS
 
+from cmservice.consent import Consent
 from cmservice.service.wsgi import create_app
 
 
 class TestWSGIApp:
     @pytest.fixture(autouse=True)
     def create_test_client(self, app_config, cert_and_key):
-        self.app = create_app(config=app_config).test_client()
+        self.flask_app = create_app(config=app_config)
+        self.app = self.flask_app.test_client()
         self.signing_key = RSAKey(key=rsa_load(cert_and_key[1]), alg='RS256')
 
+    @pytest.fixture(params=[False, True], ids=['stored_tickets', 'stateless_tickets'])
+    def stateless_tickets(self, request, app_config):
+        if request.param:
+            app_config['STATELESS_TICKET_KEY'] = 'secret'
+            self.flask_app = create_app(config=app_config)
+            self.app = self.flask_app.test_client()
+
+    @pytest.mark.usefixtures('stateless_tickets')
     def test_full_flow(self):
         id = 'test_id'
         attributes = {
@@ -60,3 +71,125 @@ class TestWSGIApp:
         path = '/verify/{}'.format(id)
         resp = self.app.get(path)
         assert json.loads(resp.data.decode('utf-8')) == consented_attributes
+
+    def test_verify_should_honour_if_none_match(self):
+        id = 'test_id'
+        self.flask_app.cm.save_consent(id, Consent(['k0', 'k1'], 3))
+
+        resp = self.app.get('/verify/{}'.format(id))
+        assert resp.status_code == 200
+        etag = resp.headers['ETag']
+        assert 0 < resp.cache_control.max_age <= 4 * 31 * 24 * 60 * 60
+
+        resp = self.app.get('/verify/{}'.format(id), headers={'If-None-Match': etag})
+        assert resp.status_code == 304
+        assert resp.headers['ETag'] == etag
+        assert not resp.data
+
+    def test_verify_max_age_should_be_bounded_by_config(self):
+        id = 'test_id'
+        self.flask_app.config['VERIFY_MAX_AGE'] = 60
+        self.flask_app.cm.save_consent(id, Consent(['k0'], 3))
+
+        resp = self.app.get('/verify/{}'.format(id))
+        assert resp.cache_control.max_age == 60
+
+    def test_verify_should_be_rate_limited(self):
+        self.flask_app.admission.rate_limits = {'verify': [1, 2]}
+        assert self.app.get('/verify/unknown').status_code == 401
+        assert self.app.get('/verify/unknown').status_code == 401
+        resp = self.app.get('/verify/unknown')
+        assert resp.status_code == 429
+        assert int(resp.headers['Retry-After']) >= 1
+
+    def test_verify_is_admitted_when_rate_limit_database_is_unavailable(self, app_config, tmpdir):
+        app_config['RATE_LIMITS'] = {'verify': [1, 2]}
+        app_config['RATE_LIMIT_DATABASE_URL'] = 'sqlite:///' + str(tmpdir.join('missing', 'rate_limit.db'))
+        app_config['STORAGE_TIMEOUT'] = 1.5
+        app = create_app(config=app_config)
+        assert app.admission.rate_limit_backend._connection.timeout == 1.5
+        assert app.test_client().get('/verify/unknown').status_code == 401
+
+    def test_verify_should_fail_fast_when_storage_is_unavailable(self):
+        with patch.object(self.flask_app.cm.consent_db, 'get_consent', side_effect=IOError('timeout')):
+            statuses = [self.app.get('/verify/test_id').status_code for _ in range(6)]
+        assert statuses == [503] * 6
+        assert self.flask_app.cm.consent_db_breaker.state == 'open'
+        resp = self.app.get('/verify/test_id')
+        assert resp.status_code == 503
+        assert int(resp.headers['Retry-After']) > 1
+
+    def test_verify_should_answer_from_stale_consents_when_storage_is_unavailable(self, app_config):
+        app_config['VERIFY_MAX_STALENESS'] = 60
+        app = create_app(config=app_config).test_client()
+        app.application.cm.save_consent('test_id', Consent(['k0'], 3))
+        with patch.object(app.application.cm.consent_db, 'get_consent', side_effect=IOError('timeout')):
+            resp = app.get('/verify/test_id')
+        assert resp.status_code == 200
+        assert json.loads(resp.data.decode('utf-8')) == ['k0']
+
+    def test_consent_page_references_fingerprinted_stylesheet(self):
+        consent_args = {
+            'attr': {'k0': ['v0']},
+            'id': 'test_id',
+            'redirect_endpoint': 'https://client.example.com/callback',
+            'requester_name': [{'text': 'requester', 'lang': 'en'}]
+        }
+        jws = JWS(json.dumps(consent_args), alg=self.signing_key.alg).sign_compact([self.signing_key])
+        ticket = self.app.get('/creq/{}'.format(jws)).data.decode('utf-8')
+        resp = self.app.get('/consent/{}'.format(ticket))
+        assert resp.status_code == 200
+
+        stylesheet_url = self.flask_app.static_assets.url('style.css')
+        assert stylesheet_url != '/static/style.css'
+        assert 'href="{}"'.format(stylesheet_url) in resp.data.decode('utf-8')
+
+        resp = self.app.get(stylesheet_url)
+        assert resp.status_code == 200
+        assert resp.cache_control.immutable
+
+    def test_consent_database_class_can_be_configured(self, app_config, tmpdir):
+        app_config['CONSENT_DATABASE_CLASS'] = 'cmservice.memory_database.ConsentMemoryDB'
+        app_config['CONSENT_DATABASE_CLASS_ARGS'] = [str(tmpdir)]
+        app = create_app(config=app_config)
+        assert type(app.cm.consent_db).__name__ == 'ConsentMemoryDB'
+        assert app.cm.consent_db.data_dir == str(tmpdir)
+
+    def test_memory_consent_database_is_refused_with_several_workers(self, app_config):
+        app_config['CONSENT_DATABASE_CLASS'] = 'cmservice.memory_database.ConsentMemoryDB'
+        app_config['SERVER_WORKERS'] = 2
+        with pytest.raises(ValueError):
+            create_app(config=app_config)
+
+    @pytest.mark.parametrize('config', [
+        {'SERVER_WORKERS': 2},
+        {'INVALIDATION_DATABASE_URL': 'sqlite://'},
+    ])
+    def test_bloom_filter_is_refused_without_immediate_invalidation(self, app_config, config):
+        app_config['CONSENT_BLOOM_FILTER_ERROR_RATE'] = 0.01
+        app_config.update(config)
+        with pytest.raises(ValueError):
+            create_app(config=app_config)
+
+    def test_bloom_filter_with_several_workers_needs_socket_bus(self, app_config, tmpdir):
+        app_config['CONSENT_BLOOM_FILTER_ERROR_RATE'] = 0.01
+        app_config['SERVER_WORKERS'] = 2
+        app_config['INVALIDATION_SOCKET_DIR'] = str(tmpdir.join('sockets'))
+        app = create_app(config=app_config)
+        assert app.cm.consent_db.known_ids is not None
+        app.cm.consent_db.invalidation_bus.close()
+
+    def test_invalidation_bus_can_be_configured(self, app_config, tmpdir):
+        app_config['INVALIDATION_SOCKET_DIR'] = str(tmpdir.join('sockets'))
+        app = create_app(config=app_config)
+        bus = app.cm.consent_db.invalidation_bus
+        assert bus.socket_dir == str(tmpdir.join('sockets'))
+        assert len(tmpdir.join('sockets').listdir()) == 1
+        bus.close()
+
+    def test_invalidation_bus_of_preloaded_app_is_started_after_fork(self, app_config, tmpdir):
+        app_config['INVALIDATION_SOCKET_DIR'] = str(tmpdir.join('sockets'))
+        app_config['INVALIDATION_START_AFTER_FORK'] = True
+        app = create_app(config=app_config)
+        assert app.cm.consent_db.invalidation_bus._start_in_children
+        assert not tmpdir.join('sockets').exists()
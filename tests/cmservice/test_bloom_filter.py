@@ -0,0 +1,30 @@
+import pytest
+
+from cmservice.bloom_filter import BloomFilter
+
+
+class TestBloomFilter(object):
+    def test_added_items_are_always_found(self):
+        bloom_filter = BloomFilter(1000, 0.01)
+        items = ['item_{}'.format(i) for i in range(1000)]
+        for item in items:
+            bloom_filter.add(item)
+        assert all(item in bloom_filter for item in items)
+        assert len(bloom_filter) == 1000
+
+    def test_false_positive_rate_is_close_to_configured(self):
+        bloom_filter = BloomFilter(1000, 0.01)
+        for i in range(1000):
+            bloom_filter.add('item_{}'.format(i))
+        false_positives = sum('other_{}'.format(i) in bloom_filter for i in range(10000))
+        assert false_positives / 10000 < 0.03
+        assert bloom_filter.false_positive_rate == pytest.approx(0.01, rel=0.2)
+
+    @pytest.mark.parametrize('capacity, error_rate', [
+        (0, 0.01),
+        (10, 0),
+        (10, 1),
+    ])
+    def test_invalid_parameters(self, capacity, error_rate):
+        with pytest.raises(ValueError):
+            BloomFilter(capacity, error_rate)
@@ -0,0 +1,145 @@
+from datetime import datetime, timedelta
+from unittest.mock import Mock, patch
+
+import pytest
+
+from cmservice.circuit_breaker import CircuitBreaker, CircuitOpenError, StaleConsentCache
+from cmservice.consent import Consent
+
+
+def fail(breaker: CircuitBreaker):
+    with pytest.raises(IOError):
+        with breaker.guard():
+            raise IOError('timeout')
+
+
+def succeed(breaker: CircuitBreaker):
+    with breaker.guard():
+        pass
+
+
+class TestCircuitBreaker(object):
+    def test_opens_after_consecutive_failures(self):
+        breaker = CircuitBreaker('db', failure_threshold=2)
+        fail(breaker)
+        assert breaker.state == CircuitBreaker.CLOSED
+        fail(breaker)
+        assert breaker.state == CircuitBreaker.OPEN
+
+        with pytest.raises(CircuitOpenError) as exc_info:
+            succeed(breaker)
+        assert 0 < exc_info.value.retry_after <= 30
+
+    def test_success_resets_failure_count(self):
+        breaker = CircuitBreaker('db', failure_threshold=2)
+        fail(breaker)
+        succeed(breaker)
+        fail(breaker)
+        assert breaker.state == CircuitBreaker.CLOSED
+
+    def test_slow_calls_count_as_failures(self):
+        breaker = CircuitBreaker('db', failure_threshold=1, slow_call_duration=1)
+        with patch('cmservice.circuit_breaker.time.monotonic', side_effect=[0, 2, 2]):
+            succeed(breaker)
+        assert breaker.state == CircuitBreaker.OPEN
+
+    def test_successful_trial_call_closes_circuit(self):
+        breaker = CircuitBreaker('db', failure_threshold=1, reset_timeout=0)
+        fail(breaker)
+        succeed(breaker)
+        assert breaker.state == CircuitBreaker.CLOSED
+        assert [(t['from'], t['to']) for t in breaker.transitions] == [
+            ('closed', 'open'), ('open', 'half_open'), ('half_open', 'closed')]
+
+    def test_failed_trial_call_opens_circuit(self):
+        breaker = CircuitBreaker('db', failure_threshold=1, reset_timeout=0)
+        fail(breaker)
+        fail(breaker)
+        assert breaker.state == CircuitBreaker.OPEN
+
+    def test_only_one_trial_call_at_a_time(self):
+        breaker = CircuitBreaker('db', failure_threshold=1, reset_timeout=0)
+        fail(breaker)
+        with breaker.guard():
+            with pytest.raises(CircuitOpenError):
+                succeed(breaker)
+
+    def test_interrupted_trial_call_lets_another_through(self):
+        breaker = CircuitBreaker('db', failure_threshold=1, reset_timeout=0)
+        fail(breaker)
+        with pytest.raises(KeyboardInterrupt):
+            with breaker.guard():
+                raise KeyboardInterrupt()
+        succeed(breaker)
+        assert breaker.state == CircuitBreaker.CLOSED
+
+    def test_exceptions_which_are_not_failures_are_ignored(self):
+        breaker = CircuitBreaker('db', failure_threshold=1, reset_timeout=0,
+                                 is_failure=lambda e: isinstance(e, IOError))
+        with pytest.raises(TypeError):
+            with breaker.guard():
+                raise TypeError()
+        assert breaker.state == CircuitBreaker.CLOSED
+        fail(breaker)
+        with pytest.raises(TypeError):
+            with breaker.guard():
+                raise TypeError()
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        succeed(breaker)
+        assert breaker.state == CircuitBreaker.CLOSED
+
+    def test_listeners_are_notified_of_transitions(self):
+        listener = Mock()
+        breaker = CircuitBreaker('db', failure_threshold=1)
+        breaker.listeners.append(listener)
+        fail(breaker)
+        listener.assert_called_once_with(breaker, CircuitBreaker.CLOSED, CircuitBreaker.OPEN)
+
+    def test_stats(self):
+        breaker = CircuitBreaker('db', failure_threshold=2)
+        fail(breaker)
+        assert breaker.stats() == {'state': 'closed', 'consecutive_failures': 1, 'transitions': []}
+
+
+class TestStaleConsentCache(object):
+    def test_get_cached_consent(self):
+        cache = StaleConsentCache(60)
+        consent = Consent(['a'], 1)
+        cache.put('id1', consent)
+        assert cache.get('id1', 12) == consent
+        assert cache.get('id2', 12) is None
+
+    def test_too_stale_consent_is_not_used(self):
+        cache = StaleConsentCache(60)
+        with patch('cmservice.circuit_breaker.time.monotonic', return_value=0):
+            cache.put('id1', Consent(['a'], 1))
+        with patch('cmservice.circuit_breaker.time.monotonic', return_value=61):
+            assert cache.get('id1', 12) is None
+
+    def test_expired_consent_is_not_used(self):
+        cache = StaleConsentCache(60)
+        cache.put('id1', Consent(['a'], 1, datetime.now() - timedelta(days=62)))
+        assert cache.get('id1', 12) is None
+
+    def test_removed_consent_is_not_used(self):
+        cache = StaleConsentCache(60)
+        cache.put('id1', Consent(['a'], 1))
+        cache.put('id1', None)
+        assert cache.get('id1', 12) is None
+
+    def test_size_is_bounded(self):
+        cache = StaleConsentCache(60, max_size=2)
+        for id in ['id1', 'id2', 'id3']:
+            cache.put(id, Consent(['a'], 1))
+        assert cache.get('id1', 12) is None
+        assert cache.get('id3', 12) is not None
+
+    def test_invalidated_consent_is_not_used(self):
+        cache = StaleConsentCache(60)
+        for id in ['id1', 'id2', 'id3']:
+            cache.put(id, Consent(['a'], 1))
+        cache.invalidate('id1')
+        assert cache.get('id1', 12) is None
+        assert cache.get('id2', 12) is not None
+        cache.invalidate(None)
+        assert cache.get('id2', 12) is None
@@ -0,0 +1,88 @@
+import base64
+import json
+
+import pytest
+
+from cmservice import codec as codec_module
+from cmservice.codec import Codec, MissingExtraError
+
+VALUE = {
+    'id': 'test_id',
+    'redirect_endpoint': 'https://client.example.com/redirect',
+    'attr': {'mail': ['user{}@example.com'.format(i) for i in range(100)], 'name': ['Åsa']},
+}
+
+
+def available_serializers():
+    serializers = ['json']
+    for serializer in ['orjson', 'msgpack']:
+        try:
+            Codec(serializer, allow_extra_formats=True)
+            serializers.append(serializer)
+        except ValueError:
+            pass
+    return serializers
+
+
+def available_compressions():
+    compressions = [None, 'zlib']
+    try:
+        Codec(compression='zstd', allow_extra_formats=True)
+        compressions.append('zstd')
+    except ValueError:
+        pass
+    return compressions
+
+
+class TestCodec(object):
+    @pytest.mark.parametrize('serializer', available_serializers())
+    @pytest.mark.parametrize('compression', available_compressions())
+    def test_decode_encoded_value(self, serializer, compression):
+        codec = Codec(serializer, compression, allow_extra_formats=True)
+        assert codec.decode(codec.encode(VALUE)) == VALUE
+
+    @pytest.mark.parametrize('serializer', available_serializers())
+    @pytest.mark.parametrize('compression', available_compressions())
+    def test_any_codec_decodes_any_format(self, serializer, compression):
+        assert Codec().decode(Codec(serializer, compression, allow_extra_formats=True).encode(VALUE)) == VALUE
+
+    def test_uncompressed_json_is_stored_as_plain_json(self):
+        assert json.loads(Codec('json', 'zlib', compression_threshold=10 ** 6).encode(VALUE)) == VALUE
+
+    def test_compression_shrinks_large_values(self):
+        assert len(Codec(compression='zlib').encode(VALUE)) < len(Codec().encode(VALUE))
+
+    @pytest.mark.parametrize('serializer, compression', [
+        ('unknown', None),
+        ('json', 'unknown'),
+    ])
+    def test_unknown_codec(self, serializer, compression):
+        with pytest.raises(ValueError):
+            Codec(serializer, compression)
+
+    def test_unsupported_version(self):
+        encoded = Codec.MARKER + base64.b64encode(bytes([Codec.VERSION + 1, 1, 0]) + b'{}').decode('ascii')
+        with pytest.raises(ValueError):
+            Codec().decode(encoded)
+
+    @pytest.mark.parametrize('serializer, compression', [
+        ('msgpack', None),
+        ('json', 'zstd'),
+    ])
+    def test_formats_needing_extras_must_be_allowed(self, serializer, compression):
+        with pytest.raises(ValueError):
+            Codec(serializer, compression)
+
+    @pytest.mark.parametrize('serializer, compression, module, extra', [
+        ('msgpack', None, 'msgpack', 'msgpack'),
+        ('json', 'zstd', 'zstandard', 'zstd'),
+    ])
+    def test_decoding_without_extra_names_it(self, monkeypatch, serializer, compression, module, extra):
+        if serializer not in available_serializers() or compression not in available_compressions():
+            pytest.skip('{} is not installed'.format(extra))
+        encoded = Codec(serializer, compression, compression_threshold=0, allow_extra_formats=True).encode(VALUE)
+        monkeypatch.setattr(codec_module, module, None)
+        with pytest.raises(MissingExtraError) as exc_info:
+            Codec().decode(encoded)
+        assert exc_info.value.extra == extra
+        assert 'CMservice[{}]'.format(extra) in str(exc_info.value)
@@ -4,6 +4,7 @@ from unittest.mock import patch
 import pytest
 
 from cmservice.consent import Consent
+from cmservice.database import AttributeDictionary, LazyDatasetConnection
 
 
 class TestConsent():
@@ -28,3 +29,29 @@ class TestConsent():
         start_date = datetime.datetime(2015, 1, 1)
         consent = Consent(None, month, timestamp=start_date)
         assert consent.has_expired(max_month)
+
+    @pytest.mark.parametrize('month, max_month, expected', [
+        (1, 999, datetime.datetime(2015, 3, 1)),
+        (5, 1, datetime.datetime(2015, 3, 1)),
+        (12, 12, datetime.datetime(2016, 2, 1)),
+    ])
+    def test_expiration_time(self, month, max_month, expected):
+        consent = Consent(None, month, timestamp=datetime.datetime(2015, 1, 1))
+        assert consent.expiration_time(max_month) == expected
+
+    def test_consents_with_same_attributes_in_other_order_are_equal(self):
+        timestamp = datetime.datetime(2015, 1, 1)
+        assert Consent(['a', 'b'], 1, timestamp) == Consent(['b', 'a'], 1, timestamp)
+        assert Consent(['a', 'b'], 1, timestamp) != Consent(['a'], 1, timestamp)
+        assert Consent(None, 1, timestamp) != Consent(['a'], 1, timestamp)
+
+    def test_consents_encoded_with_same_dictionary_are_compared_as_bitsets(self):
+        dictionary = AttributeDictionary(LazyDatasetConnection())
+        timestamp = datetime.datetime(2015, 1, 1)
+        bits = dictionary.encode(['a', 'b'])
+        consent = Consent.from_attribute_bits(bits, dictionary, 1, timestamp)
+        with patch.object(dictionary, 'decode') as decode:
+            assert consent == Consent.from_attribute_bits(bits, dictionary, 1, timestamp)
+            assert consent != Consent.from_attribute_bits(dictionary.encode(['a']), dictionary, 1, timestamp)
+        assert not decode.called
+        assert consent == Consent(['b', 'a'], 1, timestamp)
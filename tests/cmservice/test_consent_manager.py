@@ -1,14 +1,19 @@
 import json
+import os
 from datetime import timedelta, datetime
+from unittest.mock import patch
 
 import pytest
 from Crypto.PublicKey import RSA
 from jwkest.jwk import RSAKey
 from jwkest.jws import JWS
+from sqlalchemy.exc import OperationalError
 
+from cmservice.circuit_breaker import CircuitBreaker, StaleConsentCache
 from cmservice.consent import Consent
-from cmservice.consent_manager import ConsentManager, InvalidConsentRequestError
-from cmservice.database import ConsentRequestDatasetDB, ConsentDatasetDB
+from cmservice.consent_manager import ConsentManager, InvalidConsentRequestError, StorageUnavailableError
+from cmservice.database import ConsentRequestDatasetDB, ConsentDatasetDB, ConsentRequestDatasetIndex
+from cmservice.ticket import StatelessTicketCodec
 
 
 class TestConsentManager(object):
@@ -66,7 +71,7 @@ class TestConsentManager(object):
             self.cm.save_consent_request(consent_req)
 
     def test_fetch_consent_request(self, consent_request):
-        ticket = 'test_ticket'
+        ticket = self.cm.ticket_generator.new_ticket()
         self.ticket_db.save_consent_request(ticket, consent_request)
         assert self.cm.fetch_consent_request(ticket) == consent_request.data
         assert self.ticket_db.get_consent_request(ticket) is None
@@ -74,8 +79,154 @@ class TestConsentManager(object):
     def test_fetch_consent_request_should_raise_exception_for_unknown_ticket(self):
         assert self.cm.fetch_consent_request("unknown") is None
 
+    def test_fetch_consent_request_should_not_query_database_for_malformed_ticket(self):
+        with patch.object(self.ticket_db, 'get_consent_request') as get_consent_request:
+            assert self.cm.fetch_consent_request('malformed ticket') is None
+        assert not get_consent_request.called
+
+    def test_save_consent_request_should_return_same_ticket_for_retried_request(self):
+        consent_args = {'id': 'test_id', 'attr': ['xyz', 'abc'], 'redirect_endpoint': 'test_redirect'}
+        consent_req = JWS(json.dumps(consent_args)).sign_compact([self.signing_key])
+        ticket = self.cm.save_consent_request(consent_req)
+
+        with patch('jwkest.jws.factory') as factory, \
+                patch.object(self.ticket_db, 'save_consent_request') as save_consent_request:
+            assert self.cm.save_consent_request(consent_req) == ticket
+        assert not factory.called
+        assert not save_consent_request.called
+
+    def test_save_consent_request_should_generate_unique_tickets_for_different_requests(self):
+        consent_args = {'id': 'test_id', 'attr': ['xyz', 'abc'], 'redirect_endpoint': 'test_redirect'}
+        first_req = JWS(json.dumps(consent_args)).sign_compact([self.signing_key])
+        consent_args['id'] = 'other_id'
+        second_req = JWS(json.dumps(consent_args)).sign_compact([self.signing_key])
+        assert self.cm.save_consent_request(first_req) != self.cm.save_consent_request(second_req)
+
+    def test_save_consent_request_should_generate_new_ticket_when_ticket_has_been_used(self):
+        consent_args = {'id': 'test_id', 'attr': ['xyz', 'abc'], 'redirect_endpoint': 'test_redirect'}
+        consent_req = JWS(json.dumps(consent_args)).sign_compact([self.signing_key])
+        ticket = self.cm.save_consent_request(consent_req)
+        assert self.cm.fetch_consent_request(ticket) == consent_args
+
+        new_ticket = self.cm.save_consent_request(consent_req)
+        assert new_ticket != ticket
+        assert self.cm.fetch_consent_request(new_ticket) == consent_args
+
+    def test_save_consent_request_should_keep_one_ticket_for_concurrent_duplicates(self, tmpdir):
+        db_url = 'sqlite:///' + os.path.join(str(tmpdir), 'db')
+        ticket_db = ConsentRequestDatasetDB('salt', db_url)
+        worker1, worker2 = [ConsentManager(self.consent_db, ticket_db, [self.signing_key], 3600, 12,
+                                           request_index=ConsentRequestDatasetIndex('salt', 3600, db_url))
+                            for _ in range(2)]
+        consent_args = {'id': 'test_id', 'attr': ['xyz', 'abc'], 'redirect_endpoint': 'test_redirect'}
+        consent_req = JWS(json.dumps(consent_args)).sign_compact([self.signing_key])
+
+        # both workers receive the request before either has issued a ticket
+        with patch.object(worker1.request_index, 'get_ticket', return_value=None):
+            ticket = worker2.save_consent_request(consent_req)
+            assert worker1.save_consent_request(consent_req) == ticket
+        assert len(ticket_db.consent_request_table) == 1
+
     def test_save_consent(self):
         id = 'test_id'
         consent = Consent(['foo', 'bar'], 2, datetime.now())
         self.cm.save_consent(id, consent)
         assert self.consent_db.get_consent(id) == consent
+
+    def test_warm_up(self):
+        with patch.object(self.consent_db, 'warm_up') as consent_db_warm_up, \
+                patch.object(self.ticket_db, 'warm_up') as ticket_db_warm_up:
+            self.cm.warm_up()
+        assert consent_db_warm_up.called
+        assert ticket_db_warm_up.called
+
+    def test_probe_storage(self):
+        assert self.cm.probe_storage() >= 0
+
+    def test_probe_storage_fails_when_database_is_unavailable(self):
+        with patch.object(self.ticket_db, 'ping', side_effect=Exception('connection refused')):
+            with pytest.raises(Exception):
+                self.cm.probe_storage()
+
+
+class TestConsentManagerStorageFailures(object):
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.consent_db = ConsentDatasetDB("salt", 12)
+        self.breaker = CircuitBreaker('consent_db', failure_threshold=2)
+        self.cm = ConsentManager(self.consent_db, ConsentRequestDatasetDB("salt"), [], 3600, 12,
+                                 consent_db_breaker=self.breaker, stale_consents=StaleConsentCache(60))
+        self.consent = Consent(['a'], 1)
+
+    def test_fail_fast_when_circuit_is_open(self):
+        with patch.object(self.consent_db, 'get_consent', side_effect=IOError('timeout')) as get_consent:
+            for _ in range(3):
+                with pytest.raises(StorageUnavailableError):
+                    self.cm.fetch_consent('id1')
+        assert get_consent.call_count == 2
+        assert self.breaker.state == CircuitBreaker.OPEN
+
+    def test_stale_consent_is_used_when_storage_fails(self):
+        self.consent_db.save_consent('id1', self.consent)
+        assert self.cm.fetch_consent('id1') == self.consent
+
+        with patch.object(self.consent_db, 'get_consent', side_effect=IOError('timeout')):
+            for _ in range(3):
+                assert self.cm.fetch_consent('id1') == self.consent
+        assert self.breaker.state == CircuitBreaker.OPEN
+
+    def test_saved_consent_is_used_when_storage_fails(self):
+        self.cm.save_consent('id1', self.consent)
+        with patch.object(self.consent_db, 'get_consent', side_effect=IOError('timeout')):
+            assert self.cm.fetch_consent('id1') == self.consent
+
+    def test_stale_consent_is_used_when_database_fails(self):
+        self.consent_db.save_consent('id1', self.consent)
+        assert self.cm.fetch_consent('id1') == self.consent
+        error = OperationalError('SELECT', {}, Exception('database is locked'))
+        with patch.object(self.consent_db, 'get_consent', side_effect=error):
+            assert self.cm.fetch_consent('id1') == self.consent
+
+    def test_programming_errors_are_raised(self):
+        cm = ConsentManager(self.consent_db, None, [], 3600, 12, stale_consents=StaleConsentCache(60))
+        self.consent_db.save_consent('id1', self.consent)
+        assert cm.fetch_consent('id1') == self.consent
+        with patch.object(self.consent_db, 'get_consent', side_effect=TypeError()):
+            for _ in range(6):
+                with pytest.raises(TypeError):
+                    cm.fetch_consent('id1')
+        assert cm.consent_db_breaker.state == CircuitBreaker.CLOSED
+
+    def test_without_stale_consents_storage_failures_are_raised(self):
+        cm = ConsentManager(self.consent_db, None, [], 3600, 12)
+        self.consent_db.save_consent('id1', self.consent)
+        assert cm.fetch_consent('id1') == self.consent
+        with patch.object(self.consent_db, 'get_consent', side_effect=IOError('timeout')):
+            with pytest.raises(StorageUnavailableError):
+                cm.fetch_consent('id1')
+
+
+class TestStatelessConsentManager(object):
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.signing_key = RSAKey(key=RSA.generate(1024), alg='RS256')
+        self.cm = ConsentManager(ConsentDatasetDB("salt", 12), None, [self.signing_key], 3600, 12,
+                                 ticket_codec=StatelessTicketCodec('secret', 3600))
+
+    def test_fetch_saved_consent_request(self):
+        consent_args = {'id': 'test_id', 'attr': ['xyz', 'abc'], 'redirect_endpoint': 'test_redirect'}
+        consent_req = JWS(json.dumps(consent_args)).sign_compact([self.signing_key])
+        ticket = self.cm.save_consent_request(consent_req)
+        assert self.cm.fetch_consent_request(ticket) == consent_args
+        assert self.cm.fetch_consent_request(ticket) is None
+
+    def test_save_consent_request_should_return_same_ticket_for_retried_request(self):
+        consent_args = {'id': 'test_id', 'attr': ['xyz', 'abc'], 'redirect_endpoint': 'test_redirect'}
+        consent_req = JWS(json.dumps(consent_args)).sign_compact([self.signing_key])
+        ticket = self.cm.save_consent_request(consent_req)
+        assert self.cm.save_consent_request(consent_req) == ticket
+        assert self.cm.fetch_consent_request(ticket) == consent_args
+        assert self.cm.save_consent_request(consent_req) != ticket
+
+    def test_fetch_consent_request_with_unknown_ticket(self):
+        assert self.cm.fetch_consent_request('unknown') is None
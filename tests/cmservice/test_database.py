@@ -1,11 +1,13 @@
 import datetime
 import os
+import threading
 from unittest.mock import patch
 
 import pytest
 
 from cmservice.consent import Consent
-from cmservice.database import ConsentDatasetDB, ConsentRequestDatasetDB
+from cmservice.database import ConsentDatasetDB, ConsentRequestDatasetDB, AttributeDictionary, \
+    ConsentRequestDatasetIndex, ConsentRequestMemoryIndex, LazyDatasetConnection, ReplicaSet, hash_id
 
 
 @pytest.fixture
@@ -80,6 +82,195 @@ class TestConsentDB():
         assert consent_database.get_consent(self.consent_id) == consent
 
 
+class TestConsentDBBloomFilter(object):
+    def test_unknown_id_should_not_query_database(self):
+        consent_db = ConsentDatasetDB('salt', 999, bloom_filter_error_rate=0.01)
+        with patch.object(consent_db.consent_table, 'find_one') as find_one:
+            assert consent_db.get_consent('unknown') is None
+        assert not find_one.called
+        assert consent_db.negative_cache_stats()['hits'] == 1
+
+    def test_saved_consent_is_found_immediately(self):
+        consent = Consent(['attr1'], 1)
+        consent_db = ConsentDatasetDB('salt', 999, bloom_filter_error_rate=0.01)
+        assert consent_db.get_consent('id1') is None
+        consent_db.save_consent('id1', consent)
+        assert consent_db.get_consent('id1') == consent
+
+    def test_filter_is_built_from_stored_consents(self, tmpdir):
+        consent = Consent(['attr1'], 1)
+        db_url = 'sqlite:///' + os.path.join(str(tmpdir), 'db')
+        ConsentDatasetDB('salt', 999, db_url).save_consent('id1', consent)
+
+        consent_db = ConsentDatasetDB('salt', 999, db_url, bloom_filter_error_rate=0.01)
+        assert consent_db.negative_cache_stats()['size'] == 1
+        assert consent_db.get_consent('id1') == consent
+
+    def test_filter_grows_when_capacity_is_exceeded(self):
+        consent_db = ConsentDatasetDB('salt', 999, bloom_filter_error_rate=0.01, bloom_filter_capacity=2)
+        for i in range(5):
+            consent_db.save_consent('id{}'.format(i), Consent(['attr1'], 1))
+        assert consent_db.negative_cache_stats()['capacity'] >= 5
+        assert all(consent_db.get_consent('id{}'.format(i)) for i in range(5))
+
+    def test_consent_saved_during_rebuild_is_kept(self):
+        consent_db = ConsentDatasetDB('salt', 999, bloom_filter_error_rate=0.01)
+        distinct = consent_db.consent_table.distinct
+
+        def save_while_reading(*args):
+            rows = list(distinct(*args))
+            # saved by another thread after the table was read
+            consent_db.save_consent('id1', Consent(['attr1'], 1))
+            return rows
+
+        with patch.object(consent_db.consent_table, 'distinct', side_effect=save_while_reading):
+            consent_db._build_known_ids(10)
+        assert consent_db.get_consent('id1') is not None
+
+    def test_concurrent_saves_are_all_added(self, tmpdir):
+        db_url = 'sqlite:///' + os.path.join(str(tmpdir), 'db')
+        consent_db = ConsentDatasetDB('salt', 999, db_url, bloom_filter_error_rate=0.01, bloom_filter_capacity=10)
+        consent_db.warm_up()
+        ids = ['id{}'.format(i) for i in range(200)]
+
+        def save(ids):
+            for id in ids:
+                consent_db.save_consent(id, Consent(['attr1'], 1))
+
+        threads = [threading.Thread(target=save, args=(ids[i::4],)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert all(hash_id(id, 'salt') in consent_db.known_ids for id in ids)
+
+    def test_no_stats_without_filter(self, consent_database):
+        assert consent_database.negative_cache_stats() is None
+
+
+class TestAttributeDictionary(object):
+    def test_decode_encoded_attributes(self):
+        dictionary = AttributeDictionary(LazyDatasetConnection())
+        bits = dictionary.encode(['name', 'email', 'phone'])
+        assert dictionary.decode(bits) == ['name', 'email', 'phone']
+        assert dictionary.encode(['email']) & bits == dictionary.encode(['email'])
+
+    def test_names_interned_by_other_process_are_found(self, tmpdir):
+        db_url = 'sqlite:///' + os.path.join(str(tmpdir), 'db')
+        bits = AttributeDictionary(LazyDatasetConnection(db_url)).encode(['name', 'email'])
+        dictionary = AttributeDictionary(LazyDatasetConnection(db_url))
+        assert dictionary.decode(bits) == ['name', 'email']
+        assert dictionary.encode(['email', 'name']) == bits
+
+    def test_name_interned_concurrently_by_other_process(self, tmpdir):
+        from sqlalchemy.exc import IntegrityError
+
+        db_url = 'sqlite:///' + os.path.join(str(tmpdir), 'db')
+        dictionary = AttributeDictionary(LazyDatasetConnection(db_url))
+        other_dictionary = AttributeDictionary(LazyDatasetConnection(db_url))
+
+        def insert_concurrently(*args):
+            other_dictionary.encode(['name'])
+            raise IntegrityError('INSERT', {}, Exception('UNIQUE constraint failed'))
+
+        dictionary.encode(['email'])
+        with patch.object(dictionary.table, 'insert_ignore', side_effect=insert_concurrently):
+            assert dictionary.encode(['name']) == other_dictionary.encode(['name'])
+
+
+class TestConsentDBAttributeEncoding(object):
+    def test_attributes_are_stored_as_bitset(self, consent_database):
+        consent_database.save_consent('id1', Consent(['name', 'email'], 1))
+        row = consent_database.consent_table.find_one()
+        assert row['attributes'].startswith(ConsentDatasetDB.ATTRIBUTE_BITS_PREFIX)
+
+    def test_attributes_are_decoded_lazily(self, consent_database):
+        consent_database.save_consent('id1', Consent(['name', 'email'], 1))
+        with patch.object(consent_database.attribute_dictionary, 'decode') as decode:
+            consent = consent_database.get_consent('id1')
+            assert not decode.called
+            consent.attributes
+            assert decode.called
+
+    def test_consent_stored_as_json_can_be_read(self, consent_database):
+        consent_database.consent_table.insert({
+            'consent_id': hash_id('id1', consent_database.salt),
+            'timestamp': datetime.datetime.now().strftime(ConsentDatasetDB.TIME_PATTERN),
+            'months_valid': 1,
+            'attributes': '["name", "email"]',
+        })
+        assert consent_database.get_consent('id1').attributes == ['name', 'email']
+
+
+class TestWarmUp(object):
+    def test_tables_are_created(self, tmpdir):
+        db_url = 'sqlite:///' + os.path.join(str(tmpdir), 'db')
+        ConsentDatasetDB('salt', 999, db_url).warm_up()
+        ConsentRequestDatasetDB('salt', db_url).warm_up()
+
+        db = LazyDatasetConnection(db_url).db
+        assert set(db['consent'].columns) == {'id', 'consent_id', 'timestamp', 'months_valid', 'attributes'}
+        assert set(db['consent_request'].columns) == {'id', 'ticket', 'data', 'timestamp'}
+
+    def test_warm_up_keeps_stored_consents(self, tmpdir):
+        db_url = 'sqlite:///' + os.path.join(str(tmpdir), 'db')
+        consent = Consent(['attr1'], 1)
+        ConsentDatasetDB('salt', 999, db_url).save_consent('id1', consent)
+
+        consent_db = ConsentDatasetDB('salt', 999, db_url)
+        consent_db.warm_up()
+        assert consent_db.get_consent('id1') == consent
+
+
+class TestConsentDBReplicas(object):
+    @pytest.fixture(autouse=True)
+    def setup(self, tmpdir):
+        self.primary_url = 'sqlite:///' + os.path.join(str(tmpdir), 'primary.db')
+        self.replica_urls = ['sqlite:///' + os.path.join(str(tmpdir), 'replica{}.db'.format(i)) for i in range(2)]
+        self.consent = Consent(['attr1'], 1)
+
+    def replicate(self, id: str, consent: Consent):
+        for replica_url in self.replica_urls:
+            ConsentDatasetDB('salt', 999, replica_url).save_consent(id, consent)
+
+    def test_reads_go_to_replicas(self):
+        consent_db = ConsentDatasetDB('salt', 999, self.primary_url, replica_urls=self.replica_urls,
+                                      read_your_writes_window=0)
+        consent_db.save_consent('id1', self.consent)
+        assert consent_db.get_consent('id1') is None
+
+        self.replicate('id1', self.consent)
+        assert consent_db.get_consent('id1') == self.consent
+
+    def test_reads_after_write_go_to_primary(self):
+        consent_db = ConsentDatasetDB('salt', 999, self.primary_url, replica_urls=self.replica_urls)
+        consent_db.save_consent('id1', self.consent)
+        assert consent_db.get_consent('id1') == self.consent
+
+    def test_reads_are_load_balanced(self):
+        consent_db = ConsentDatasetDB('salt', 999, self.primary_url, replica_urls=self.replica_urls)
+        ConsentDatasetDB('salt', 999, self.replica_urls[0]).save_consent('id1', self.consent)
+        assert [bool(consent_db.get_consent('id1')) for _ in range(4)] == [True, False, True, False]
+
+    def test_failed_replica_is_taken_out_of_rotation(self):
+        consent_db = ConsentDatasetDB('salt', 999, self.primary_url, replica_urls=self.replica_urls,
+                                      read_your_writes_window=0)
+        consent_db.save_consent('id1', self.consent)
+        failing_replica = consent_db.replica_set.replicas[0]
+        with patch.object(failing_replica, 'table', side_effect=Exception('connection refused')):
+            assert consent_db.get_consent('id1') == self.consent
+        assert consent_db.replica_set.healthy == 1
+        assert consent_db.replica_set.choose() is consent_db.replica_set.replicas[1]
+        assert consent_db.replica_set.choose() is consent_db.replica_set.replicas[1]
+
+    def test_recovered_replica_is_put_back_in_rotation(self):
+        replica_set = ReplicaSet(self.replica_urls, retry_interval=0)
+        replica_set.mark_down(replica_set.replicas[0])
+        assert replica_set.healthy == 1
+        assert replica_set.choose() is replica_set.replicas[0]
+        assert replica_set.healthy == 2
+
+
 class TestSQLite3ConsentDB(object):
     def test_store_db_in_file(self, tmpdir):
         consent_id = 'id1'
@@ -107,3 +298,112 @@ class TestSQLite3ConsentRequestDB(object):
         # make sure it was persisted to file
         consent_db = ConsentRequestDatasetDB('salt', db_url)
         assert consent_db.get_consent_request(ticket) == consent_request
+
+
+class TestLazyDatasetConnection(object):
+    def test_connection_is_not_reused_after_fork(self, tmpdir):
+        connection = LazyDatasetConnection('sqlite:///' + os.path.join(str(tmpdir), 'db'))
+        connection.ping()
+        inherited = connection.db.executable
+
+        connection.reset_after_fork()
+        assert connection.db.executable is not inherited
+
+    def test_in_memory_database_is_kept_after_fork(self):
+        connection = LazyDatasetConnection()
+        connection.table('test').insert({'foo': 'bar'})
+
+        connection.reset_after_fork()
+        assert connection.table('test').find_one(foo='bar')
+
+    @pytest.mark.parametrize('db_url, engine_kwargs', [
+        ('sqlite:////tmp/consent.db', {'connect_args': {'timeout': 1.5}}),
+        ('postgresql://localhost/consent', {'connect_args': {'connect_timeout': 2,
+                                                             'options': '-c statement_timeout=1500'},
+                                            'pool_timeout': 1.5}),
+        ('mysql+pymysql://localhost/consent', {'connect_args': {'connect_timeout': 2, 'read_timeout': 2,
+                                                                'write_timeout': 2},
+                                               'pool_timeout': 1.5}),
+    ])
+    def test_timeout(self, db_url, engine_kwargs):
+        assert LazyDatasetConnection(db_url, timeout=1.5)._engine_kwargs() == engine_kwargs
+
+    def test_no_timeout(self):
+        assert LazyDatasetConnection('postgresql://localhost/consent')._engine_kwargs() == {}
+
+    def test_ping_fails_for_unavailable_database(self, tmpdir):
+        connection = LazyDatasetConnection('sqlite:///' + os.path.join(str(tmpdir), 'missing', 'db'))
+        with pytest.raises(Exception):
+            connection.ping()
+
+
+class TestConsentRequestIndex(object):
+    @pytest.fixture(params=['memory', 'dataset'])
+    def index(self, request):
+        if request.param == 'memory':
+            return ConsentRequestMemoryIndex('salt', 600)
+        return ConsentRequestDatasetIndex('salt', 600)
+
+    def test_get_added_ticket(self, index):
+        assert index.get_ticket(index.digest('jwt1')) is None
+        assert index.add_ticket(index.digest('jwt1'), 'ticket1') == 'ticket1'
+        assert index.get_ticket(index.digest('jwt1')) == 'ticket1'
+        assert index.get_ticket(index.digest('jwt2')) is None
+
+    def test_ticket_added_first_is_kept(self, index):
+        index.add_ticket(index.digest('jwt1'), 'ticket1')
+        assert index.add_ticket(index.digest('jwt1'), 'ticket2') == 'ticket1'
+        assert index.get_ticket(index.digest('jwt1')) == 'ticket1'
+
+    def test_expired_ticket_is_replaced(self, index):
+        index.ttl = -1
+        index.add_ticket(index.digest('jwt1'), 'ticket1')
+        assert index.get_ticket(index.digest('jwt1')) is None
+        assert index.add_ticket(index.digest('jwt1'), 'ticket2') == 'ticket2'
+
+    def test_removed_ticket_is_replaced(self, index):
+        index.add_ticket(index.digest('jwt1'), 'ticket1')
+        index.remove_ticket('ticket1')
+        assert index.get_ticket(index.digest('jwt1')) is None
+        assert index.add_ticket(index.digest('jwt1'), 'ticket2') == 'ticket2'
+
+    def test_jwts_and_tickets_are_not_stored(self):
+        index = ConsentRequestDatasetIndex('salt', 600)
+        digest = index.digest('jwt1')
+        index.add_ticket(digest, 'ticket1')
+        row = index.index_table.find_one()
+        assert row['request_digest'] == digest[:index.DIGEST_BYTES].hex()
+        assert row['ticket_hash'] == hash_id('ticket1', 'salt')
+        assert 'ticket1' not in row['encrypted_ticket']
+        assert digest[index.DIGEST_BYTES:].hex() not in row.values()
+
+    def test_encrypted_ticket_can_only_be_decrypted_with_jwt(self):
+        index = ConsentRequestDatasetIndex('salt', 600)
+        index.add_ticket(index.digest('jwt1'), 'ticket1')
+        row = index.index_table.find_one()
+        forged_digest = bytes.fromhex(row['request_digest']) + bytes(32)
+        with pytest.raises(ValueError):
+            index.get_ticket(forged_digest)
+
+    def test_add_ticket_is_a_single_insert(self):
+        index = ConsentRequestDatasetIndex('salt', 600)
+        index.warm_up()
+        with patch.object(index.index_table, 'delete') as delete, \
+                patch.object(index.index_table, 'find_one') as find_one:
+            index.add_ticket(index.digest('jwt1'), 'ticket1')
+        assert not delete.called
+        assert not find_one.called
+
+    def test_memory_index_size_is_bounded(self):
+        index = ConsentRequestMemoryIndex('salt', 600, max_size=2)
+        for i in range(3):
+            index.add_ticket(index.digest('jwt{}'.format(i)), 'ticket{}'.format(i))
+        assert index.get_ticket(index.digest('jwt0')) is None
+        assert index.get_ticket(index.digest('jwt2')) == 'ticket2'
+
+    def test_expired_tickets_are_cleaned_up(self):
+        index = ConsentRequestDatasetIndex('salt', 600, cleanup_interval=2)
+        index.add_ticket(index.digest('jwt1'), 'ticket1')
+        index.ttl = -1
+        index.add_ticket(index.digest('jwt2'), 'ticket2')
+        assert [row['ticket_hash'] for row in index.index_table] == [hash_id('ticket2', 'salt')]
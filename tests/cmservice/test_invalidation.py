@@ -0,0 +1,238 @@
+import os
+import threading
+import time
+from unittest.mock import patch
+
+import pytest
+
+from cmservice.circuit_breaker import CircuitBreaker, StaleConsentCache
+from cmservice.consent import Consent
+from cmservice.consent_manager import ConsentManager
+from cmservice.database import ConsentDatasetDB, hash_id
+from cmservice.invalidation import InvalidationBus, UnixSocketInvalidationBus, DatabaseInvalidationBus
+
+
+class Received(object):
+    def __init__(self):
+        self.hashed_ids = []
+        self.event = threading.Event()
+
+    def __call__(self, hashed_id):
+        self.hashed_ids.append(hashed_id)
+        self.event.set()
+
+
+class TestInvalidationBus(object):
+    def test_single_process_bus_does_nothing(self):
+        bus = InvalidationBus()
+        received = Received()
+        bus.subscribe(received)
+        bus.start()
+        bus.publish('hashed_id')
+        bus.close()
+        assert received.hashed_ids == []
+
+
+class TestUnixSocketInvalidationBus(object):
+    @pytest.fixture(autouse=True)
+    def setup(self, tmpdir):
+        self.socket_dir = str(tmpdir.join('sockets'))
+        self.buses = [UnixSocketInvalidationBus(self.socket_dir) for _ in range(2)]
+        for bus in self.buses:
+            bus.start()
+        yield
+        for bus in self.buses:
+            bus.close()
+
+    def test_invalidation_is_received_by_other_processes(self):
+        received, own = Received(), Received()
+        self.buses[0].subscribe(own)
+        self.buses[1].subscribe(received)
+        self.buses[0].publish('hashed_id')
+        assert received.event.wait(5)
+        assert received.hashed_ids == ['hashed_id']
+        assert own.hashed_ids == []
+
+    def test_sockets_of_exited_processes_are_removed(self):
+        stale_socket = os.path.join(self.socket_dir, '1-abcd.sock')
+        with open(stale_socket, 'w'):
+            pass
+        self.buses[0].publish('hashed_id')
+        assert not os.path.exists(stale_socket)
+
+    def test_closed_bus_removes_its_socket(self):
+        self.buses[1].close()
+        assert len(os.listdir(self.socket_dir)) == 1
+
+    def test_bus_started_in_parent_is_not_started_in_forked_process(self):
+        self.buses[1].after_fork()
+        assert self.buses[1]._socket is None
+        assert len(os.listdir(self.socket_dir)) == 2
+
+    def test_bus_started_after_fork(self):
+        bus = UnixSocketInvalidationBus(self.socket_dir)
+        received = Received()
+        bus.subscribe(received)
+        bus.start_after_fork()
+        assert len(os.listdir(self.socket_dir)) == 2
+
+        bus.after_fork()
+        try:
+            assert len(os.listdir(self.socket_dir)) == 3
+            # caches inherited from the parent may have missed invalidations
+            assert received.hashed_ids == [None]
+        finally:
+            bus.close()
+
+
+class TestDatabaseInvalidationBus(object):
+    @pytest.fixture(autouse=True)
+    def setup(self, tmpdir):
+        db_url = 'sqlite:///' + str(tmpdir.join('invalidation.db'))
+        self.buses = [DatabaseInvalidationBus(db_url, poll_interval=60, max_delay=10) for _ in range(2)]
+        for bus in self.buses:
+            bus.start()
+        yield
+        for bus in self.buses:
+            bus.close()
+
+    def test_invalidation_is_received_by_other_processes(self):
+        received, own = Received(), Received()
+        self.buses[0].subscribe(own)
+        self.buses[1].subscribe(received)
+        self.buses[0].publish('hashed_id1')
+        self.buses[0].publish('hashed_id2')
+        for bus in self.buses:
+            bus.poll()
+        assert received.hashed_ids == ['hashed_id1', 'hashed_id2']
+        assert own.hashed_ids == []
+
+        self.buses[1].poll()
+        assert received.hashed_ids == ['hashed_id1', 'hashed_id2']
+
+    def test_invalidations_published_before_start_are_not_received(self):
+        self.buses[0].publish('hashed_id')
+        bus = DatabaseInvalidationBus(self.buses[0]._connection.db_url, poll_interval=60)
+        received = Received()
+        bus.subscribe(received)
+        bus.start()
+        bus.poll()
+        bus.close()
+        assert received.hashed_ids == []
+
+    def test_invalidation_committed_late_is_received(self):
+        received = Received()
+        self.buses[1].subscribe(received)
+        table = self.buses[0].invalidation_table
+        table.insert({'id': 3, 'hashed_id': 'hashed_id3', 'origin': 'other', 'created': time.time()})
+        self.buses[1].poll()
+        assert received.hashed_ids == ['hashed_id3']
+
+        # ids 1 and 2 were taken by transactions which commit later
+        table.insert({'id': 1, 'hashed_id': 'hashed_id1', 'origin': 'other', 'created': time.time()})
+        self.buses[1].poll()
+        table.insert({'id': 2, 'hashed_id': 'hashed_id2', 'origin': 'other', 'created': time.time()})
+        self.buses[1].poll()
+        self.buses[1].poll()
+        assert received.hashed_ids == ['hashed_id3', 'hashed_id1', 'hashed_id2']
+        assert self.buses[1]._gaps == {}
+        assert self.buses[1]._seen == set()
+
+    def test_skipped_ids_are_given_up_after_overlap(self):
+        table = self.buses[0].invalidation_table
+        table.insert({'id': 3, 'hashed_id': 'hashed_id3', 'origin': 'other', 'created': time.time()})
+        self.buses[1].poll()
+        assert set(self.buses[1]._gaps) == {1, 2}
+        with patch('cmservice.invalidation.time.monotonic', return_value=time.monotonic() + 31):
+            self.buses[1].poll()
+        assert self.buses[1]._gaps == {}
+
+    def test_bus_started_after_fork_receives_what_was_published_since(self):
+        bus = DatabaseInvalidationBus(self.buses[0]._connection.db_url, poll_interval=60)
+        received = Received()
+        bus.subscribe(received)
+        bus.start_after_fork()
+        self.buses[0].publish('hashed_id')
+
+        bus.after_fork()
+        try:
+            bus.poll()
+        finally:
+            bus.close()
+        assert received.hashed_ids == ['hashed_id']
+
+    def test_failed_polling_for_longer_than_max_delay_invalidates_everything(self):
+        received = Received()
+        self.buses[1].subscribe(received)
+        with patch.object(self.buses[1]._connection, 'table', side_effect=IOError('timeout')):
+            self.buses[1].poll()
+            assert received.hashed_ids == []
+            with patch('cmservice.invalidation.time.monotonic', return_value=time.monotonic() + 11):
+                self.buses[1].poll()
+                self.buses[1].poll()
+        assert received.hashed_ids == [None]
+
+        self.buses[0].publish('hashed_id')
+        self.buses[1].poll()
+        assert received.hashed_ids == [None, 'hashed_id', None]
+
+    def test_old_invalidations_are_removed(self):
+        self.buses[0].publish('hashed_id')
+        with patch('cmservice.invalidation.time.time', return_value=time.time() + 3601):
+            self.buses[1].poll()
+        assert len(self.buses[1].invalidation_table) == 0
+
+
+class TestConsentInvalidation(object):
+    @pytest.fixture(autouse=True)
+    def setup(self, tmpdir):
+        consent_db_url = 'sqlite:///' + str(tmpdir.join('consent.db'))
+        invalidation_db_url = 'sqlite:///' + str(tmpdir.join('invalidation.db'))
+        self.buses = [DatabaseInvalidationBus(invalidation_db_url, poll_interval=60) for _ in range(2)]
+        self.consent_dbs = [ConsentDatasetDB('salt', 12, consent_db_url, bloom_filter_error_rate=0.01,
+                                             invalidation_bus=bus)
+                            for bus in self.buses]
+        for bus in self.buses:
+            bus.start()
+        yield
+        for bus in self.buses:
+            bus.close()
+
+    def test_consent_saved_by_other_process_passes_bloom_filter(self):
+        ConsentManager(self.consent_dbs[0], None, [], 3600, 12).save_consent('id1', Consent(['a'], 1))
+        assert self.consent_dbs[1].get_consent('id1') is None
+
+        self.buses[1].poll()
+        assert self.consent_dbs[1].get_consent('id1').attributes == ['a']
+
+    def test_bloom_filter_is_rebuilt_when_invalidations_may_have_been_missed(self):
+        self.consent_dbs[0].save_consent('id1', Consent(['a'], 1))
+        self.buses[1]._deliver(None)
+        assert self.consent_dbs[1].get_consent('id1').attributes == ['a']
+
+    def test_bloom_filter_is_disabled_if_it_cant_be_rebuilt(self):
+        with patch.object(self.consent_dbs[1], '_build_known_ids', side_effect=IOError('timeout')):
+            self.buses[1]._deliver(None)
+        assert self.consent_dbs[1].known_ids is None
+        self.consent_dbs[0].save_consent('id1', Consent(['a'], 1))
+        assert self.consent_dbs[1].get_consent('id1').attributes == ['a']
+
+    def test_consent_changed_by_other_process_is_dropped_from_stale_consents(self):
+        stale_consents = StaleConsentCache(60)
+        cm = ConsentManager(self.consent_dbs[1], None, [], 3600, 12, stale_consents=stale_consents)
+        cm.save_consent('id1', Consent(['a'], 1))
+        assert stale_consents.get(hash_id('id1', 'salt'), 12) is not None
+
+        self.consent_dbs[0].remove_consent('id1')
+        self.consent_dbs[0].publish_invalidation('id1')
+        self.buses[1].poll()
+        assert stale_consents.get(hash_id('id1', 'salt'), 12) is None
+
+
+    def test_failed_publishing_does_not_fail_saving_consent(self):
+        cm = ConsentManager(self.consent_dbs[0], None, [], 3600, 12)
+        with patch.object(self.buses[0], 'publish', side_effect=IOError('timeout')):
+            for _ in range(10):
+                cm.save_consent('id1', Consent(['a'], 1))
+        assert self.consent_dbs[0].get_consent('id1').attributes == ['a']
+        assert cm.consent_db_breaker.state == CircuitBreaker.CLOSED
@@ -0,0 +1,14 @@
+from unittest.mock import patch
+
+from cmservice.latency import LatencyMonitor
+
+
+class TestLatencyMonitor(object):
+    def test_average_decays_without_observations(self):
+        monitor = LatencyMonitor(half_life=1)
+        with patch('cmservice.latency.time') as mock_time:
+            mock_time.monotonic.return_value = 100
+            monitor.observe(2.0)
+            assert monitor.average == 2.0
+            mock_time.monotonic.return_value = 102
+            assert monitor.average == 0.5
@@ -0,0 +1,149 @@
+import json
+import logging
+import queue
+import sys
+
+import pytest
+
+from cmservice import log
+from cmservice.log import LazyJSON, JSONFormatter, NonBlockingQueueHandler, RequestContextFilter, SamplingFilter, \
+    request_id, setup_logging
+from cmservice.tracing import FileSpanExporter, Tracer
+
+
+def make_record(name='cmservice.test', level=logging.DEBUG, msg='message %s', args=('arg',), exc_info=None):
+    return logging.LogRecord(name, level, __file__, 1, msg, args, exc_info)
+
+
+class TestLazyJSON(object):
+    def test_serialized_when_formatted(self):
+        payload = {'attr': ['a', 'b']}
+        assert str(LazyJSON(payload)) == json.dumps(payload)
+        assert make_record(msg='request: %s', args=(LazyJSON(payload),)).getMessage() == \
+            'request: {}'.format(json.dumps(payload))
+
+
+class TestSamplingFilter(object):
+    def test_debug_records_are_sampled_by_logger(self):
+        sampling_filter = SamplingFilter({'cmservice.consent_manager': 0.0})
+        assert not sampling_filter.filter(make_record('cmservice.consent_manager'))
+        assert not sampling_filter.filter(make_record('cmservice.consent_manager.child'))
+        assert sampling_filter.filter(make_record('cmservice.consent_manager', logging.WARNING))
+        assert sampling_filter.filter(make_record('cmservice.database'))
+
+    def test_sample_rate(self):
+        sampling_filter = SamplingFilter({'cmservice': 0.5})
+        kept = sum(sampling_filter.filter(make_record()) for _ in range(1000))
+        assert 350 < kept < 650
+
+
+class TestRequestContextFilter(object):
+    def test_adds_request_and_trace_id(self, tmpdir):
+        token = request_id.set('request1')
+        try:
+            tracer = Tracer(FileSpanExporter(str(tmpdir.join('spans.jsonl'))))
+            with tracer.start_trace('GET', None, {}) as span:
+                record = make_record()
+                RequestContextFilter().filter(record)
+        finally:
+            request_id.reset(token)
+        assert record.request_id == 'request1'
+        assert record.trace_id == span.trace_id
+
+    def test_outside_of_request(self):
+        record = make_record()
+        RequestContextFilter().filter(record)
+        assert record.request_id is None
+        assert record.trace_id is None
+
+
+class TestJSONFormatter(object):
+    def test_format(self):
+        record = make_record()
+        record.request_id = 'request1'
+        entry = json.loads(JSONFormatter().format(record))
+        assert entry['message'] == 'message arg'
+        assert entry['level'] == 'DEBUG'
+        assert entry['logger'] == 'cmservice.test'
+        assert entry['request_id'] == 'request1'
+        assert 'trace_id' not in entry
+
+    def test_format_exception(self):
+        try:
+            raise ValueError('failure')
+        except ValueError:
+            record = make_record(exc_info=sys.exc_info())
+        entry = json.loads(JSONFormatter().format(record))
+        assert 'ValueError: failure' in entry['exception']
+
+
+class TestNonBlockingQueueHandler(object):
+    def test_records_are_dropped_when_queue_is_full(self):
+        handler = NonBlockingQueueHandler(queue.Queue(1))
+        for _ in range(3):
+            handler.handle(make_record())
+        assert handler.queue.qsize() == 1
+        assert handler.dropped == 2
+
+    def test_message_is_formatted_before_queueing(self):
+        handler = NonBlockingQueueHandler(queue.Queue())
+        try:
+            raise ValueError('failure')
+        except ValueError:
+            handler.handle(make_record(args=(['mutable'],), exc_info=sys.exc_info()))
+        record = handler.queue.get_nowait()
+        assert record.getMessage() == "message ['mutable']"
+        assert record.exc_info is None
+        assert 'ValueError: failure' in record.exc_text
+
+
+class TestSetupLogging(object):
+    @pytest.fixture(autouse=True)
+    def restore_root_logger(self):
+        root = logging.getLogger('')
+        level = root.level
+        yield
+        if log._handler is not None:
+            root.removeHandler(log._handler)
+            log._stop_listener()
+            log._handler = None
+        root.setLevel(level)
+
+    def queue_handlers(self):
+        return [handler for handler in logging.getLogger('').handlers if isinstance(handler, NonBlockingQueueHandler)]
+
+    def test_setting_up_again_replaces_handler(self):
+        setup_logging('INFO')
+        setup_logging('INFO')
+        assert len(self.queue_handlers()) == 1
+
+    def test_records_are_written_in_background(self, capsys, tmpdir):
+        log_file = str(tmpdir.join('cmservice.log'))
+        setup_logging('INFO', 'json', log_file)
+        logging.getLogger('cmservice.test').info('message %s', 'arg')
+        logging.getLogger('cmservice.test').debug('not logged')
+        log._stop_listener()
+
+        for output in [capsys.readouterr().out, tmpdir.join('cmservice.log').read()]:
+            lines = output.splitlines()
+            assert len(lines) == 1
+            assert json.loads(lines[0])['message'] == 'message arg'
+
+    def test_exception_is_written_through_listener(self, capsys):
+        setup_logging('INFO', 'json')
+        try:
+            raise ValueError('failure')
+        except ValueError:
+            logging.getLogger('cmservice.test').exception('boom')
+        log._stop_listener()
+
+        entry = json.loads(capsys.readouterr().out)
+        assert entry['message'] == 'boom'
+        assert 'ValueError: failure' in entry['exception']
+
+    def test_restart_after_fork(self, capsys):
+        setup_logging('INFO')
+        log._restart_listener_after_fork()
+        logging.getLogger('cmservice.test').warning('after fork')
+        log._stop_listener()
+        assert 'after fork' in capsys.readouterr().out
@@ -0,0 +1,134 @@
+import os
+from datetime import datetime, timedelta
+
+import pytest
+
+from cmservice.consent import Consent
+from cmservice.memory_database import ConsentMemoryDB
+
+
+@pytest.fixture
+def data_dir(tmpdir):
+    return os.path.join(str(tmpdir), 'consents')
+
+
+class TestConsentMemoryDB(object):
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.consent = Consent(['name', 'email'], 1)
+
+    def test_save_consent(self):
+        consent_db = ConsentMemoryDB('salt', 999)
+        consent_db.save_consent('id1', self.consent)
+        assert consent_db.get_consent('id1') == self.consent
+        assert consent_db.get_consent('unknown') is None
+
+    def test_remove_consent(self):
+        consent_db = ConsentMemoryDB('salt', 999)
+        consent_db.save_consent('id1', self.consent)
+        consent_db.remove_consent('id1')
+        assert consent_db.get_consent('id1') is None
+
+    def test_expired_consent_is_not_returned(self):
+        consent_db = ConsentMemoryDB('salt', 999)
+        consent_db.save_consent('id1', Consent(['name'], 1, datetime.now() - timedelta(weeks=10)))
+        assert consent_db.get_consent('id1') is None
+
+    def test_sweep_removes_expired_consents(self):
+        consent_db = ConsentMemoryDB('salt', 999)
+        consent_db.save_consent('id1', self.consent)
+        consent_db.save_consent('id2', Consent(['name'], 1, datetime.now() - timedelta(weeks=10)))
+        consent_db.save_consent('id2', Consent(['name'], 1, datetime.now() - timedelta(weeks=20)))
+        assert len(consent_db) == 1
+        assert consent_db.sweep() == 0
+
+    def test_replaced_consent_is_not_swept_with_old_expiration(self):
+        consent_db = ConsentMemoryDB('salt', 999)
+        consent_db.save_consent('id1', Consent(['name'], 1, datetime.now() - timedelta(weeks=7)))
+        consent_db.save_consent('id1', self.consent)
+        consent_db.sweep()
+        assert consent_db.get_consent('id1') == self.consent
+
+    def test_expiration_heap_is_compacted(self):
+        consent_db = ConsentMemoryDB('salt', 999)
+        for _ in range(3 * ConsentMemoryDB.MIN_COMPACTED_HEAP_SIZE):
+            consent_db.save_consent('id1', self.consent)
+        assert len(consent_db._expirations) <= ConsentMemoryDB.MIN_COMPACTED_HEAP_SIZE + 2
+        assert consent_db.get_consent('id1') == self.consent
+
+
+class TestConsentMemoryDBPersistence(object):
+    def test_consents_are_loaded_from_write_ahead_log(self, data_dir):
+        consent = Consent(['name', 'email'], 1)
+        consent_db = ConsentMemoryDB('salt', 999, data_dir)
+        consent_db.save_consent('id1', consent)
+        consent_db.save_consent('id2', consent)
+        consent_db.remove_consent('id2')
+        consent_db.close()
+
+        consent_db = ConsentMemoryDB('salt', 999, data_dir)
+        assert consent_db.get_consent('id1') == consent
+        assert consent_db.get_consent('id2') is None
+
+    def test_snapshot_truncates_write_ahead_log(self, data_dir):
+        consent = Consent(['name'], 1)
+        consent_db = ConsentMemoryDB('salt', 999, data_dir, snapshot_interval=3)
+        for i in range(4):
+            consent_db.save_consent('id{}'.format(i), consent)
+        consent_db.close()
+
+        assert os.path.exists(os.path.join(data_dir, ConsentMemoryDB.SNAPSHOT_NAME))
+        with open(os.path.join(data_dir, ConsentMemoryDB.WAL_NAME), 'rb') as f:
+            assert len(f.readlines()) == 1
+
+        consent_db = ConsentMemoryDB('salt', 999, data_dir)
+        assert all(consent_db.get_consent('id{}'.format(i)) == consent for i in range(4))
+
+    def test_partially_written_record_is_skipped(self, data_dir):
+        consent = Consent(['name'], 1)
+        consent_db = ConsentMemoryDB('salt', 999, data_dir)
+        consent_db.save_consent('id1', consent)
+        consent_db.close()
+        with open(os.path.join(data_dir, ConsentMemoryDB.WAL_NAME), 'ab') as f:
+            f.write(b'{"op": "save", "id"')
+
+        consent_db = ConsentMemoryDB('salt', 999, data_dir)
+        assert consent_db.get_consent('id1') == consent
+        consent_db.save_consent('id2', consent)
+        consent_db.close()
+
+        consent_db = ConsentMemoryDB('salt', 999, data_dir)
+        assert consent_db.get_consent('id2') == consent
+        consent_db.save_consent('id2', consent)
+        consent_db.close()
+
+        consent_db = ConsentMemoryDB('salt', 999, data_dir)
+        assert consent_db.get_consent('id2') == consent
+
+    @pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs fork')
+    def test_restarted_worker_sees_consents_of_previous_worker(self, data_dir):
+        consent = Consent(['name'], 1)
+        # created in the master of a preloaded app, before the workers are forked
+        consent_db = ConsentMemoryDB('salt', 999, data_dir, snapshot_interval=4)
+        consent_db.save_consent('master', consent)
+
+        def run_worker(expected_ids, new_ids):
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    if all(consent_db.get_consent(id) == consent for id in expected_ids):
+                        for id in new_ids:
+                            consent_db.save_consent(id, consent)
+                        status = 0
+                finally:
+                    os._exit(status)
+            return os.waitpid(pid, 0)[1]
+
+        assert run_worker(['master'], ['w1-a', 'w1-b']) == 0
+        # the second worker writes a snapshot, which must include the consents of the first
+        assert run_worker(['master', 'w1-a', 'w1-b'], ['w2-a', 'w2-b', 'w2-c']) == 0
+
+        consent_db.close()
+        consent_db = ConsentMemoryDB('salt', 999, data_dir)
+        assert all(consent_db.get_consent(id) == consent for id in ['master', 'w1-a', 'w1-b', 'w2-a', 'w2-b', 'w2-c'])
@@ -0,0 +1,72 @@
+from unittest.mock import patch
+
+import pytest
+
+from cmservice.ticket import TicketGenerator, StatelessTicketCodec
+
+
+class TestTicketGenerator(object):
+    @pytest.mark.parametrize('secret', [None, 'secret'])
+    def test_generated_tickets_are_well_formed_and_unique(self, secret):
+        generator = TicketGenerator(secret)
+        tickets = {generator.new_ticket() for _ in range(100)}
+        assert len(tickets) == 100
+        assert all(generator.is_well_formed(ticket) for ticket in tickets)
+
+    @pytest.mark.parametrize('ticket', [
+        '',
+        'test_ticket',
+        'a' * 64,
+        '../../' + 'a' * 37,
+    ])
+    def test_malformed_tickets_are_rejected(self, ticket):
+        assert not TicketGenerator().is_well_formed(ticket)
+
+    def test_ticket_with_invalid_hmac_is_rejected(self):
+        ticket = TicketGenerator('secret').new_ticket()
+        assert not TicketGenerator('other secret').is_well_formed(ticket)
+        token, mac = ticket.split('.')
+        assert not TicketGenerator('secret').is_well_formed(token)
+        assert not TicketGenerator('secret').is_well_formed('{}.{}'.format(token[::-1], mac))
+
+    @pytest.mark.parametrize('secret', [None, 'secret'])
+    def test_ticket_with_trailing_newline_is_rejected(self, secret):
+        generator = TicketGenerator(secret)
+        assert not generator.is_well_formed(generator.new_ticket() + '\n')
+
+
+class TestStatelessTicketCodec(object):
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.codec = StatelessTicketCodec('secret', 600)
+
+    def test_decode_encoded_ticket(self, consent_request):
+        ticket = self.codec.encode(consent_request)
+        assert self.codec.decode(ticket) == consent_request
+
+    def test_ticket_can_only_be_used_once(self, consent_request):
+        ticket = self.codec.encode(consent_request)
+        assert self.codec.decode(ticket)
+        assert self.codec.decode(ticket) is None
+
+    def test_expired_ticket_is_rejected(self, consent_request):
+        ticket = self.codec.encode(consent_request)
+        with patch('cmservice.ticket.time.time', return_value=10 ** 10):
+            assert self.codec.decode(ticket) is None
+
+    def test_ticket_encrypted_with_other_key_is_rejected(self, consent_request):
+        ticket = StatelessTicketCodec('other secret', 600).encode(consent_request)
+        assert self.codec.decode(ticket) is None
+
+    def test_tampered_ticket_is_rejected(self, consent_request):
+        ticket = self.codec.encode(consent_request)
+        tampered = ticket[:-10] + ('A' if ticket[-10] != 'A' else 'B') + ticket[-9:]
+        assert self.codec.decode(tampered) is None
+
+    @pytest.mark.parametrize('ticket', [
+        '',
+        'test_ticket',
+        '!!!!',
+    ])
+    def test_malformed_ticket_is_rejected(self, ticket):
+        assert self.codec.decode(ticket) is None
@@ -0,0 +1,182 @@
+import json
+import threading
+from unittest.mock import Mock
+
+import pytest
+
+from cmservice.tracing import Tracer, FileSpanExporter, OTLPSpanExporter, current_span, parse_traceparent, span, \
+    traced
+
+TRACE_ID = '4bf92f3577b34da6a3ce929d0e0e4736'
+PARENT_ID = '00f067aa0ba902b7'
+
+
+@pytest.fixture
+def exporter():
+    return Mock()
+
+
+@pytest.fixture
+def tracer(exporter):
+    return Tracer(exporter)
+
+
+def exported_spans(exporter):
+    return {s.name: s for s in exporter.export.call_args[0][0]}
+
+
+class TestParseTraceparent(object):
+    def test_sampled(self):
+        assert parse_traceparent('00-{}-{}-01'.format(TRACE_ID, PARENT_ID)) == (TRACE_ID, PARENT_ID, True)
+
+    def test_not_sampled(self):
+        assert parse_traceparent('00-{}-{}-00'.format(TRACE_ID, PARENT_ID)) == (TRACE_ID, PARENT_ID, False)
+
+    @pytest.mark.parametrize('traceparent', [
+        None,
+        '',
+        'garbage',
+        'ff-{}-{}-01'.format(TRACE_ID, PARENT_ID),
+        '00-{}-{}-01'.format('0' * 32, PARENT_ID),
+        '00-{}-{}-01'.format(TRACE_ID, '0' * 16),
+    ])
+    def test_invalid(self, traceparent):
+        assert parse_traceparent(traceparent) is None
+
+
+class TestTracer(object):
+    def test_spans_are_nested(self, tracer, exporter):
+        with tracer.start_trace('root'):
+            with span('child', foo='bar'):
+                with span('grandchild'):
+                    pass
+
+        spans = exported_spans(exporter)
+        assert spans['root'].parent_id is None
+        assert spans['child'].parent_id == spans['root'].span_id
+        assert spans['grandchild'].parent_id == spans['child'].span_id
+        assert spans['child'].attributes == {'foo': 'bar'}
+        assert len({s.trace_id for s in spans.values()}) == 1
+        assert current_span() is None
+
+    def test_trace_is_exported_once_when_root_ends(self, tracer, exporter):
+        with tracer.start_trace('root'):
+            with span('child'):
+                pass
+            assert not exporter.export.called
+        assert exporter.export.call_count == 1
+
+    def test_trace_continues_callers_trace(self, tracer, exporter):
+        with tracer.start_trace('root', '00-{}-{}-01'.format(TRACE_ID, PARENT_ID)):
+            pass
+        root = exported_spans(exporter)['root']
+        assert root.trace_id == TRACE_ID
+        assert root.parent_id == PARENT_ID
+
+    def test_callers_sampling_decision_is_respected(self, exporter):
+        tracer = Tracer(exporter, sample_rate=0.0)
+        assert tracer.start_trace('root', '00-{}-{}-00'.format(TRACE_ID, PARENT_ID)) is None
+        assert tracer.start_trace('root', '00-{}-{}-01'.format(TRACE_ID, PARENT_ID)) is not None
+
+    def test_sample_rate(self, exporter):
+        tracer = Tracer(exporter, sample_rate=0.25)
+        sampled = sum(1 for _ in range(4000) if tracer.start_trace('root'))
+        assert 800 < sampled < 1200
+
+    def test_exception_is_recorded(self, tracer, exporter):
+        with pytest.raises(ValueError):
+            with tracer.start_trace('root'):
+                with span('child'):
+                    raise ValueError('failed')
+        assert exported_spans(exporter)['child'].error == "ValueError('failed')"
+
+    def test_spans_outside_trace_are_not_recorded(self):
+        with span('child') as s:
+            assert s is None
+            assert current_span() is None
+
+    def test_traced(self, tracer, exporter):
+        @traced()
+        def f():
+            return current_span().name
+
+        with tracer.start_trace('root'):
+            name = f()
+        assert name.endswith('test_traced.<locals>.f')
+        assert name in exported_spans(exporter)
+
+    def test_traceparent_of_span(self, tracer):
+        with tracer.start_trace('root') as root:
+            assert parse_traceparent(root.traceparent) == (root.trace_id, root.span_id, True)
+
+
+class TestFileSpanExporter(object):
+    def test_spans_are_appended_as_json_lines(self, tmpdir):
+        path = str(tmpdir.join('spans.jsonl'))
+        tracer = Tracer(FileSpanExporter(path))
+        for _ in range(2):
+            with tracer.start_trace('root'):
+                with span('child'):
+                    pass
+
+        assert tracer.exporter.flush(5)
+        with open(path) as f:
+            spans = [json.loads(line) for line in f]
+        assert [s['name'] for s in spans] == ['child', 'root'] * 2
+        assert spans[0]['parent_id'] == spans[1]['span_id']
+        assert spans[0]['duration_ms'] >= 0
+
+    def test_spans_are_written_in_background(self, tmpdir, tracer):
+        path = str(tmpdir.join('spans.jsonl'))
+        tracer.exporter = FileSpanExporter(path)
+        written = threading.Event()
+        tracer.exporter.send = Mock(side_effect=lambda spans: written.wait(5))
+        with tracer.start_trace('root'):
+            pass
+        assert not tmpdir.join('spans.jsonl').exists()
+        assert not tracer.exporter.flush(0.01)
+
+        written.set()
+        assert tracer.exporter.flush(5)
+        assert [s.name for s in tracer.exporter.send.call_args[0][0]] == ['root']
+
+
+class TestOTLPSpanExporter(object):
+    def test_encode(self, tracer, exporter):
+        with tracer.start_trace('root', '00-{}-{}-01'.format(TRACE_ID, PARENT_ID), {'http.status_code': 200}):
+            with span('child', template='consent.mako'):
+                pass
+
+        encoded = OTLPSpanExporter('http://localhost:4318/v1/traces').encode(exporter.export.call_args[0][0])
+        resource_spans = encoded['resourceSpans'][0]
+        assert resource_spans['resource']['attributes'] == [
+            {'key': 'service.name', 'value': {'stringValue': 'cmservice'}}]
+        child, root = resource_spans['scopeSpans'][0]['spans']
+        assert root['traceId'] == TRACE_ID
+        assert root['parentSpanId'] == PARENT_ID
+        assert root['kind'] == 2
+        assert root['attributes'] == [{'key': 'http.status_code', 'value': {'intValue': '200'}}]
+        assert child['parentSpanId'] == root['spanId']
+        assert child['kind'] == 1
+        assert child['attributes'] == [{'key': 'template', 'value': {'stringValue': 'consent.mako'}}]
+        assert int(child['endTimeUnixNano']) >= int(child['startTimeUnixNano'])
+
+    def test_spans_are_sent_in_background(self, tracer):
+        sent = threading.Event()
+        exporter = OTLPSpanExporter('http://localhost:4318/v1/traces')
+        exporter.send = Mock(side_effect=lambda spans: sent.set())
+        tracer.exporter = exporter
+        with tracer.start_trace('root'):
+            pass
+
+        assert sent.wait(5)
+        assert [s.name for s in exporter.send.call_args[0][0]] == ['root']
+
+    def test_spans_are_dropped_when_queue_is_full(self, tracer):
+        exporter = OTLPSpanExporter('http://localhost:4318/v1/traces', max_queue_size=1)
+        exporter._ensure_worker = Mock()
+        tracer.exporter = exporter
+        with tracer.start_trace('root'):
+            with span('child'):
+                pass
+        assert exporter.dropped == 1
@@ -6,6 +6,23 @@ from OpenSSL import crypto
 from cmservice.consent_request import ConsentRequest
 
 
+def pytest_addoption(parser):
+    parser.addoption('--benchmark', action='store_true', help='also run the benchmark tests')
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', 'benchmark: wall-clock benchmark, only run with --benchmark')
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption('--benchmark'):
+        return
+    skip = pytest.mark.skip(reason='benchmark, run with --benchmark')
+    for item in items:
+        if 'benchmark' in item.keywords:
+            item.add_marker(skip)
+
+
 @pytest.fixture(scope='session')
 def cert_and_key(tmpdir_factory):
     tmpdir = str(tmpdir_factory.getbasetemp())